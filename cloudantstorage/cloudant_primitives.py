@@ -31,7 +31,7 @@ def create_document(user, document, public_hostname, tenant, namespace, resource
     """
     return 400, None, 'TODO'
 
-def execute_query(user, query, public_hostname, tenant, namespace, projection=None):
+def execute_query(user, query, public_hostname, tenant, namespace, projection=None, lazy=False):
     """
     Execute the specified 'query' against the collection identified by 'public_hostname', 'tenant',
     and 'namespace'.
@@ -44,7 +44,7 @@ def execute_query(user, query, public_hostname, tenant, namespace, projection=No
     """
     return 400, 'TODO'
 
-def get_document(user, public_hostname, tenant, namespace, documentId):
+def get_document(user, public_hostname, tenant, namespace, documentId, lazy=False):
     """
     Get the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
 
@@ -54,6 +54,278 @@ def get_document(user, public_hostname, tenant, namespace, documentId):
     """
     return 400, 'TODO'
 
+def find_documents_by_label(user, label, public_hostname, tenant, namespace):
+    """
+    Find the documents in the collection identified by 'public_hostname', 'tenant', and 'namespace' that have a subject
+    whose rdfs:label is 'label'.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: no errors
+    """
+    return 400, 'TODO'
+
+def find_members(user, membership_resource, membership_predicate, query, sort_predicate, public_hostname, tenant, namespace, skip=0, limit=None):
+    """
+    Find the documents in the collection identified by 'public_hostname', 'tenant', and 'namespace' that have a subject
+    with 'membership_predicate' whose value is 'membership_resource', and that also match 'query', if it isn't empty.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: no errors
+    """
+    return 400, 'TODO'
+
+def count_members(user, membership_resource, membership_predicate, public_hostname, tenant, namespace):
+    """
+    Count the documents that find_members (without a query) would find.
+
+    Return:
+        Success: (200, <count:int>)
+        Error: no errors
+    """
+    return 400, 'TODO'
+
+def create_view(user, name, query, projection, public_hostname, tenant, namespace):
+    """
+    Register the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace', and
+    materialize it. 'query' and 'projection' are as for execute_query.
+
+    Return:
+        Success: (201, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def drop_view(user, name, public_hostname, tenant, namespace):
+    """
+    Unregister the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace', and drop it.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def read_view(user, name, public_hostname, tenant, namespace, lazy=False):
+    """
+    Get the documents of the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace'.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def replace_document(user, document, public_hostname, tenant, namespace, document_id):
+    """
+    Replace the content of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with
+    'document' (rdf_json), creating the document if it doesn't exist.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def get_documents(user, public_hostname, tenant, namespace, document_ids, lazy=False):
+    """
+    Get the documents with the IDs 'document_ids' in the collection identified by 'public_hostname', 'tenant', and 'namespace'.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def create_attachment(user, stream, length, content_type, filename, public_hostname, tenant, namespace, document_id):
+    """
+    Store 'length' bytes read from 'stream' as an attachment of the document specified by 'public_hostname', 'tenant',
+    'namespace', and 'document_id'.
+
+    Return:
+        Success: (201, <attachment-id:string>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def get_attachment(user, public_hostname, tenant, namespace, document_id, attachment_id):
+    """
+    Get the attachment 'attachment_id' of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    Return:
+        Success: (200, <attachment:file-like object with length, content_type and filename attributes>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def delete_attachment(user, public_hostname, tenant, namespace, document_id, attachment_id):
+    """
+    Delete the attachment 'attachment_id' of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def append_change_entries(tenant, namespace, entries):
+    """
+    Append 'entries' to the change log stored with the collection identified by 'tenant' and 'namespace'. Each entry is a
+    dictionary with the keys 'position' (its position in the log, starting at 0), 'kind', 'changed', 'order', and 'identifier'.
+
+    Return:
+        Success: (201, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def read_change_entries(tenant, namespace, start, end=None, limit=None):
+    """
+    Get the entries of the change log stored with the collection identified by 'tenant' and 'namespace' whose positions
+    are from 'start' up to (but not including) 'end', or to the end of the log if 'end' is None, in log order - at most
+    'limit' of them, if it isn't None.
+
+    Return:
+        Success: (200, [<entry:dict>, ...]) (see append_change_entries)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def change_log_length(tenant, namespace):
+    """
+    Get the length of the change log stored with the collection identified by 'tenant' and 'namespace', i.e., the position
+    of its next entry.
+
+    Return:
+        Success: (200, <length:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def allocate_change_positions(tenant, namespace, count):
+    """
+    Atomically allocate 'count' consecutive positions in the change log stored with the collection identified by 'tenant'
+    and 'namespace', for entries to be appended with append_change_entries.
+
+    Return:
+        Success: (200, <first position:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def claim_change_positions(tenant, namespace, start, count):
+    """
+    Atomically allocate the 'count' consecutive positions from 'start' on in the change log stored with the collection
+    identified by 'tenant' and 'namespace', e.g., to store entries whose positions are given by the segments they belong to.
+    This fails if any position from 'start' on has already been allocated (see allocate_change_positions), and later
+    allocations follow the claimed positions.
+
+    Return:
+        Success: (200, None)
+        Error: (409, <errror-msg:string>) if positions from 'start' on have already been allocated
+    """
+    return 400, 'TODO'
+
+def truncate_change_log(tenant, namespace, before):
+    """
+    Remove the entries whose positions are less than 'before' from the change log stored with the collection identified
+    by 'tenant' and 'namespace'. Positions are never reused, so later entries keep their positions.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def remove_numbered_documents(tenant, namespace, prefix, before):
+    """
+    Remove the documents '<prefix><n>' whose number n is less than 'before' from the collection identified by 'tenant' and
+    'namespace', e.g., the ChangeLog segments stored as whole documents by earlier versions of trsbuilder.
+
+    Return:
+        Success: (200, <count:int>) the number of documents removed
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def change_log_start(tenant, namespace):
+    """
+    Get the position before which the change log stored with the collection identified by 'tenant' and 'namespace' has
+    been truncated (0 if it hasn't been).
+
+    Return:
+        Success: (200, <position:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def add_base_members(tenant, namespace, member_urls, stamp):
+    """
+    Add 'member_urls' to the TRS base stored with the collection identified by 'tenant' and 'namespace' (members that are
+    already in the base get the new 'stamp').
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def remove_base_members(tenant, namespace, member_urls=None, before=None):
+    """
+    Remove 'member_urls', or (if 'member_urls' is None) the members that were last added with a stamp less than 'before',
+    from the TRS base stored with the collection identified by 'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def read_base_members(tenant, namespace, after=None, limit=None):
+    """
+    Get the members of the TRS base stored with the collection identified by 'tenant' and 'namespace' that follow 'after'
+    (or all members, if 'after' is None), in URI order, up to 'limit' of them.
+
+    Return:
+        Success: (200, [<member-url:string>, ...])
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def read_document_changes(tenant, namespace, after=None, limit=None):
+    """
+    Get the changes of the documents of the collection identified by 'tenant' and 'namespace' that follow the position
+    'after' (or the latest position, if 'after' is None) - at most 'limit' of them, if it isn't None.
+
+    Return:
+        Success: (200, [<change:dict>, ...], <position>)
+        Error: (<status-code:int>, None, <errror-msg:string>)
+    """
+    return 400, None, 'TODO'
+
+def read_change_source_position(tenant, namespace):
+    """
+    Get the position (see read_document_changes) recorded with the change log stored with the collection identified by
+    'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, <position, or None if none has been recorded>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
+def write_change_source_position(tenant, namespace, position):
+    """
+    Record the position 'position' (see read_document_changes) with the change log stored with the collection identified
+    by 'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    return 400, 'TODO'
+
 def delete_document(user, public_hostname, tenant, namespace, document_id):
     """
     Delete the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
@@ -66,7 +338,17 @@ def delete_document(user, public_hostname, tenant, namespace, document_id):
     """
     return 400, 'TODO'
 
-def patch_document(user, mod_count, new_values, public_hostname, tenant, namespace, document_id):
+def delete_documents(user, query, public_hostname, tenant, namespace):
+    """
+    Delete all the documents that match 'query' in the collection identified by 'public_hostname', 'tenant', and 'namespace'.
+
+    Return:
+        Success: (200, [<deleted-document-id:string>, ...])
+        Error: no errors
+    """
+    return 400, 'TODO'
+
+def patch_document(user, mod_count, new_values, public_hostname, tenant, namespace, document_id, merge=False):
     """
     Patch the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with the
     content in 'document'.
@@ -103,3 +385,6 @@ def get_prior_versions(user, public_hostname, tenant, namespace, history):
 
 def tenant_names(namespace):
     return [] # TODO
+
+def set_request_deadline(deadline):
+    return # TODO
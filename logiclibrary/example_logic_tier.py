@@ -2,9 +2,10 @@ from storage import operation_primitives
 import urlparse, urllib
 import json, rdf_json
 from rdf_json import URI
-from trsbuilder import TrackedResourceSetBuilder
+import trsbuilder
 import utils
 import os
+import time
 import requests
 from requests.exceptions import ConnectionError
 from base_constants import RDF, RDFS, LDP, CE, OWL, TRS, AC, AC_R, AC_W, AC_C, AC_D, AC_ALL, ADMIN_USER, NAMESPACE_MAPPINGS
@@ -17,11 +18,19 @@ HISTORY = CE+'history'
 CREATION_EVENT = TRS+'Creation'
 MODIFICATION_EVENT = TRS+'Modification'
 DELETION_EVENT = TRS+'Deletion'
+ATTACHMENT = CE+'attachment'
+ATTACHMENTS_SEGMENT = 'attachments' # attachments of a document are at <document-url>/attachments/<attachment-id>
 
 CHECK_ACCESS_RIGHTS = os.environ.get('CHECK_ACCESS_RIGHTS') != 'False'
+# Optional limit (in seconds) on the time spent processing a request, including its storage queries and intra-system requests
+REQUEST_TIMEOUT = float(os.environ['REQUEST_TIMEOUT']) if 'REQUEST_TIMEOUT' in os.environ else None
 UNCHANGED=object() # special value for recurse() args
+MIN_INTRA_SYSTEM_TIMEOUT = 0.001 # seconds - requests doesn't accept a zero timeout
 
 SAFE_IN_QUERY_STRING = "~:@!$'()*+,;=/" # exclude &
+MAX_BATCH_GET_URLS = 100
+CHANGE_FEED_WAIT = 30 # seconds a change feed request waits for new entries, unless its 'wait' query parameter says otherwise
+MAX_CHANGE_FEED_WAIT = 60
 
 def quote_query_string(s):
     return urllib.quote(s, SAFE_IN_QUERY_STRING)
@@ -33,9 +42,36 @@ class Domain_Logic(object):
         self.user = self.claims['user']
         self.url_components = url_policy.get_url_components(environ)
         self.tenant, self.namespace, self.document_id, self.extra_path_segments, self.path, self.path_parts, self.request_hostname, self.query_string = self.url_components
-        self.change_tracking = change_tracking # TODO: should we provide a way to turn change_tracking on/off dynamically
-        if change_tracking:
-            self.trs_builders = {}
+        self.change_tracking = change_tracking and trsbuilder.INLINE_CHANGE_TRACKING # TODO: should we provide a way to turn change_tracking on/off dynamically
+        self.deadline = self.request_deadline()
+        operation_primitives.set_request_deadline(self.deadline)
+        self.change_feed_authorized = False
+
+    def request_deadline(self):
+        """
+        Return the time (a time.time() value) by which this request must be processed, or None if it has no deadline.
+
+        The deadline is REQUEST_TIMEOUT seconds after the request was received, or earlier if the request is an intra-system
+        request whose caller has less time left (the CE-Request-Timeout header, see intra_system_timeout - a value that isn't a
+        positive number of seconds is ignored, and a larger one can't extend REQUEST_TIMEOUT). It is kept in the
+        environ, so other Domain_Logic instances for the same request share it. Storage queries are limited to the time left
+        until the deadline, and fail with 503 or 504 when it's exceeded.
+        """
+        if 'ce.deadline' in self.environ:
+            return self.environ['ce.deadline']
+        timeouts = [REQUEST_TIMEOUT] if REQUEST_TIMEOUT is not None else []
+        if 'HTTP_CE_REQUEST_TIMEOUT' in self.environ:
+            try:
+                timeout = float(self.environ['HTTP_CE_REQUEST_TIMEOUT'])
+            except ValueError:
+                timeout = None
+            if timeout is not None and 0 < timeout < float('inf'): # not nan, inf, or negative
+                timeouts.append(timeout)
+            else:
+                logger.warn('invalid CE-Request-Timeout header: %s', self.environ['HTTP_CE_REQUEST_TIMEOUT'])
+        deadline = time.time() + min(timeouts) if timeouts else None
+        self.environ['ce.deadline'] = deadline
+        return deadline
 
     def recurse(self, function, namespace=UNCHANGED, document_id=UNCHANGED, extra_path_segments=UNCHANGED, query_string=UNCHANGED, url=None, tenant=UNCHANGED):
         """
@@ -168,23 +204,182 @@ class Domain_Logic(object):
                                      body should be a list of pairs, where the first element of the pair identifies the field in error, or is ''.
                                      The second element of the pair should start with a number, a space, and an optional string explaining the error
         """
+        if hasattr(body, 'get') and body.get('action') == 'delete':
+            return self.delete_documents(body.get('query'))
+        if hasattr(body, 'get') and body.get('action') in ('create-view', 'drop-view'):
+            return self.update_view(body)
+        if hasattr(body, 'get') and body.get('action') == 'batch-get':
+            return self.batch_get(body.get('urls'))
         return 400, [], [('', 'unknown action')]
 
-    def permissions(self, document, insert_document=None):
+    def update_view(self, body):
+        """
+        Create or drop a saved view of the collection associated with 'self'. These are the 'create-view' and 'drop-view' actions:
+
+            {"action": "create-view", "name": <name>, "query": {...}, "projection": {...}}
+            {"action": "drop-view", "name": <name>}
+
+        The documents of a view are maintained by storage as documents are created, patched and deleted, and are read with
+        GET <collection>?view=<name>. Since a view is shared by all users, only the admin user may create and drop views when
+        access rights are checked.
+        """
+        if not self.namespace or self.document_id: #trailing / or other problem
+            return self.bad_path()
+        if CHECK_ACCESS_RIGHTS and self.user != ADMIN_USER:
+            return 403, [], [('', 'only %s may create or drop views' % ADMIN_USER)]
+        name = body.get('name')
+        if not name:
+            return 400, [], [('', 'missing view name')]
+        if body['action'] == 'create-view':
+            status, result = operation_primitives.create_view(self.user, name, body.get('query', {}), body.get('projection'), self.request_hostname, self.tenant, self.namespace)
+        else:
+            status, result = operation_primitives.drop_view(self.user, name, self.request_hostname, self.tenant, self.namespace)
+        if status not in (200, 201):
+            return status, [], [('', result)]
+        return 200, [], []
+
+    def delete_documents(self, query):
+        """
+        Delete all the documents in the collection associated with 'self' that match 'query' (see execute_query).
+        This is the 'delete' action: POST {"action": "delete", "query": {...}} to the collection with CE-Post-Reason: CE-Action.
+        The query must not be empty - use DELETE on the collection to drop it. The last version of each deleted document is
+        kept as a history document.
+
+        With access rights checking, only the documents that the user owns or that are in a resource group in which
+        the user may delete are deleted.
+
+        The return value is a triple of (status, headers, body):
+          200 - OK                => body is a document listing the deleted resources (ce:deleted)
+          others                  => headers may be an empty list or may optionally include headers to return to the client
+                                     body is a list of pairs, as for the other methods
+        """
+        if not self.namespace or self.document_id: #trailing / or other problem
+            return self.bad_path()
+        if not hasattr(query, 'get') or not query.get('$query', query): # rather than deleting the whole collection
+            return 400, [], [('query', 'the delete action requires a non-empty query')]
+        query = dict(query)
+        if CHECK_ACCESS_RIGHTS:
+            resource_groups = []
+            for resource_group in self.resource_groups():
+                status, permissions = self.resource_group_permissions(resource_group)
+                if status != 200:
+                    return 403, [], [('', 'unable to retrieve permissions. status: %s text: %s' % (status, permissions))]
+                if permissions & AC_D:
+                    resource_groups.append(resource_group)
+            if '$query' in query: # storage only reads the query modifiers next to '$query'
+                query['$query'] = dict(query['$query'], **{'$access': self.access_query(resource_groups)})
+            else:
+                query['$access'] = self.access_query(resource_groups)
+        status, document_ids = operation_primitives.delete_documents(self.user, query, self.request_hostname, self.tenant, self.namespace)
+        if status != 200:
+            return status, [], [('', document_ids)]
+        resource_urls = [url_policy.construct_url(self.request_hostname, self.tenant, self.namespace, document_id) for document_id in document_ids]
+        if self.change_tracking and len(resource_urls) > 0:
+            self.generate_change_events(DELETION_EVENT, resource_urls)
+        request_url = self.request_url()
+        return 200, [], rdf_json.RDF_JSON_Document({request_url: {CE+'deleted': [URI(resource_url) for resource_url in resource_urls]}}, request_url)
+
+    def batch_get(self, urls):
+        """
+        GET several documents of the tenant associated with 'self' in one request. This is the 'batch-get' action:
+        POST {"action": "batch-get", "urls": [<document-url>, ...]} with CE-Post-Reason: CE-Action.
+
+        The documents are read with one storage query per collection, and the user's permissions are retrieved once per
+        resource group rather than once per document.
+
+        The return value is a triple of (status, headers, body):
+          200 - OK                => body is one rdf_json document with the triples of all the documents that the user may read.
+                                     Its request URL subject lists them (ce:resource), and the URLs that don't identify a
+                                     readable document (ce:notFound).
+          others                  => body is a list of pairs, as for the other methods
+        """
+        if not isinstance(urls, (list, tuple)):
+            return 400, [], [('urls', 'batch-get requires a list of urls')]
+        if len(urls) > MAX_BATCH_GET_URLS:
+            return 400, [], [('urls', 'batch-get accepts at most %d urls' % MAX_BATCH_GET_URLS)]
+        status, documents, not_found = self.read_documents(urls)
+        if status != 200:
+            return status, [], [('', documents)]
+        found = set(str(document.graph_url) for document in documents)
+        request_url = self.request_url()
+        result = rdf_json.RDF_JSON_Document({request_url: {}}, request_url)
+        self.add_member_detail(result, documents)
+        if found:
+            result.data[request_url][CE+'resource'] = [URI(str(url)) for url in urls if str(url) in found]
+        if not_found:
+            result.data[request_url][CE+'notFound'] = [URI(url) for url in not_found]
+        return 200, [], result
+
+    def read_documents(self, urls):
+        # Read the documents of this tenant with 'urls' that the user may read, with one storage query per collection.
+        # Return (status, documents, not_found), where not_found lists the urls that don't identify a readable document.
+        document_ids = {} # namespace -> {document id: url}
+        not_found = []
+        for url in urls:
+            url = str(url)
+            url_parts = self.tenant_url_parts(url)
+            if url_parts and url_parts[1] and not url_parts[2]:
+                document_ids.setdefault(url_parts[0], {})[url_parts[1]] = url
+            else:
+                not_found.append(url)
+        documents = []
+        for namespace, urls_by_id in document_ids.iteritems():
+            status, result = operation_primitives.get_documents(self.user, self.request_hostname, self.tenant, namespace, urls_by_id.iterkeys())
+            if status != 200:
+                return status, result, not_found
+            documents.extend(result)
+        if CHECK_ACCESS_RIGHTS:
+            group_permissions = {}
+            readable = []
+            for document in documents:
+                status, permissions = self.permissions(document, group_permissions=group_permissions)
+                if status == 200 and permissions & AC_R:
+                    readable.append(document)
+            documents = readable
+        found = set(str(document.graph_url) for document in documents)
+        not_found.extend(url for urls_by_id in document_ids.itervalues() for url in urls_by_id.itervalues() if url not in found)
+        return 200, documents, not_found
+
+    def tenant_url_parts(self, url):
+        # Return the (namespace, document_id, extra_path_segments) of 'url' if it's the canonical URL of a resource of this
+        # tenant, or None
+        try:
+            namespace, document_id, extra_path_segments, parse_result = url_policy.parse(url)
+        except Exception:
+            return None
+        if namespace and url_policy.construct_url(self.request_hostname, self.tenant, namespace, document_id, extra_path_segments) == url:
+            return namespace, document_id, extra_path_segments
+        return None
+
+    def permissions(self, document, insert_document=None, group_permissions=None):
+        # 'group_permissions' optionally caches the permissions of resource groups, when the permissions of several
+        # documents are checked in the same request
         owner = document.get_value(CE+'owner')
         if self.user == str(owner):
             return 200, AC_ALL # owner can do everything
         else:
             resource_group = document.get_value(AC+'resource-group')
             if resource_group:
-                permissions_url = url_policy.construct_url(self.request_hostname, self.tenant, 'ac-permissions') + ('?%s&%s' % (quote_query_string(str(resource_group)), quote_query_string(self.user)))
-                r = self.intra_system_get(permissions_url)
-                if r.status_code == 200:
-                    return 200, int(r.text)
-                else:
-                    return r.status_code, 'url: %s text: %s' % (permissions_url, r.text)
+                if group_permissions is None:
+                    return self.resource_group_permissions(resource_group)
+                if str(resource_group) not in group_permissions:
+                    group_permissions[str(resource_group)] = self.resource_group_permissions(resource_group)
+                return group_permissions[str(resource_group)]
         return 200, 0
 
+    def resource_group_permissions(self, resource_group):
+        permissions_url = url_policy.construct_url(self.request_hostname, self.tenant, 'ac-permissions') + ('?%s&%s' % (quote_query_string(str(resource_group)), quote_query_string(self.user)))
+        r = self.intra_system_get(permissions_url)
+        if r.status_code == 200:
+            return 200, int(r.text)
+        else:
+            return r.status_code, 'url: %s text: %s' % (permissions_url, r.text)
+
+    def access_query(self, resource_groups):
+        # A '$access' query clause matches the documents owned by the user or in one of 'resource_groups'. Storage evaluates it on
+        # indexed owner and resource group fields, rather than on the ce:owner and ac:resource-group triples of every candidate document.
+        return {'owner': self.user, 'resourceGroups': [str(resource_group) for resource_group in resource_groups]}
+
     def resource_groups(self):
         resource_group_url = url_policy.construct_url(self.request_hostname, self.tenant, 'ac-resource-groups') + ('?%s' % quote_query_string(self.user))
         r = self.intra_system_get(resource_group_url)
@@ -206,14 +401,16 @@ class Domain_Logic(object):
             return 504, [], [('','intra_system_get exception: %s' % e.message)]
         return 200, [('Content-Type', 'text/plain'), ('Content-length', '1')], ['1']
 
-    def prim_get_document(self):
+    def prim_get_document(self, lazy=False):
+        # with lazy=True, a stored document is returned with its subjects converted on access (see operation_primitives.get_document),
+        # for callers that only read a few predicates of it
         if not self.document_id and 'rdfs_label=' in self.query_string:
             #TODO: move this to a separate method and call it from get_container() instead of from here
             query_parms=urlparse.parse_qs(self.query_string)
-            query = {'_any': {RDFS+'label' : query_parms['rdfs_label'][0]}}
-            status, result = operation_primitives.execute_query(self.user, query, self.request_hostname, self.tenant, self.namespace)
+            label = query_parms['rdfs_label'][0]
+            status, result = operation_primitives.find_documents_by_label(self.user, label, self.request_hostname, self.tenant, self.namespace)
             if status == 200:
-                logger.info('Successful query for url: %s query: %s number of results: %s', self.request_url(), query, len(result))
+                logger.info('Successful label lookup for url: %s label: %s number of results: %s', self.request_url(), label, len(result))
                 if len(result) == 1:
                     document = result[0]
                     new_url_parts = urlparse.urlparse(document.graph_url)
@@ -232,11 +429,14 @@ class Domain_Logic(object):
                         document = rdf_json.RDF_JSON_Document({container_url: container_predicates}, container_url)
                         self.add_member_detail(document, result)
                         return 200, document
-                    logger.info('Multiple query matches for url : %s query: %s status: %s', self.request_url(), query, status)                   
+                    logger.info('Multiple label matches for url : %s label: %s status: %s', self.request_url(), label, status)                   
                     return 409, ['Duplicate label, use ?all=true to retrieve the list of resources']
-            logger.info('Failed query for url: %s query: %s status: %s', self.request_url(), query, status)                   
-            return 404, ['Not found']
-        return operation_primitives.get_document(self.user, self.request_hostname, self.tenant, self.namespace, self.document_id)
+            logger.info('Failed label lookup for url: %s label: %s status: %s', self.request_url(), label, status)                   
+            return (status, result) if status in (503, 504) else (404, ['Not found'])
+        if self.document_id and self.namespace.endswith(trsbuilder.TRACKING_SUFFIX) and trsbuilder.isTrackingDocument(self.document_id):
+            # the change log and base are stored as lists of entries and members, and their RDF is generated when it's read
+            return trsbuilder.getTrackingDocument(self.request_hostname, self.tenant, self.namespace, self.document_id, self.query_string)
+        return operation_primitives.get_document(self.user, self.request_hostname, self.tenant, self.namespace, self.document_id, lazy)
         
     def get_document(self):
         """
@@ -250,6 +450,10 @@ class Domain_Logic(object):
                                      body should be a list of pairs, where the first element of the pair identifies the field in error, or is ''.
                                      The second element of the pair should start with a number, a space, and an optional string explaining the error
         """
+        if 'expand=' in self.query_string:
+            query_parms = urlparse.parse_qs(self.query_string)
+            if 'expand' in query_parms:
+                return self.get_expanded_document(query_parms)
         if not self.document_id and 'rdfs_label=' not in self.query_string:
             return self.get_collection()
         if not self.namespace:
@@ -272,6 +476,41 @@ class Domain_Logic(object):
             logger.warn("example_logic_tier GET failed (prim_get_document) {0}: {1}".format(status, document))
             return status, [], [('', document)]
 
+    def get_expanded_document(self, query_parms):
+        """
+        GET the document associated with 'self' (without the 'expand' query parameter), and add the resources that it links to
+        with the predicates in the 'expand' parameter (comma separated predicate URLs) to the response, e.g.:
+
+            GET /cat/items/1?expand=http%3A//example.org/ns%23category,http%3A//example.org/ns%23reviews
+
+        Linked documents are read with one query per collection (see read_documents). Linked resources below a document, like
+        owned containers, are read with recursive_get_document. Resources of other tenants or servers, and resources that the
+        user can't read, are left out. At most MAX_BATCH_GET_URLS resources are added.
+        """
+        predicates = [predicate for value in query_parms.pop('expand') for predicate in value.split(',') if predicate]
+        status, headers, document = self.recurse(self.get_document, query_string=urllib.urlencode(query_parms, True))
+        if status != 200:
+            return status, headers, document
+        urls = []
+        for subject, subject_node in document.iteritems():
+            for predicate in predicates:
+                values = subject_node.get(predicate)
+                for value in values if isinstance(values, (list, tuple)) else [values]:
+                    if isinstance(value, URI) and str(value) not in document.data and str(value) not in urls:
+                        urls.append(str(value))
+        urls = urls[:MAX_BATCH_GET_URLS]
+        status, documents, not_found = self.read_documents(urls)
+        if status != 200:
+            return status, [], [('', documents)]
+        for url in urls:
+            url_parts = self.tenant_url_parts(url)
+            if url_parts and url_parts[2]: # an owned container, or another resource below a document
+                status, headers, linked_resource = self.recursive_get_document(url=url)
+                if status == 200:
+                    documents.append(linked_resource)
+        self.add_member_detail(document, documents)
+        return 200, [], document
+
     def get_collection(self):
         """
         This method returns a storage collection as a Basic Profile Container.
@@ -292,7 +531,11 @@ class Domain_Logic(object):
             document.graph_url = document.graph_url + '?non-member-properties'
             status = 200
         else:
-            status, results = operation_primitives.execute_query(self.user, {}, self.request_hostname, self.tenant, self.namespace)
+            query_parms = urlparse.parse_qs(self.query_string)
+            if 'view' in query_parms:
+                status, results = operation_primitives.read_view(self.user, query_parms['view'][0], self.request_hostname, self.tenant, self.namespace)
+            else:
+                status, results = operation_primitives.execute_query(self.user, {}, self.request_hostname, self.tenant, self.namespace)
             if status == 200:
                 self.add_member_detail(document, results)
                 member_values = []
@@ -315,6 +558,8 @@ class Domain_Logic(object):
                                      body should be a list of pairs, where the first element of the pair identifies the field in error, or is ''.
                                      The second element of the pair should start with a number, a space, and an optional string explaining the error
         """
+        if self.is_attachment_request():
+            return self.delete_attachment()
         resource_url = url_policy.construct_url(self.request_hostname, self.tenant, self.namespace, self.document_id)
         status, headers, document = self.get_document()
         if status != 200:
@@ -342,12 +587,13 @@ class Domain_Logic(object):
     def drop_collection(self):
         if not self.namespace: # nope, not a pre-existing container resource either
             return self.bad_path()
+        if self.change_tracking:
+            trsbuilder.flush_change_events(trsbuilder.FLUSH_TIMEOUT) # so queued events don't recreate the dropped TRS
         operation_primitives.drop_collection(self.user, self.request_hostname, self.tenant, self.namespace)
         operation_primitives.drop_collection(self.user, self.request_hostname, self.tenant, self.namespace + '_history')
         operation_primitives.drop_collection(self.user, self.request_hostname, self.tenant, self.namespace + '_tracking')
-        document_namespace = self.tenant + '/' + self.namespace
-        if self.change_tracking and document_namespace in self.trs_builders:
-            del self.trs_builders[document_namespace]
+        if self.change_tracking:
+            trsbuilder.discard_builder(self.request_hostname, self.tenant + '/' + self.namespace)
         return 204, [], []
 
     def patch_document(self, request_body):
@@ -369,9 +615,9 @@ class Domain_Logic(object):
         resource_url = url_policy.construct_url(self.request_hostname, self.tenant, self.namespace, self.document_id)
         document = rdf_json.RDF_JSON_Document(request_body, resource_url)
         if CHECK_ACCESS_RIGHTS:
-            status, headers, prepatch_document = self.get_document() # TODO: Use prim get
+            status, prepatch_document = self.prim_get_document(lazy=True) # only its owner and resource group are read
             if status != 200:
-                return status, headers, prepatch_document
+                return status, [], [('', prepatch_document)]
             status, permissions = self.permissions(prepatch_document)
             if status == 200:
                 if not permissions & AC_W:
@@ -381,10 +627,11 @@ class Domain_Logic(object):
         if not 'HTTP_CE_REVISION' in self.environ:
             return 400, [], [('', 'Must provide CE-Revision header')]
         revision = self.environ['HTTP_CE_REVISION']
+        merge = self.environ.get('HTTP_CE_MERGE', '').lower() == 'true' # apply to the current revision unless changes overlap
         self.preprocess_properties_for_storage_insertion(document)
         new_url_parts = urlparse.urlparse(document.graph_url)
         path_parts, namespace, document_id, extra_path_segments = url_policy.parse_path(new_url_parts.path)
-        status, result = operation_primitives.patch_document(self.user, revision, request_body, self.request_hostname, self.tenant, namespace, document_id)
+        status, result = operation_primitives.patch_document(self.user, revision, request_body, self.request_hostname, self.tenant, namespace, document_id, merge)
         if(status == 200):
             get_status, headers, new_document = self.get_document()
             if(get_status == 200):
@@ -396,6 +643,130 @@ class Domain_Logic(object):
         else:
             return status, [], [('', result)]
 
+    def is_attachment_request(self):
+        return bool(self.document_id and self.extra_path_segments and self.extra_path_segments[0] == ATTACHMENTS_SEGMENT)
+
+    def create_attachment(self, stream, length, content_type, filename=None):
+        """
+        Store 'length' bytes read from 'stream' (the request body) as a new attachment of the document associated with 'self',
+        and link it from the document with a ce:attachment value. The body is streamed into storage, so it is never held in memory.
+
+        The return value is a triple of (status, headers, body):
+          201 - Created           => headers includes a Location header with the URL of the attachment. body is an empty list.
+          others                  => body is a list of pairs, as for create_document
+        """
+        if len(self.extra_path_segments) != 1:
+            return self.bad_path()
+        status, headers, document = self.attachment_document(AC_W)
+        if status != 200:
+            return status, headers, document
+        status, attachment_id = operation_primitives.create_attachment(self.user, stream, length, content_type, filename, self.request_hostname, self.tenant, self.namespace, self.document_id)
+        if status != 201:
+            return status, [], [('', attachment_id)]
+        attachment_url = url_policy.construct_url(self.request_hostname, self.tenant, self.namespace, self.document_id, [ATTACHMENTS_SEGMENT, attachment_id])
+        status, result = self.link_attachment(document, attachment_url, True)
+        if status != 200:
+            operation_primitives.delete_attachment(self.user, self.request_hostname, self.tenant, self.namespace, self.document_id, attachment_id)
+            return status, [], [('', 'could not link the attachment to its document: %s' % result)]
+        return 201, [('Location', attachment_url)], []
+
+    def get_attachment(self):
+        """
+        GET the attachment associated with 'self'. The user must be allowed to read the attachment's document.
+
+        The return value is a triple of (status, headers, body). If status is 200, body is a file-like object with 'length',
+        'content_type' and 'filename' attributes, otherwise it's a list of pairs, as for get_document.
+        """
+        if len(self.extra_path_segments) != 2:
+            return self.bad_path()
+        status, headers, document = self.recurse(self.get_document, extra_path_segments=None)
+        if status != 200:
+            return status, headers, document
+        status, attachment = operation_primitives.get_attachment(self.user, self.request_hostname, self.tenant, self.namespace, self.document_id, self.extra_path_segments[1])
+        if status != 200:
+            return status, [], [('', attachment)]
+        return 200, [], attachment
+
+    def delete_attachment(self):
+        if len(self.extra_path_segments) != 2:
+            return self.bad_path()
+        status, headers, document = self.attachment_document(AC_W)
+        if status != 200:
+            return status, headers, document
+        status, result = operation_primitives.delete_attachment(self.user, self.request_hostname, self.tenant, self.namespace, self.document_id, self.extra_path_segments[1])
+        if status != 200:
+            return status, [], [('', result)]
+        status, result = self.link_attachment(document, self.request_url(), False)
+        if status != 200:
+            logger.warn('deleted attachment %s but could not unlink it: %s', self.request_url(), result)
+        return 204, [], []
+
+    def attachment_document(self, access_mode):
+        # get the document of the attachment(s) of this request, if the user has 'access_mode' permission on it
+        status, headers, document = self.recurse(self.get_document, extra_path_segments=None)
+        if status != 200:
+            return status, headers, document
+        if CHECK_ACCESS_RIGHTS:
+            status, permissions = self.permissions(document)
+            if status != 200:
+                return 403, [], [('', 'unable to retrieve permissions. status: %s text: %s' % (status, permissions))]
+            if not permissions & access_mode:
+                return 403, [], [('', 'not authorized')]
+        return 200, [], document
+
+    def is_change_feed_request(self):
+        return bool(self.namespace and self.namespace.endswith(trsbuilder.TRACKING_SUFFIX) and self.document_id == trsbuilder.CHANGES_DOCUMENT_ID
+                    and not self.extra_path_segments)
+
+    def get_change_feed(self, since=None, wait=None):
+        """
+        GET the change feed of the tracking collection associated with 'self' (e.g., /cat/items_tracking/changes?since=120&wait=30),
+        i.e., the entries of its TRS change log that follow the entry with the feed sequence number 'since' (the 'since' query
+        parameter if None, or 0). If there are none yet, wait up to 'wait' seconds (the 'wait' query parameter if None, or
+        CHANGE_FEED_WAIT, and at most MAX_CHANGE_FEED_WAIT or the time left until the request's deadline) for one to be added.
+        The user must be allowed to read the TRS.
+
+        The return value is a triple of (status, headers, body). The values of headers and body depends on the status:
+          200 - OK                => body is a dictionary with the 'entries' (a list of dictionaries with 'sequence', 'order',
+                                     'kind', and 'changed' keys, which is empty if none were added in time), and the feed
+                                     sequence number to read the 'next' entries from. The feed sequence number of an entry
+                                     is its position in the log plus one, and usually, but not always, its 'order'.
+          410 - Gone              => the entries that follow 'since' have been removed from the change log, so the client
+                                     has to read the TRS base again
+          others                  => body is a list of pairs, as for get_document
+        """
+        query_parms = urlparse.parse_qs(self.query_string)
+        try:
+            since = int(query_parms.get('since', [0])[0]) if since is None else since
+            wait = float(query_parms.get('wait', [CHANGE_FEED_WAIT])[0]) if wait is None else wait
+        except ValueError:
+            return 400, [], [('', 'since must be an integer and wait a number')]
+        wait = max(min(wait, MAX_CHANGE_FEED_WAIT), 0)
+        if self.deadline is not None:
+            wait = max(min(wait, self.deadline - time.time()), 0)
+        if not self.change_feed_authorized: # the feed can be read as often as the TRS
+            status, headers, document = self.recurse(self.get_document, document_id=trsbuilder.TRS_DOCUMENT_ID, query_string='')
+            if status != 200:
+                return status, headers, document
+            self.change_feed_authorized = True
+        status, entries = trsbuilder.readChangeFeed(self.tenant, self.namespace, since, wait)
+        if status != 200:
+            return status, [], [('', entries)]
+        entries = [{'sequence': entry['position'] + 1, 'order': entry['order'], 'kind': entry['kind'], 'changed': entry['changed']} for entry in entries]
+        return 200, [], {'entries': entries, 'next': entries[-1]['sequence'] if entries else since}
+
+    def link_attachment(self, document, attachment_url, add):
+        # add or remove the ce:attachment value of 'document' for 'attachment_url'. The patch is merged with any patches
+        # made since 'document' was read, unless they changed its attachments too.
+        attachments = [value for value in document.get_values(ATTACHMENT) if str(value) != attachment_url]
+        if add:
+            attachments.append(URI(attachment_url))
+        revision = document.get_value(CE+'revision')
+        status, result = operation_primitives.patch_document(self.user, revision, {document.graph_url: {ATTACHMENT: attachments}}, self.request_hostname, self.tenant, self.namespace, self.document_id, True)
+        if status == 200 and self.change_tracking:
+            self.generate_change_event(MODIFICATION_EVENT, self.document_url())
+        return status, result
+
     def document_url(self):
         return url_policy.construct_url(self.request_hostname, self.tenant, self.namespace, self.document_id)
 
@@ -422,6 +793,8 @@ class Domain_Logic(object):
         ldp_hasMember = container.get_value(LDP+'hasMemberRelation')
         ldp_isMemberOf = container.get_value(LDP+'isMemberOfRelation')
         ldp_containerSortPredicate = container.get_value(CE+'containerSortPredicates')
+        # members of a specific resource are found with find_members, which can use the storage's membership index
+        member_of_resource = ldp_isMemberOf and not ldp_hasMember and not query and ldp_resource and ldp_resource != '_any'
         if not ldp_resource:
             raise ValueError('must provide a membership resource')
         elif ldp_hasMember:
@@ -434,23 +807,17 @@ class Domain_Logic(object):
                 if ldp_resource == '_any':
                     query = {'_any': {str(ldp_isMemberOf) : '_any'}}
                 else:
-                    query = {'_any': {str(ldp_isMemberOf) : ldp_resource}}
+                    query = {}
         else:
             return 200, container
         if CHECK_ACCESS_RIGHTS:
-            resource_groups = self.resource_groups()
-            query['_any2'] = {}
-            if len(resource_groups) > 0:
-                if len(resource_groups) > 1:
-                    resource_group_value = {'$in': resource_groups}
-                else:
-                    resource_group_value = resource_groups[0]
-                query['_any2']['$or'] = [{CE+'owner': URI(self.user)}, {AC+'resource-group': resource_group_value}]
-            else:
-                query['_any2'][CE+'owner'] = URI(self.user)
-        if ldp_containerSortPredicate:
-            query = {'$query': query, '$orderby' : {ldp_containerSortPredicate: 1}}
-        status, result = operation_primitives.execute_query(self.user, query, self.request_hostname, self.tenant, self.namespace)
+            query['$access'] = self.access_query(self.resource_groups())
+        if member_of_resource:
+            status, result = operation_primitives.find_members(self.user, str(ldp_resource), str(ldp_isMemberOf), query, str(ldp_containerSortPredicate) if ldp_containerSortPredicate else None, self.request_hostname, self.tenant, self.namespace)
+        else:
+            if ldp_containerSortPredicate:
+                query = {'$query': query, '$orderby' : {ldp_containerSortPredicate: 1}}
+            status, result = operation_primitives.execute_query(self.user, query, self.request_hostname, self.tenant, self.namespace)
         if status == 200:
             self.add_member_detail(container, result)
             return 200, container
@@ -614,10 +981,17 @@ class Domain_Logic(object):
         document.set_value(property_predicate, URI(url))
 
     def generate_change_event(self, event_type, resource_uri):
+        self.generate_change_events(event_type, [resource_uri])
+
+    def generate_change_events(self, event_type, resource_uris):
+        # the events are added to the collection's TRS by a background thread, so the request doesn't wait for it
+        document_namespace = self.tenant + '/' + self.namespace #Todo: - do this better
+        trsbuilder.post_change_events(self.request_hostname, document_namespace, resource_uris, event_type)
+
+    def trs_builder(self):
+        # the process-wide builder of the collection's TRS, shared by all requests
         document_namespace = self.tenant + '/' + self.namespace #Todo: - do this better
-        if document_namespace not in self.trs_builders:
-            self.trs_builders[document_namespace] = TrackedResourceSetBuilder(self.request_hostname, document_namespace)
-        self.trs_builders[document_namespace].addChangeEntry(resource_uri, event_type)
+        return trsbuilder.get_builder(self.request_hostname, document_namespace)
 
     def namespace_mappings(self):
         return NAMESPACE_MAPPINGS
@@ -650,7 +1024,7 @@ class Domain_Logic(object):
         if not 'Accept' in headers:
             headers['Accept'] = 'application/rdf+json+ce'
         logger.debug('intra_system_get request_url: %s actual_url: %s headers: %s', request_url, actual_url, headers)
-        return requests.get(actual_url, headers=headers)
+        return requests.get(actual_url, headers=headers, timeout=self.intra_system_timeout(headers))
 
     def intra_system_post(self, request_url, data, headers=None):
         if not headers: headers = dict()
@@ -662,7 +1036,7 @@ class Domain_Logic(object):
             headers['CE-Post-Reason'] = 'CE-Create'
         actual_url = utils.set_resource_host_header(str(request_url), headers)
         logger.debug('intra_system_post request_url: %s actual_url: %s headers: %s data: %s', request_url, actual_url, headers,data)
-        return requests.post(actual_url, headers=headers, data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False)
+        return requests.post(actual_url, headers=headers, data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False, timeout=self.intra_system_timeout(headers))
 
     def intra_system_patch(self, request_url, revision, data, headers=None):
         if not headers: headers = dict()
@@ -673,7 +1047,7 @@ class Domain_Logic(object):
         headers['CE-Revision'] = str(revision)
         actual_url = utils.set_resource_host_header(str(request_url), headers)
         logger.debug('intra_system_patch request_url: %s actual_url: %s headers: %s data: %s', request_url, actual_url, headers,data)
-        return requests.patch(actual_url, headers=headers, data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False)
+        return requests.patch(actual_url, headers=headers, data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False, timeout=self.intra_system_timeout(headers))
 
     def intra_system_delete(self, request_url, headers=None):
         if not headers: headers = dict()
@@ -681,7 +1055,7 @@ class Domain_Logic(object):
             headers['Authorization'] = 'Bearer %s' % utils.get_jwt(self.environ)
         actual_url = utils.set_resource_host_header(str(request_url), headers)
         logger.debug('intra_system_delete request_url: %s actual_url: %s headers: %s', request_url, actual_url, headers)
-        return requests.delete(actual_url, headers=headers, verify=False)
+        return requests.delete(actual_url, headers=headers, verify=False, timeout=self.intra_system_timeout(headers))
 
     def intra_system_put(self, request_url, data, headers=None):
         if not headers: headers = dict()
@@ -691,7 +1065,16 @@ class Domain_Logic(object):
             headers['Content-Type'] = 'application/rdf+json+ce'
         actual_url = utils.set_resource_host_header(str(request_url), headers)
         logger.debug('intra_system_put request_url: %s actual_url: %s headers: %s data: %s', request_url, actual_url, headers,data)
-        return requests.put(actual_url, headers=headers,  data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False)
+        return requests.put(actual_url, headers=headers,  data=json.dumps(data, cls=rdf_json.RDF_JSON_Encoder), verify=False, timeout=self.intra_system_timeout(headers))
+
+    def intra_system_timeout(self, headers):
+        # The timeout of an intra-system request: the time left until the deadline of this request, which is also passed
+        # to the callee in the CE-Request-Timeout header, so it stops working when the caller stops waiting.
+        if self.deadline is None:
+            return None
+        remaining = max(self.deadline - time.time(), MIN_INTRA_SYSTEM_TIMEOUT)
+        headers['CE-Request-Timeout'] = '%.3f' % remaining
+        return remaining
 
 def get_header(header, headers, default=None):
     headerl = header.lower()
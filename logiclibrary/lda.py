@@ -107,6 +107,8 @@ def patch_document(environ, document, complete_document_callback=None):
     not match the value provided by the client, the patch will fail and an HTTP 409 (Conflict) status code will be returned. 
     If the update succeeds, the ce_revision in the database will be updated, along with the specidied fields, and an HTTP 200 (OK) status
     code will be returned. A history document will also be created to capture the previous state of the resource.
+    If the ``environ`` also includes a CE-Merge: true header, a patch of an older revision is applied to the current revision
+    unless it changes a property that has been changed since that revision.
 
     The return value is a triple of (body, status, headers). The values of headers and body depends on the status:
       200 - OK                => Successful patch. headers is a list of headers to return to the client. 
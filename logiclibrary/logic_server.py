@@ -7,6 +7,10 @@ import Cookie
 import utils
 import jwt
 import importlib
+import re
+import time
+import threading
+from requests.exceptions import Timeout
 
 import logging
 if 'LOGGING_LEVEL' in os.environ:
@@ -22,6 +26,19 @@ else:
 logic_tier = importlib.import_module(import_name)
 Domain_Logic = logic_tier.Domain_Logic
 
+ATTACHMENT_READ_SIZE = 64 * 1024 # attachments are streamed to the client in pieces of this many bytes
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+FILENAME_PATTERN = re.compile(r'filename="?([^";]+)"?')
+CHANGE_FEED_STREAM_SECONDS = 300 # an event stream is closed after this long, and EventSource clients reconnect with Last-Event-ID
+CHANGE_FEED_KEEPALIVE_SECONDS = 15 # an event stream without new entries gets a comment this often
+# An event stream holds the thread (or process) serving it until it's closed, so a process serves at most
+# MAX_CHANGE_FEED_STREAMS of them at a time, and answers other event stream requests with 503. Keep it below the number of
+# requests a process can serve concurrently, so other requests aren't starved - with a server that runs one request per
+# process at a time, serve event streams from processes of their own, or use an asynchronous server.
+MAX_CHANGE_FEED_STREAMS = int(os.environ.get('MAX_CHANGE_FEED_STREAMS', 10))
+change_feed_streams = threading.BoundedSemaphore(MAX_CHANGE_FEED_STREAMS) if MAX_CHANGE_FEED_STREAMS > 0 else None
+MAX_ATTACHMENT_SIZE = int(os.environ.get('MAX_ATTACHMENT_SIZE', 100 * 1024 * 1024)) # bytes - larger uploads are rejected with 413
+
 def post_document(environ, start_response):
     domain_logic = Domain_Logic(environ)
     post_reason = environ.get('HTTP_CE_POST_REASON')
@@ -29,6 +46,8 @@ def post_document(environ, start_response):
         post_reason = 'ce-create'
     else:
         post_reason = post_reason.lower()
+    if post_reason == 'ce-create' and hasattr(domain_logic, 'create_attachment') and domain_logic.is_attachment_request():
+        return post_attachment(domain_logic, environ, start_response)
     if post_reason == 'ce-create' or post_reason == 'ce-transform' or post_reason == 'ce-action':
         content_type = environ.get('CONTENT_TYPE','').split(';')[0].lower()
         if content_type == 'multipart/form-data':
@@ -64,6 +83,150 @@ def post_document(environ, start_response):
     else:
         return make_json_response(400, [], [('', 'unrecognized post reason %s' % post_reason)], 'application/json', start_response)
 
+def post_attachment(domain_logic, environ, start_response):
+    # The request body is passed on as a stream, so it's stored without being read into memory. Its length must be known
+    # up front (a chunked request has no Content-Length), since the stream is read up to that many bytes.
+    try:
+        content_length = int(environ.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        content_length = -1
+    if not environ.get('CONTENT_LENGTH'):
+        status, headers, body = 411, [], [('', 'an attachment upload requires a Content-Length header')]
+    elif content_length < 0:
+        status, headers, body = 400, [], [('', 'invalid Content-Length header: %s' % environ['CONTENT_LENGTH'])]
+    elif content_length > MAX_ATTACHMENT_SIZE:
+        status, headers, body = 413, [], [('', 'attachments are limited to %d bytes' % MAX_ATTACHMENT_SIZE)]
+    else:
+        content_type = environ.get('CONTENT_TYPE') or 'application/octet-stream'
+        filename = FILENAME_PATTERN.search(environ.get('HTTP_CONTENT_DISPOSITION', ''))
+        status, headers, body = domain_logic.create_attachment(environ['wsgi.input'], content_length, content_type, filename.group(1) if filename else None)
+    add_standard_headers(environ, headers)
+    if status == 201:
+        start_response('%s %s' % (str(status), http_status_codes[status]), headers)
+        return []
+    elif status == 403:
+        return send_auth_challenge(environ, start_response)
+    else:
+        return make_json_response(status, headers, body, 'application/json', start_response)
+
+def get_attachment(domain_logic, environ, start_response):
+    status, headers, attachment = domain_logic.get_attachment()
+    add_standard_headers(environ, headers)
+    if status == 403:
+        return send_auth_challenge(environ, start_response)
+    elif status != 200:
+        return make_json_response(status, headers, attachment, 'application/json', start_response)
+    length = attachment.length
+    byte_range = parse_range(environ.get('HTTP_RANGE'), length)
+    headers.append(('Accept-Ranges', 'bytes'))
+    if byte_range is False:
+        attachment.close()
+        headers.append(('Content-Range', 'bytes */%d' % length))
+        start_response('416 %s' % http_status_codes[416], headers)
+        return []
+    if byte_range is None:
+        start, end = 0, length
+    else:
+        status = 206
+        start, end = byte_range
+        headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, length)))
+    headers.append(('Content-Type', attachment.content_type or 'application/octet-stream'))
+    headers.append(('Content-Length', str(end - start)))
+    if not header_set('Cache-Control', headers):
+        headers.append(('Cache-Control', 'no-cache'))
+    start_response('%s %s' % (str(status), http_status_codes[status]), headers)
+    return read_attachment(attachment, start, end)
+
+def parse_range(range_header, length):
+    # Return the (start, end) byte range (end is exclusive) of a single range 'bytes=' Range header, None if there is no such
+    # header (other ranges are ignored, so the whole attachment is returned), or False if the range can't be satisfied.
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '': # suffix range - the last N bytes
+        suffix_length = int(match.group(2))
+        return (max(length - suffix_length, 0), length) if suffix_length > 0 and length > 0 else False
+    start = int(match.group(1))
+    end = int(match.group(2)) + 1 if match.group(2) else length
+    if end <= start: # invalid, so ignored
+        return None
+    if start >= length:
+        return False
+    return start, min(end, length)
+
+def read_attachment(attachment, start, end):
+    # yield the bytes [start, end) of an attachment a piece at a time, so memory use doesn't depend on the size of the range
+    try:
+        attachment.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = attachment.read(min(remaining, ATTACHMENT_READ_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        attachment.close()
+
+def get_change_feed(domain_logic, environ, start_response):
+    # A change feed is a long-poll JSON resource, or a stream of Server-Sent Events with one 'change' event per entry of
+    # the change log (whose id is the entry's sequence number) if the client accepts text/event-stream.
+    if 'text/event-stream' not in environ.get('HTTP_ACCEPT', ''):
+        status, headers, body = domain_logic.get_change_feed()
+        add_standard_headers(environ, headers)
+        if status == 403:
+            return send_auth_challenge(environ, start_response, 'application/json')
+        return make_json_response(status, headers, body, 'application/json', start_response)
+    last_event_id = environ.get('HTTP_LAST_EVENT_ID', '')
+    status, headers, body = domain_logic.get_change_feed(int(last_event_id) if last_event_id.isdigit() else None, 0)
+    add_standard_headers(environ, headers)
+    if status == 403:
+        return send_auth_challenge(environ, start_response, 'application/json')
+    elif status != 200:
+        return make_json_response(status, headers, body, 'application/json', start_response)
+    if change_feed_streams is not None and not change_feed_streams.acquire(False):
+        headers.append(('Retry-After', str(CHANGE_FEED_KEEPALIVE_SECONDS)))
+        return make_json_response(503, headers, [('', 'too many change feed streams')], 'application/json', start_response)
+    headers.append(('Content-Type', 'text/event-stream'))
+    headers.append(('Cache-Control', 'no-cache'))
+    start_response('200 OK', headers)
+    deadline = time.time() + CHANGE_FEED_STREAM_SECONDS
+    if domain_logic.deadline is not None:
+        deadline = min(deadline, domain_logic.deadline)
+    return ChangeFeedStream(stream_change_feed(domain_logic, body, deadline))
+
+class ChangeFeedStream(object):
+    # The response body of an event stream, which gives back its slot (see MAX_CHANGE_FEED_STREAMS) when the server closes
+    # it - even if the stream was never iterated.
+    def __init__(self, events):
+        self.events = events
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        try:
+            self.events.close()
+        finally:
+            if change_feed_streams is not None:
+                change_feed_streams.release()
+
+def stream_change_feed(domain_logic, body, deadline):
+    # yield the events of a change feed until 'deadline' (a time.time() value)
+    while True:
+        for entry in body['entries']:
+            yield 'event: change\nid: %d\ndata: %s\n\n' % (entry['sequence'], json.dumps(entry))
+        if not body['entries']:
+            yield ': keep-alive\n\n'
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        status, headers, next_body = domain_logic.get_change_feed(body['next'], min(remaining, CHANGE_FEED_KEEPALIVE_SECONDS))
+        if status != 200:
+            yield 'event: error\ndata: %s\n\n' % json.dumps({'status': status, 'message': next_body[0][1] if next_body else ''})
+            return
+        body = next_body
+
 def get_content_location(environ, document):
     return str(document.graph_url) if hasattr(document, 'graph_url') else utils.get_request_url(environ)
     
@@ -71,6 +234,10 @@ def get_document(environ, start_response):
     # In this application architectural style, the only method that ever returns HTML is GET. We never
     # return HTML from POST and we do not support application/x-www-form-urlencoded for POST
     domain_logic = Domain_Logic(environ)
+    if hasattr(domain_logic, 'get_attachment') and domain_logic.is_attachment_request():
+        return get_attachment(domain_logic, environ, start_response)
+    if hasattr(domain_logic, 'get_change_feed') and domain_logic.is_change_feed_request():
+        return get_change_feed(domain_logic, environ, start_response)
     status, headers, body = domain_logic.get_document()
     add_standard_headers(environ, headers)
     request = Request(environ)
@@ -198,23 +365,28 @@ def application(environ, start_response):
     request_method = environ['REQUEST_METHOD']
     path_info = environ['PATH_INFO']
     path_parts = path_info.split('/')
-    if request_method == 'GET':
-        if path_parts[-1] == '__environ__':
-            return get_environ(environ, start_response)
-        elif path_parts[-1] == '__health__':
-            return get_health(environ, start_response)
-        else:
-            return get_document(environ, start_response)
-    elif request_method == 'POST':
-        return post_document(environ, start_response)
-    elif request_method == 'PATCH':
-        return patch_document(environ, start_response)
-    elif request_method == 'PUT':
-        return put_document(environ, start_response)
-    elif request_method == 'DELETE':
-        return delete_document(environ, start_response)
-    elif request_method == 'OPTIONS':
-        return explain_options(environ, start_response)
+    try:
+        if request_method == 'GET':
+            if path_parts[-1] == '__environ__':
+                return get_environ(environ, start_response)
+            elif path_parts[-1] == '__health__':
+                return get_health(environ, start_response)
+            else:
+                return get_document(environ, start_response)
+        elif request_method == 'POST':
+            return post_document(environ, start_response)
+        elif request_method == 'PATCH':
+            return patch_document(environ, start_response)
+        elif request_method == 'PUT':
+            return put_document(environ, start_response)
+        elif request_method == 'DELETE':
+            return delete_document(environ, start_response)
+        elif request_method == 'OPTIONS':
+            return explain_options(environ, start_response)
+    except Timeout as e:
+        # an intra-system request did not complete before the deadline of this request (see Domain_Logic.request_deadline)
+        logger.warn('request timed out - method: %s path: %s error: %s', request_method, path_info, e)
+        return make_text_response(504, [], 'request timed out', 'text/plain', start_response)
 
     response_body = 'not handled - method: %s path: %s' % (environ['REQUEST_METHOD'], environ['PATH_INFO'])
     response_headers = [('Content-Type', 'text/plain'),
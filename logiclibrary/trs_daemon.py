@@ -0,0 +1,99 @@
+# This module maintains the Tracked Resource Sets of collections from the oplog of their MongoDB replica set, instead of
+# having the logic tier add a change entry for each write it makes (see trsbuilder). It is run as a script, with the same
+# environment variables as the application (MONGODB_DB_HOST, MONGODB_DB_PORT, APP_NAME, OPERATION_PRIMITIVES, TRS_..., ...):
+#
+#   python trs_daemon.py public_hostname tenant/namespace [tenant/namespace ...]
+#
+# and the application servers are run with TRS_CHANGE_SOURCE=oplog, so they do no change tracking of their own. Each
+# collection is tailed by a thread of its own, which adds the changes it reads to the TRS of the collection in batches of up
+# to BATCH_SIZE entries (see read_document_changes in operation_primitives for what counts as a change), and then records the
+# oplog position it has reached with the change log. After a restart, each thread continues from its recorded position, so
+# no change is missed - but the changes of a batch that was added when the daemon stopped before recording its position are
+# added again. If the oplog no longer goes back to the recorded position, the changes in between are lost, so the base of the
+# TRS is recomputed (see computeBase in trsbuilder) and tailing starts over from the latest position.
+#
+# Only one daemon should tail a collection.
+#
+import sys
+import threading
+import logging
+import time
+from storage import operation_primitives
+from base_constants import URL_POLICY as url_policy
+import trsbuilder
+from trsbuilder import TRS
+
+logger=logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+RETRY_SECONDS = 10
+
+CHANGE_KINDS = {'create': TRS['Creation'], 'modify': TRS['Modification'], 'delete': TRS['Deletion']}
+
+def tail(public_hostname, collection_name):
+    tenant, namespace = collection_name.split('/', 1)
+    tracking_namespace = namespace + trsbuilder.TRACKING_SUFFIX
+    status, position = operation_primitives.read_change_source_position(tenant, tracking_namespace)
+    if status != 200:
+        raise Exception("could not read the oplog position of {0}: {1} {2}".format(collection_name, status, position))
+    builder = trsbuilder.get_builder(public_hostname, collection_name)
+    logger.info("tailing {0} from oplog position {1}".format(collection_name, position))
+    while True:
+        try:
+            status, changes, position_read = operation_primitives.read_document_changes(tenant, namespace, position, BATCH_SIZE)
+        except Exception:
+            logger.exception("could not read the changes of {0}".format(collection_name))
+            time.sleep(RETRY_SECONDS)
+            continue
+        if status == 410:
+            logger.warn("missed changes of {0}: {1}".format(collection_name, position_read))
+            builder.computeBase()
+            position = None
+            continue
+        elif status != 200:
+            logger.warn("could not read the changes of {0}: {1} {2}".format(collection_name, status, position_read))
+            time.sleep(RETRY_SECONDS)
+            continue
+        events = []
+        for change in changes:
+            if change['kind'] == 'drop':
+                add_changes(builder, events)
+                events = []
+                trsbuilder.discard_builder(public_hostname, collection_name) # the TRS is dropped with its collection
+                builder = trsbuilder.get_builder(public_hostname, collection_name)
+                continue
+            event = (url_policy.construct_url(public_hostname, tenant, namespace, change['document']), CHANGE_KINDS[change['kind']])
+            if len(events) == 0 or events[-1] != event: # a patch of several subjects is a series of revisions
+                events.append(event)
+        if not add_changes(builder, events):
+            time.sleep(RETRY_SECONDS)
+            continue
+        if position_read != position:
+            operation_primitives.write_change_source_position(tenant, tracking_namespace, position_read)
+            position = position_read
+
+def add_changes(builder, events):
+    # return: True if the events have been added to the TRS of 'builder'
+    if len(events) == 0:
+        return True
+    if builder.addChanges(events) is None:
+        logger.warn("could not add {0} change entries to {1}".format(len(events), builder.trackedResourceSetURI))
+        return False
+    return True
+
+def run(public_hostname, collection_names):
+    threads = []
+    for collection_name in collection_names:
+        thread = threading.Thread(target=tail, args=(public_hostname, collection_name), name='trs-tail %s' % collection_name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1) # rather than join(), so the process can be interrupted
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3:
+        print 'usage: python trs_daemon.py public_hostname tenant/namespace [tenant/namespace ...]'
+        sys.exit(1)
+    run(sys.argv[1], sys.argv[2:])
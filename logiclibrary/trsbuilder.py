@@ -13,23 +13,86 @@
 #
 #   builder.addChangeEntry('http://someResourceUri', TRS['Modification'], 100)
 #
-# The following call can be used to add another entry using a generated sequence number (i.e., the next
-# consecutive value, 101 in this case):
+# The following call can be used to add another entry using a generated sequence number, which is the entry's position
+# in the log plus one:
 #
 #   builder.addChangeEntry('http://someOtherResourceUri', TRS['Modification'])
 #
+# Positions are allocated from a counter in storage (see allocate_change_positions), so several processes (on several
+# nodes) can add entries to the same TRS: their entries never take each other's positions or sequence numbers, and are
+# inserted rather than written over the stored log.
+#
 # If the Change Log has more than a page worth of entries (the default page size is 100), then the first
 # segment will point to a continuation segment, which can be retrieved the same way, only using its URI 
 # (e.g., 'http://example.com/tracking/cl1').
 #
-# The following method can be called at any time to (re)compute the base portion of the Tracked Resource Set:
+# Adding an entry only appends it to the entries stored with the TRS (see append_change_entries in operation_primitives),
+# and adds (or removes) the resource of a CREATION (or DELETION) entry to (from) the members stored for the base (see
+# add_base_members). The RDF of the TrackedResourceSet, its ChangeLog segments, and the pages of its base is generated
+# from what's stored when it's read:
+#
+#   status, document = getTrackingDocument(public_hostname, tenant, namespace, document_id, query_string)
+#
+# The base is read in pages of BASE_PAGE_SIZE members, linked with ldp:nextPage. Its cutoff event is the latest entry of
+# the ChangeLog when its first page is read. Since the base is updated before an entry is added to the log, the base
+# reflects all the changes up to its cutoff event (and maybe some later ones, which a client sees again in the log).
+#
+# The following method can be called at any time to recompute the members of the base from the tracked collection, e.g.,
+# to repair a base that missed some changes. It scans the whole collection in a background thread:
 #
 #   builder.computeBase();
 #
-# TODO Add automatic support for truncating (removing old segments) of overly long ChangeLogs.
+# The base of a new TRS is computed that way too. Constructing a builder reads the TRS from storage, so a server should
+# use the process-wide builder of a collection instead, which is constructed once and shared by all requests (and threads):
+#
+#   builder = get_builder(public_hostname, collection_name)
+#
+# discard_builder(public_hostname, collection_name) forgets the builder of a collection, e.g., when it's dropped. Other
+# processes find out that the TRS they have a builder for has been removed (with its collection) from storage when they
+# next use the builder - they check for it every TRS_BUILDER_CHECK_SECONDS (10 by default) - and construct a new one.
+#
+# A server that doesn't want its requests to wait for the TRS to be updated posts its change events instead:
+#
+#   post_change_events(public_hostname, collection_name, ['http://someResourceUri'], TRS['Creation'])
+#
+# They're queued, and added to the TRS by a background thread, which takes up to CHANGE_EVENT_BATCH_SIZE events off the
+# queue at a time and adds the events of each collection in a single write (see addChanges). Events of the same collection
+# are added in the order in which they were posted. The queue is in memory, so events that are still queued when the process
+# is killed are lost - flush_change_events waits for the queue to be empty, and is called when the process exits normally.
+# With TRS_ASYNC_CHANGE_EVENTS=False, post_change_events adds the events to the TRS before it returns.
+#
+# Consumers that want to be notified of changes read the change feed instead of polling the ChangeLog:
+#
+#   status, entries = readChangeFeed(tenant, namespace, since, timeout)
+#
+# returns the entries that follow the one with the feed sequence number 'since', i.e., its position in the stored log plus
+# one (which is also its trs:order, unless the entry was added with an order of its own or converted from a log stored by
+# an earlier version of this module), waiting up to 'timeout' seconds for one to be added if there are none yet. A waiting reader is woken up as soon as a builder of this process has
+# stored entries of its log, and checks for entries added by other processes every TRS_FEED_POLL_INTERVAL seconds.
+# Positions are allocated before their entries are stored, so a later entry can be stored before an earlier one: the feed
+# stops at a missing position, and only skips it when it has been missing for TRS_FEED_HOLE_GRACE_SECONDS (5 by default),
+# e.g., because the process that allocated it failed to store its entry.
+#
+# With TRS_CHANGE_SOURCE=oplog, the logic tier doesn't add change entries at all. The TRS of a collection is maintained by
+# trs_daemon.py instead, which tails the oplog of the collection (see read_document_changes in operation_primitives) and
+# adds an entry for each document it creates, revises or deletes, whoever wrote it. Readers of the change feed of a server
+# then pick up the daemon's entries by polling.
+#
+# With TRS_CHANGE_LOG_SEGMENTS=<n>, the ChangeLog is truncated to its latest n segments (including the current one) as
+# entries are added; the oldest remaining segment then has no trs:previous. The cutoff event of the base is the latest
+# entry of the log when it's read, so the removed segments are always older than it. A builder only reads the length and
+# start of the stored log when it's constructed, and keeps none of its entries in memory, so neither its start-up time nor
+# its memory grows with the log.
 #
 import sys, os
 import datetime
+import threading
+import Queue
+import atexit
+import itertools
+import logging
+import time
+import urlparse, urllib
 from rdflib.graph import Graph
 from rdflib.namespace import Namespace
 from rdflib.term import Literal
@@ -46,61 +109,205 @@ if __name__ == '__main__':
 
 from storage import operation_primitives
 
+logger=logging.getLogger(__name__)
+
 DEFAULT_SEGMENT_SIZE = 100
 
+TRACKING_SUFFIX = '_tracking'
 TRS_DOCUMENT_ID = 'trs'
+CHANGES_DOCUMENT_ID = 'changes' # the change feed
 CL_DOCUMENT_ID_PREFIX = 'cl-'
-BASE_DOCUMENT_ID_PREFIX = 'base-'
+BASE_DOCUMENT_ID = 'base'
+BASE_DOCUMENT_ID_PREFIX = 'base-' # of the bases stored as a single document by earlier versions of this module
+BASE_PAGE_SIZE = 500
+BASE_BATCH_SIZE = 100
+ASYNC_CHANGE_EVENTS = os.environ.get('TRS_ASYNC_CHANGE_EVENTS') != 'False'
+CHANGE_EVENT_BATCH_SIZE = int(os.environ.get('TRS_CHANGE_EVENT_BATCH_SIZE', 100))
+FLUSH_TIMEOUT = 10 # seconds to wait for queued change events when the process exits
+CHANGE_LOG_SEGMENTS = max(1, int(os.environ['TRS_CHANGE_LOG_SEGMENTS'])) if 'TRS_CHANGE_LOG_SEGMENTS' in os.environ else None
+FEED_POLL_INTERVAL = float(os.environ.get('TRS_FEED_POLL_INTERVAL', 5))
+FEED_BATCH_SIZE = 100
+FEED_HOLE_GRACE_SECONDS = float(os.environ.get('TRS_FEED_HOLE_GRACE_SECONDS', 5))
+MAX_FEED_HOLES = 100 # missing positions remembered per log
+INLINE_CHANGE_TRACKING = os.environ.get('TRS_CHANGE_SOURCE', 'inline') != 'oplog'
+BUILDER_CHECK_SECONDS = float(os.environ.get('TRS_BUILDER_CHECK_SECONDS', 10))
 
 PRIVILEGED_USER = 'http://ibm.com/user/Frank'
 
 TRS = Namespace('http://jazz.net/ns/trs#')
 RDF = Namespace('http://www.w3.org/1999/02/22-rdf-syntax-ns#')
 RDFS = Namespace('http://www.w3.org/2000/01/rdf-schema#')
+LDP = Namespace('http://www.w3.org/ns/ldp#')
 
-# Generate the RDF contents for the specified segment of the specified ChangeLog. 
-# Segments are numbered 1 to N, N being the most recent. Segment number N will grow up to twice
-# the specified segmentSize before being split into two segments. All other segments are exactly
-# the specified size.
-# 
-# changes: the current ordered list of entries for the ChangeLog. The last entry in the list is the most recent change.
-# isTrackedResourceSet: true => generate current segment as a blank node (to be inserted in a TrackedResourceSet).
+builders = {} # (public_hostname, collection_name) -> TrackedResourceSetBuilder
+builder_locks = {} # (public_hostname, collection_name) -> lock held while the builder is constructed
+registry_lock = threading.Lock()
+change_events = Queue.Queue() # (public_hostname, collection_name, changed, kind)
+writer_thread = None
+feed_conditions = {} # (tenant, namespace) -> condition notified when entries are stored
+feed_versions = {} # (tenant, namespace) -> number of notifications so far
+feed_holes = {} # (tenant, namespace) -> {missing position: time it was first found missing}
+
+# Return the builder of the TRS of a collection, constructing it (and so recovering its state from storage) on first use
+# in this process, or when the TRS it was constructed for has been removed from storage (see isStale).
+def get_builder(public_hostname, collection_name):
+    key = (public_hostname, collection_name)
+    builder = builders.get(key)
+    if builder is not None and not builder.isStale():
+        return builder
+    with registry_lock:
+        lock = builder_locks.setdefault(key, threading.Lock())
+    with lock: # construct each builder once, without holding up the builders of other collections
+        current = builders.get(key)
+        if current is None or current is builder:
+            if builder is not None:
+                logger.info("the TRS of {0} has been removed, reloading it".format(collection_name))
+            current = TrackedResourceSetBuilder(public_hostname, collection_name)
+            builders[key] = current
+    return current
+
+# Forget the builder of a collection, so the next get_builder constructs a new one from what's in storage.
+def discard_builder(public_hostname, collection_name):
+    key = (public_hostname, collection_name)
+    with registry_lock:
+        lock = builder_locks.get(key)
+    if lock is None:
+        return
+    with lock:
+        builders.pop(key, None)
+
+# Add change entries for the resources 'changed_list' of the collection 'collection_name', of the type 'kind', to the
+# collection's TRS - in the background unless ASYNC_CHANGE_EVENTS is False.
+def post_change_events(public_hostname, collection_name, changed_list, kind):
+    if not ASYNC_CHANGE_EVENTS:
+        get_builder(public_hostname, collection_name).addChangeEntries(changed_list, kind)
+        return
+    start_writer()
+    for changed in changed_list:
+        change_events.put((public_hostname, collection_name, changed, kind))
+
+def start_writer():
+    global writer_thread
+    if writer_thread is not None:
+        return
+    with registry_lock:
+        if writer_thread is None:
+            thread = threading.Thread(target=write_change_events, name='trs-writer')
+            thread.daemon = True
+            thread.start()
+            writer_thread = thread
+
+def write_change_events():
+    while True:
+        events = [change_events.get()]
+        while len(events) < CHANGE_EVENT_BATCH_SIZE:
+            try: events.append(change_events.get_nowait())
+            except Queue.Empty: break
+        collections = [] # in the order of their first event
+        changes = {} # (public_hostname, collection_name) -> [(changed, kind), ...]
+        for public_hostname, collection_name, changed, kind in events:
+            key = (public_hostname, collection_name)
+            if key not in changes:
+                collections.append(key)
+                changes[key] = []
+            changes[key].append((changed, kind))
+        for key in collections:
+            try:
+                get_builder(*key).addChanges(changes[key])
+            except Exception:
+                logger.exception("could not add {0} change entries to the TRS of {1}".format(len(changes[key]), key[1]))
+        for _ in events:
+            change_events.task_done()
+
+# Wait (up to 'timeout' seconds, if it isn't None) until the change events that have been posted so far are in their TRS.
+# return: True if they are.
+def flush_change_events(timeout=None):
+    deadline = time.time() + timeout if timeout is not None else None
+    while change_events.unfinished_tasks > 0:
+        if deadline is not None and time.time() >= deadline:
+            logger.warn("{0} change events weren't added to their TRS".format(change_events.unfinished_tasks))
+            return False
+        time.sleep(0.01)
+    return True
+
+atexit.register(flush_change_events, FLUSH_TIMEOUT)
+
+def feedCondition(tenant, namespace):
+    with registry_lock:
+        return feed_conditions.setdefault((tenant, namespace), threading.Condition())
+
+# Wake up the readers of the change feed of the ChangeLog stored in 'tenant/namespace'.
+def notifyChangeFeed(tenant, namespace):
+    condition = feedCondition(tenant, namespace)
+    with condition:
+        feed_versions[(tenant, namespace)] = feed_versions.get((tenant, namespace), 0) + 1
+        condition.notify_all()
+
+# Get up to FEED_BATCH_SIZE entries of the ChangeLog stored in the collection 'tenant/namespace' that follow the entry
+# with the feed sequence number 'since' (0 for all of them), waiting up to 'timeout' seconds for one if there are none.
+# Feed sequence numbers are positions plus one (not trs:order values), so this is a range scan, which stops at a position
+# whose entry hasn't been stored yet (see contiguousEntries).
+# return: (200, [<entry:dict>, ...]) (see append_change_entries), possibly empty, or (410, <error message>) if entries
+#         that follow 'since' have been removed by truncation, or (<status>, <error message>)
+def readChangeFeed(tenant, namespace, since, timeout=0):
+    key = (tenant, namespace)
+    condition = feedCondition(tenant, namespace)
+    deadline = time.time() + timeout
+    while True:
+        with condition:
+            version = feed_versions.get(key, 0)
+        status, start = operation_primitives.change_log_start(tenant, namespace)
+        if status != 200:
+            return status, start
+        if since < start:
+            return 410, 'entries after %d have been removed from the change log' % since
+        status, entries = operation_primitives.read_change_entries(tenant, namespace, since, limit=FEED_BATCH_SIZE)
+        if status != 200:
+            return status, entries
+        entries, holeWait = contiguousEntries(key, since, entries)
+        remaining = deadline - time.time()
+        if len(entries) > 0 or remaining <= 0:
+            return status, entries
+        with condition:
+            if feed_versions.get(key, 0) == version: # nothing stored since the entries were read
+                condition.wait(min(remaining, FEED_POLL_INTERVAL, holeWait if holeWait is not None else FEED_POLL_INTERVAL))
+
+# Return the leading 'entries' (read from position 'since' on) whose positions follow each other, and the seconds to wait
+# before the first missing position is skipped (None if none is missing). A missing position is skipped once it has been
+# missing for FEED_HOLE_GRACE_SECONDS, since its entry may never be stored.
+def contiguousEntries(key, since, entries):
+    position = since
+    now = time.time()
+    for index, entry in enumerate(entries):
+        if entry['position'] != position:
+            with registry_lock:
+                holes = feed_holes.setdefault(key, {})
+                if position not in holes and len(holes) >= MAX_FEED_HOLES:
+                    holes.pop(min(holes, key=holes.get)) # the oldest
+                missingSince = holes.setdefault(position, now)
+            if missingSince + FEED_HOLE_GRACE_SECONDS > now:
+                return entries[:index], missingSince + FEED_HOLE_GRACE_SECONDS - now
+            logger.warn("skipping missing change log positions {0} to {1} of {2}".format(position, entry['position'] - 1, key[1]))
+            position = entry['position']
+        position += 1
+    return entries, None
+
+# Add the RDF of a ChangeLog segment with the entries 'changes' (oldest first) to 'outputGraph'.
+#
+# segmentResource: the resource of the segment (a blank node for the current segment of a TrackedResourceSet).
 # changeLogURIPrefix: the URI prefix of the ChangeLog segments (i.e., "<prefix>/1", "<prefix>/2", ...).
-# segmentNo: the segment number to generate (must be > truncatedSegmentNo).
-# truncatedSegmentNo: the segment number of the continuation of the log represented by "changes" (0 => none).
-# segmentSize: the segment size.
-# outputGraph: the Graph in which to generate the ChangeLog RDF.
-# 
-# return: the generated segment resource.
-def generateSegment(changes, isTrackedResourceSet, changeLogURIPrefix, segmentNo, truncatedSegmentNo, segmentSize, outputGraph):
-    currentSegment = truncatedSegmentNo + len(changes) / segmentSize
-    if currentSegment == 0:
-        currentSegment += 1
-    
-    assert(segmentNo > truncatedSegmentNo and segmentNo <= currentSegment)
-    
-    if segmentNo == currentSegment:
-        if isTrackedResourceSet:
-            segmentResource = BNode() # resource will be a blank node
-        else: 
-            segmentResource = URIRef(changeLogURIPrefix)
-    else:
-        segmentResource = URIRef(changeLogURIPrefix + str(segmentNo))
-    
+# segmentNo: the segment number.
+# truncatedSegmentNo: the number of the latest segment that has been removed by truncation (0 => none).
+#
+# return: segmentResource.
+def addSegment(changes, segmentResource, changeLogURIPrefix, segmentNo, outputGraph, truncatedSegmentNo=0):
     nextSegmentNo = segmentNo - 1
-    if nextSegmentNo != 0:
+    if nextSegmentNo > truncatedSegmentNo:
         nextPageResource = changeLogURIPrefix + str(nextSegmentNo)
         outputGraph.add((segmentResource, TRS['previous'], Literal(nextPageResource)))
 
-    startIndex = (segmentNo - truncatedSegmentNo - 1) * segmentSize
-    if startIndex + (segmentSize * 2) <= len(changes):
-        endIndex = startIndex + segmentSize
-    else:
-        endIndex = len(changes)
-    
     changesList = RDF['nil']
-    for index in range(startIndex, endIndex):
-        change = changes[index]
+    for change in changes:
         changeResource = URIRef(change.identifier)
         outputGraph.add((changeResource, TRS['changed'], URIRef(change.changed)))
         outputGraph.add((changeResource, RDF['type'], URIRef(change.kind)))
@@ -116,8 +323,109 @@ def generateSegment(changes, isTrackedResourceSet, changeLogURIPrefix, segmentNo
     
     return segmentResource
 
-def generateIdentifier(order):
-    return "urn:trs:" + timestamp() + ":" + str(order);
+# The number of the current segment of a ChangeLog with 'length' entries. Segments are numbered 1 to N, N being the
+# current one. All other segments hold exactly segmentSize entries, and the current one holds up to twice segmentSize
+# entries before being split into two.
+def currentSegmentNumber(length, segmentSize):
+    return max(1, length / segmentSize)
+
+# The positions of the first entry and of the entry after the last one of segment 'segmentNo' of a ChangeLog with
+# 'length' entries.
+def segmentBounds(segmentNo, length, segmentSize):
+    start = (segmentNo - 1) * segmentSize
+    end = length if segmentNo == currentSegmentNumber(length, segmentSize) else segmentNo * segmentSize
+    return start, end
+
+def isTrackingDocument(document_id):
+    return document_id in (TRS_DOCUMENT_ID, BASE_DOCUMENT_ID) or document_id.startswith(CL_DOCUMENT_ID_PREFIX)
+
+# Get the TrackedResourceSet ('trs'), a ChangeLog segment ('cl-<segment number>'), or a page of the base ('base', with
+# the query string 'after=<last member of the previous page>' for the pages after the first) stored in the collection
+# 'tenant/namespace' (a namespace ending with TRACKING_SUFFIX), generating its RDF from the stored entries and members.
+# return: (200, RDF_JSON_Document) or (<status>, <error message>)
+def getTrackingDocument(public_hostname, tenant, namespace, document_id, query_string='', segmentSize=DEFAULT_SEGMENT_SIZE):
+    if document_id == BASE_DOCUMENT_ID:
+        return getBasePage(public_hostname, tenant, namespace, query_string)
+    status, length = operation_primitives.change_log_length(tenant, namespace)
+    if status != 200:
+        return status, length
+    status, start = operation_primitives.change_log_start(tenant, namespace)
+    if status != 200:
+        return status, start
+    currentSegmentNo = currentSegmentNumber(length, segmentSize)
+    truncatedSegmentNo = min(start / segmentSize, currentSegmentNo - 1)
+    trackedResourceSetURIBase = 'http://%s/%s/%s/' % (public_hostname, tenant, namespace)
+    changeLogURIBase = trackedResourceSetURIBase + CL_DOCUMENT_ID_PREFIX
+    graphURI = trackedResourceSetURIBase + document_id
+    if document_id == TRS_DOCUMENT_ID:
+        status, document = operation_primitives.get_document(PRIVILEGED_USER, public_hostname, tenant, namespace, document_id)
+        if status != 200:
+            return status, document
+        graph = rdfjson_to_graph(document)
+        if graph.value(URIRef(graphURI), TRS['changeLog']) is not None: # stored with its current segment by an earlier version
+            return status, document
+        segmentNo = currentSegmentNo
+        segmentResource = BNode()
+        graph.add((URIRef(graphURI), TRS['changeLog'], segmentResource))
+    else:
+        try:
+            segmentNo = int(document_id[len(CL_DOCUMENT_ID_PREFIX):])
+        except ValueError:
+            segmentNo = 0
+        if segmentNo <= truncatedSegmentNo or segmentNo >= currentSegmentNo:
+            return 404, '404 not found'
+        graph = Graph()
+        segmentResource = URIRef(graphURI)
+    start, end = segmentBounds(segmentNo, length, segmentSize)
+    status, entries = operation_primitives.read_change_entries(tenant, namespace, start, end)
+    if status != 200:
+        return status, entries
+    if len(entries) == 0 and segmentNo != currentSegmentNo: # a segment stored as a whole by an earlier version
+        return operation_primitives.get_document(PRIVILEGED_USER, public_hostname, tenant, namespace, document_id)
+    changes = [ChangeEntry(entry['kind'], entry['changed'], entry['order'], entry['identifier'], entry['position']) for entry in entries]
+    addSegment(changes, segmentResource, changeLogURIBase, segmentNo, graph, truncatedSegmentNo)
+    return 200, RDF_JSON_Document(graph_to_rdfjson(graph), graphURI)
+
+def getBasePage(public_hostname, tenant, namespace, query_string):
+    baseURI = URIRef('http://%s/%s/%s/%s' % (public_hostname, tenant, namespace, BASE_DOCUMENT_ID))
+    after = urlparse.parse_qs(query_string).get('after', [None])[0]
+    graph = Graph()
+    if after is None:
+        # the cutoff event is read before the members, so the members reflect all the changes up to it
+        status, cutoffEvent = latestChangeEvent(tenant, namespace)
+        if status != 200:
+            return status, cutoffEvent
+        graph.add((baseURI, TRS['cutoffEvent'], cutoffEvent))
+        pageURI = baseURI
+    else:
+        pageURI = URIRef(baseURI + '?' + urllib.urlencode({'after': after}))
+    status, members = operation_primitives.read_base_members(tenant, namespace, after, BASE_PAGE_SIZE)
+    if status != 200:
+        return status, members
+    for member in members:
+        graph.add((baseURI, RDFS['member'], URIRef(member)))
+    graph.add((pageURI, RDF['type'], LDP['Page']))
+    graph.add((pageURI, LDP['pageOf'], baseURI))
+    if len(members) == BASE_PAGE_SIZE:
+        graph.add((pageURI, LDP['nextPage'], URIRef(baseURI + '?' + urllib.urlencode({'after': members[-1]}))))
+    else:
+        graph.add((pageURI, LDP['nextPage'], RDF['nil']))
+    return 200, RDF_JSON_Document(graph_to_rdfjson(graph), str(pageURI))
+
+# Get the latest entry of the ChangeLog stored in the collection 'tenant/namespace'.
+# return: (200, <the entry's identifier, or rdf:nil if the log is empty>) or (<status>, <error message>)
+def latestChangeEvent(tenant, namespace):
+    status, length = operation_primitives.change_log_length(tenant, namespace)
+    if status != 200 or length == 0:
+        return status, length if status != 200 else RDF['nil']
+    status, entries = operation_primitives.read_change_entries(tenant, namespace, length - 1)
+    if status != 200:
+        return status, entries
+    return 200, URIRef(entries[-1]['identifier']) if entries else RDF['nil']
+
+# stamp: the timestamp() of the entry, which can be shared by the entries added at the same time.
+def generateIdentifier(order, stamp=None):
+    return "urn:trs:" + (stamp or timestamp()) + ":" + str(order);
 
 def timestamp():
     return datetime.datetime.utcnow().isoformat()
@@ -137,7 +445,8 @@ def host_collection_and_document_names_from_url(url):
 
 def getGraph(graphURI):
     host_name, collection_name, document_id = host_collection_and_document_names_from_url(graphURI)
-    status, rdfjson = operation_primitives.get_document(PRIVILEGED_USER, host_name, collection_name, document_id)
+    tenant, namespace = collection_name.split('/', 1)
+    status, rdfjson = operation_primitives.get_document(PRIVILEGED_USER, host_name, tenant, namespace, document_id)
     if status == 200:
         graph = rdfjson_to_graph(rdfjson)
         return graph
@@ -147,41 +456,57 @@ def getGraph(graphURI):
 def storeGraph(graphURI, graph):
     rdfjson = graph_to_rdfjson(graph)
     host_name, collection_name, document_id = host_collection_and_document_names_from_url(graphURI)
+    tenant, namespace = collection_name.split('/', 1)
     document = RDF_JSON_Document(rdfjson, graphURI)
-    #TODO: This implementation relies on replace_document using upsert=true. Efficient, but result is missing created/creator properties.
-    operation_primitives.replace_document(PRIVILEGED_USER, document, host_name, collection_name, document_id)
+    # replace_document upserts the document with the 'tracking' write concern of the storage layer (w:1 by default)
+    operation_primitives.replace_document(PRIVILEGED_USER, document, host_name, tenant, namespace, document_id)
     
 def deleteGraph(graphURI):
     host_name, collection_name, document_id = host_collection_and_document_names_from_url(graphURI)
-    operation_primitives.delete_document(PRIVILEGED_USER, host_name, collection_name, document_id)
+    tenant, namespace = collection_name.split('/', 1)
+    operation_primitives.delete_document(PRIVILEGED_USER, host_name, tenant, namespace, document_id)
     
-class ChangeEntry:
-    def __init__(self, kind, changed, order, identifier):
-        self.kind = kind
-        self.changed = changed
-        self.order = order
-        self.identifier = identifier
+class ChangeEntry(object):
+    __slots__ = ('kind', 'changed', 'order', 'identifier', 'position') # no __dict__ per entry
+
+    def __init__(self, kind, changed, order, identifier, position=None):
+        self.kind = intern(str(kind)) # one of the few change types, shared by all entries
+        self.changed = str(changed)
+        self.order = int(order)
+        self.identifier = str(identifier)
+        self.position = position # in the stored log
     
 class TrackedResourceSetBuilder:
-    def __init__(self, public_hostname, collection_name, segmentSize=DEFAULT_SEGMENT_SIZE, computeBase=True):
+    def __init__(self, public_hostname, collection_name, segmentSize=DEFAULT_SEGMENT_SIZE, computeBase=False):
         self.publicHostname = public_hostname
         self.collectionName = collection_name
-        self.trackedResourceSetURIBase = 'http://%s/%s_tracking/' % (public_hostname, collection_name)
+        self.tenant, self.namespace = collection_name.split('/', 1)
+        self.trackingNamespace = self.namespace + TRACKING_SUFFIX
+        self.trackedResourceSetURIBase = 'http://%s/%s/%s/' % (public_hostname, self.tenant, self.trackingNamespace)
         self.trackedResourceSetURI = self.trackedResourceSetURIBase + TRS_DOCUMENT_ID
         self.changeLogURIBase = self.trackedResourceSetURIBase + CL_DOCUMENT_ID_PREFIX
+        self.currentBaseURI = None # until the base has been computed
+        self.computingBase = False
         self.segmentSize = segmentSize
         self.segmentNo = 1
-        self.currentChanges = []
+        self.truncatedSegmentNo = 0 # the latest segment that has been removed by truncation
+        self.length = 0 # the number of entries in the stored log, as far as this process knows
+        self.lock = threading.RLock() # serializes the changes of the threads that share this builder
+        self.checkedAt = time.time() # when the stored TRS was last known to exist (see isStale)
         
         trsGraph = getGraph(self.trackedResourceSetURI)
         if trsGraph is not None: # Already have an existing TrackedResourceSet/ChangeLog?
-            self.currentBaseURI = trsGraph.objects(URIRef(self.trackedResourceSetURI), TRS['base']).next()
-            changeLogURI = trsGraph.objects(URIRef(self.trackedResourceSetURI), TRS['changeLog']).next()
-            self.initCurrentChanges(trsGraph, changeLogURI)
-            if computeBase:
-                self.computeBase() # recompute the base resource
+            self.currentBaseURI = trsGraph.value(URIRef(self.trackedResourceSetURI), TRS['base'])
+            changeLogURI = trsGraph.value(URIRef(self.trackedResourceSetURI), TRS['changeLog'])
+            if changeLogURI is not None: # stored with its current segment by an earlier version of this module
+                self.convertCurrentChanges(self.initCurrentChanges(trsGraph, changeLogURI))
+            else:
+                self.loadChangeLogBounds()
+            if computeBase or self.currentBaseURI != URIRef(self.trackedResourceSetURIBase + BASE_DOCUMENT_ID):
+                self.computeBase() # recompute the base (or compute it from a base stored by an earlier version of this module)
         else:
-            self.computeBase() # create the initial base resource
+            self.loadChangeLogBounds()
+            self.computeBase() # create the initial base
 
     # Add a new change entry to the log. Entries are maintained in the order in which they're added.
     # changed: the URI of the resource that has changed.
@@ -189,28 +514,120 @@ class TrackedResourceSetBuilder:
     # order: the sequence number for the new entry or None for the builder to generate one.
     # return: the sequence number assigned to the new entry.
     def addChangeEntry(self, changed, kind, order=None):
+        with self.lock:
+            self.updateBase([changed], kind)
+            entries = self.appendChangeEntries([(changed, kind)], order)
+            if len(entries) == 0:
+                return None
+            self.storeChangeEntries(entries)
+            self.truncateChangeLog()
+            return entries[-1].order
+
+    # Add a new change entry of the same type for each of several resources, storing them in a single write.
+    # changed_list: the URIs of the resources that have changed.
+    # kind: the type of change (CREATION, MODIFICATION, or DELETION).
+    # return: the sequence number assigned to the last new entry.
+    def addChangeEntries(self, changed_list, kind):
+        return self.addChanges([(changed, kind) for changed in changed_list])
+
+    # Add a new change entry for each of several changes, in order, storing them in a single write.
+    # changes: a list of (changed, kind) pairs, where changed is the URI of a resource that has changed, and kind is the
+    #          type of its change (CREATION, MODIFICATION, or DELETION).
+    # return: the sequence number assigned to the last new entry.
+    def addChanges(self, changes):
+        with self.lock:
+            for kind, group in itertools.groupby(changes, lambda change: change[1]):
+                self.updateBase([changed for changed, _ in group], kind)
+            entries = self.appendChangeEntries(changes)
+            if len(entries) == 0:
+                return None
+            self.storeChangeEntries(entries)
+            self.truncateChangeLog()
+            return entries[-1].order
+
+    # Allocate positions in the stored log for the entries of 'changes' (see addChanges), and return the entries. The caller
+    # stores them (see storeChangeEntries).
+    # order: the sequence number of the first entry, or None to use the position of each entry plus one.
+    def appendChangeEntries(self, changes, order=None):
+        if len(changes) == 0:
+            return []
+        status, position = operation_primitives.allocate_change_positions(self.tenant, self.trackingNamespace, len(changes))
+        if status != 200:
+            logger.warn("could not allocate change log positions of {0}: {1} {2}".format(self.trackedResourceSetURI, status, position))
+            return []
+        stamp = timestamp()
+        entries = []
+        for index, (changed, kind) in enumerate(changes):
+            entries.append(self.appendChangeEntry(changed, kind, position + index, order + index if order is not None else None, stamp))
+        return entries
+
+    # Make the entry for an allocated position, and account for it in the length of the log.
+    def appendChangeEntry(self, changed, kind, position, order=None, stamp=None):
         if order is None:
-            if len(self.currentChanges) != 0:
-                order = self.currentChanges[len(self.currentChanges)-1].order + 1
-            else:
-                order = 1
-        identifier = generateIdentifier(order)
-        entry = ChangeEntry(kind, changed, order, identifier)
-        self.currentChanges.append(entry)
-        if len(self.currentChanges) == 2 * self.segmentSize: # Time to split into 2 segments?
-            self.storeSegment()
-            self.currentChanges = self.currentChanges[self.segmentSize:]
-            self.segmentNo += 1
-        self.storeSegment()
-        return order
-
-    # Get the latest Change Event in the ChangeLog.
+            order = position + 1
+        identifier = generateIdentifier(order, stamp)
+        entry = ChangeEntry(kind, changed, order, identifier, position)
+        self.length = max(self.length, position + 1)
+        self.segmentNo = currentSegmentNumber(self.length, self.segmentSize)
+        return entry
+
+    # Add the resources of CREATION entries to the base, and remove those of DELETION entries from it. This is done before
+    # the entries are added to the log, so the base always reflects the changes up to the latest entry of the log.
+    def updateBase(self, changed_list, kind):
+        if str(kind) == str(TRS['Creation']):
+            status, msg = operation_primitives.add_base_members(self.tenant, self.trackingNamespace, [str(changed) for changed in changed_list], time.time())
+        elif str(kind) == str(TRS['Deletion']):
+            status, msg = operation_primitives.remove_base_members(self.tenant, self.trackingNamespace, [str(changed) for changed in changed_list])
+        else:
+            return
+        if status != 200:
+            logger.warn("could not update the base of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+
+    # Append entries to the stored log, in a single write.
+    def storeChangeEntries(self, entries):
+        storage_entries = [{'position': entry.position, 'kind': entry.kind, 'changed': entry.changed, 'order': entry.order,
+                            'identifier': entry.identifier} for entry in entries]
+        status, msg = operation_primitives.append_change_entries(self.tenant, self.trackingNamespace, storage_entries)
+        if status != 201:
+            logger.warn("could not store change entries of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+        else:
+            notifyChangeFeed(self.tenant, self.trackingNamespace)
+
+    # Remove the segments before the latest CHANGE_LOG_SEGMENTS segments, if that's configured.
+    def truncateChangeLog(self):
+        if CHANGE_LOG_SEGMENTS is None or self.segmentNo - CHANGE_LOG_SEGMENTS <= self.truncatedSegmentNo:
+            return
+        truncatedSegmentNo = self.segmentNo - CHANGE_LOG_SEGMENTS
+        status, msg = operation_primitives.truncate_change_log(self.tenant, self.trackingNamespace, truncatedSegmentNo * self.segmentSize)
+        if status != 200:
+            logger.warn("could not truncate the change log of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+            return
+        # the segments stored as whole documents by an earlier version of this module, if any, are removed in a single write
+        status, msg = operation_primitives.remove_numbered_documents(self.tenant, self.trackingNamespace, CL_DOCUMENT_ID_PREFIX, truncatedSegmentNo + 1)
+        if status != 200:
+            logger.warn("could not remove the old change log segments of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+        logger.info("truncated the change log of {0} before segment {1}".format(self.trackedResourceSetURI, truncatedSegmentNo + 1))
+        self.truncatedSegmentNo = truncatedSegmentNo
+
+    # Check whether the stored TRS has been removed since this builder stored or loaded it, e.g., because another process
+    # dropped the collection. This is checked at most every BUILDER_CHECK_SECONDS, and not while the base is being computed
+    # (the TRS of a new collection is only stored once its base is).
+    # return: True if the builder is stale, and a new one should be constructed from storage.
+    def isStale(self):
+        now = time.time()
+        if now < self.checkedAt + BUILDER_CHECK_SECONDS or self.computingBase or self.currentBaseURI is None:
+            return False
+        self.checkedAt = now
+        status, document = operation_primitives.get_document(PRIVILEGED_USER, self.publicHostname, self.tenant, self.trackingNamespace, TRS_DOCUMENT_ID)
+        return status == 404
+
+    # Get the latest Change Event in the stored ChangeLog, which may have been added by another process.
     # return: a Change Event URI or null, if the log is empty.
     def getLatestChangeEvent(self):
-        if len(self.currentChanges) != 0:
-            return self.currentChanges[len(self.currentChanges)-1].identifier
-        else:
-            return RDF['nil']
+        status, latest = latestChangeEvent(self.tenant, self.trackingNamespace)
+        if status != 200:
+            raise Exception("could not read the latest change event of {0}: {1} {2}".format(self.trackedResourceSetURI, status, latest))
+        return latest
     
     # Extract the segment number from a ChangeLogSegment URI.
     # segmentURI: the segment URI.
@@ -221,63 +638,118 @@ class TrackedResourceSetBuilder:
         else: 
             return int(segmentURI[len(self.changeLogURIBase)])
     
-    # Store/persist the current segment in a file.
-    def storeSegment(self):
-        # TODO Re-implement this method in a way that doesn't regenerate the whole segment every time.
+    # Store the TrackedResourceSet resource, which refers to the current base. Its ChangeLog is generated from the stored
+    # entries when it's read (see getTrackingDocument).
+    def storeTrackedResourceSet(self):
         graph = Graph()
-        nextSegment = generateSegment(self.currentChanges, True, self.changeLogURIBase, self.segmentNo, self.segmentNo - 1, self.segmentSize, graph)
-        if not isinstance(nextSegment, BNode):
-            storeGraph(nextSegment, graph)
-            return
-        
         trackedResourceSet = URIRef(self.trackedResourceSetURI)
-        graph.add((trackedResourceSet, TRS['changeLog'], nextSegment))
         graph.add((trackedResourceSet, TRS['base'], URIRef(self.currentBaseURI)))
         graph.add((trackedResourceSet, RDF['type'], TRS['TrackedResourceSet']))
 
         storeGraph(self.trackedResourceSetURI, graph);
+
+    # Read the length of the stored log, and the segment before which it has been truncated.
+    def loadChangeLogBounds(self):
+        status, self.length = operation_primitives.change_log_length(self.tenant, self.trackingNamespace)
+        self.segmentNo = currentSegmentNumber(self.length, self.segmentSize)
+        status, start = operation_primitives.change_log_start(self.tenant, self.trackingNamespace)
+        self.truncatedSegmentNo = min(start / self.segmentSize, self.segmentNo - 1)
+
+    # Store the entries of a current segment that was read from a TrackedResourceSet stored by an earlier version of this
+    # module (see initCurrentChanges), and store the TrackedResourceSet without them. Its older segments stay as they were stored.
+    # The entries keep the positions of their segment, which are claimed first, so the conversion is done by one process
+    # only, and later entries are allocated positions after them.
+    def convertCurrentChanges(self, changes):
+        start = (self.segmentNo - 1) * self.segmentSize
+        status, msg = operation_primitives.claim_change_positions(self.tenant, self.trackingNamespace, start, len(changes))
+        if status != 200: # converted by another process (or a log already continues from here)
+            logger.info("not converting the change log of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+            self.loadChangeLogBounds()
+            return
+        for index, entry in enumerate(changes):
+            entry.position = start + index
+        self.length = start + len(changes)
+        self.storeChangeEntries(changes)
+        self.storeTrackedResourceSet()
         
+    # Read the entries of the current segment of a TrackedResourceSet stored by an earlier version of this module.
+    # return: the entries, oldest first.
     def initCurrentChanges(self, changeLogGraph, changeLogURI):
+        # the list starts with the most recent entry
+        changes = []
         listEntry = changeLogGraph.objects(changeLogURI, TRS['changes']).next()
         while listEntry != RDF['nil']:
             change = changeLogGraph.objects(listEntry, RDF['first']).next()
             kind = changeLogGraph.objects(change, RDF['type']).next()
             resource = changeLogGraph.objects(change, TRS['changed']).next()
-            order = changeLogGraph.objects(change, TRS['order']).next()
+            order = int(changeLogGraph.objects(change, TRS['order']).next())
             identifier = change;
-            self.currentChanges.insert(0, ChangeEntry(kind, resource, order, identifier))
+            changes.append(ChangeEntry(kind, resource, order, identifier))
             listEntry = changeLogGraph.objects(listEntry, RDF['rest']).next()
+        changes.reverse()
         try: 
             nextSegmentURI = changeLogGraph.objects(changeLogURI, TRS['previous']).next()
             self.segmentNo = self.extractSegmentNumber(nextSegmentURI) + 1;
         except StopIteration: 
-            return
+            pass
+        return changes
         
+    # Start recomputing the members of the base in a background thread, unless that's already under way.
     def computeBase(self):
-        base_id = BASE_DOCUMENT_ID_PREFIX + operation_primitives.make_objectid()
-        baseURI = URIRef(self.trackedResourceSetURIBase + base_id)
-        graph = Graph()
-        
-        # get the cutoff event
-        cutoffEvent = self.getLatestChangeEvent()
-        graph.add((baseURI, TRS['cutoffEvent'], cutoffEvent))
-        
-        # compute the members
-        cursor = operation_primitives.MONGO_DB[self.collectionName].find(fields={ '_id': True })
-        while True:
-            try: document = cursor.next()
-            except StopIteration: break
-            document_id = document['_id']
-            member = url_policy.construct_url(self.publicHostname, None, self.collectionName, document_id)
-            graph.add((baseURI, RDFS['member'], URIRef(member)))
-
-        # store the new base
-        storeGraph(baseURI, graph);
-        
-        # set the new base reference and store the TRS
-        self.currentBaseURI = baseURI;
-        self.storeSegment()
+        with self.lock:
+            if self.computingBase:
+                return
+            self.computingBase = True
+        thread = threading.Thread(target=self.recomputeBase, name='trs-base %s' % self.collectionName)
+        thread.daemon = True
+        thread.start()
+
+    # Add every document of the collection to the base, and then remove the members that were neither added by this scan
+    # nor by a CREATION entry since it started. A document the scan read before it was deleted is added back by the scan,
+    # so the resources whose latest entry since the scan started (the entries after its cutoff event, by any process) is a
+    # DELETION are then removed again.
+    def recomputeBase(self):
+        try:
+            with self.lock:
+                stamp = time.time()
+                cutoffEvent = self.getLatestChangeEvent()
+                status, scanStart = operation_primitives.change_log_length(self.tenant, self.trackingNamespace)
+                if status != 200:
+                    raise Exception("could not read the change log length of {0}: {1} {2}".format(self.trackedResourceSetURI, status, scanStart))
+            cursor = operation_primitives.tenant_collection(self.tenant, self.namespace).find(fields={ '_id': True })
+            members = []
+            count = 0
+            for document in cursor:
+                members.append(url_policy.construct_url(self.publicHostname, self.tenant, self.namespace, document['_id']))
+                if len(members) == BASE_BATCH_SIZE:
+                    operation_primitives.add_base_members(self.tenant, self.trackingNamespace, members, stamp)
+                    count += len(members)
+                    members = []
+            operation_primitives.add_base_members(self.tenant, self.trackingNamespace, members, stamp)
+            count += len(members)
+            operation_primitives.remove_base_members(self.tenant, self.trackingNamespace, before=stamp)
+            self.removeDeletedMembers(scanStart)
+            self.currentBaseURI = URIRef(self.trackedResourceSetURIBase + BASE_DOCUMENT_ID)
+            self.storeTrackedResourceSet() # the TRS of a new collection can be read from now on
+            logger.info("computed base of {0} with {1} members, cutoff event {2}".format(self.trackedResourceSetURI, count, cutoffEvent))
+        except Exception:
+            logger.exception("could not compute the base of {0}".format(self.trackedResourceSetURI))
+        finally:
+            with self.lock:
+                self.computingBase = False
         
+    # Remove the resources whose latest entry from position 'start' on is a DELETION from the base.
+    def removeDeletedMembers(self, start):
+        status, entries = operation_primitives.read_change_entries(self.tenant, self.trackingNamespace, start)
+        if status != 200:
+            raise Exception("could not read the change entries of {0}: {1} {2}".format(self.trackedResourceSetURI, status, entries))
+        latestKinds = dict((entry['changed'], entry['kind']) for entry in entries) # entries are in log order
+        deleted = [changed for changed, kind in latestKinds.iteritems() if kind == str(TRS['Deletion'])]
+        if len(deleted) > 0:
+            status, msg = operation_primitives.remove_base_members(self.tenant, self.trackingNamespace, deleted)
+            if status != 200:
+                raise Exception("could not update the base of {0}: {1} {2}".format(self.trackedResourceSetURI, status, msg))
+
     #def is_system_document(self, document_id):
     #    return document_id == TRS_DOCUMENT_ID or \
     #           document_id.startswith(CL_DOCUMENT_ID_PREFIX) or \
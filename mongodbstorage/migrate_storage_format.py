@@ -0,0 +1,72 @@
+# This module converts existing collections between storage format 1 and storage format 2 (see storage_mapping.py).
+# It is run as a script, with the same environment variables as the application (MONGODB_DB_HOST, MONGODB_DB_PORT, APP_NAME, ...):
+#
+#   python migrate_storage_format.py 2                    # convert all tenant collections to format 2
+#   python migrate_storage_format.py 2 tenant/namespace   # convert only the named collections
+#   python migrate_storage_format.py 1                    # convert back to format 1
+#
+# Documents are converted one at a time with an update that is conditional on the document's _modificationCount, so
+# concurrent patches are not lost (a document patched during its conversion is retried). Application servers cache the
+# format of each collection, so they should be restarted after a collection has been converted.
+#
+import sys
+import logging
+import operation_primitives
+from storage_mapping import storage_format, storage_subject_node_to_format, STORAGE_FORMAT_V1, STORAGE_FORMAT_V2
+
+logger=logging.getLogger(__name__)
+
+MAX_RETRIES = 5
+
+def tenant_collection_names():
+    collection_names = set()
+    for cluster in operation_primitives.cluster_names():
+        collection_names.update(collection_name for collection_name in operation_primitives.cluster_database(cluster).collection_names()
+                                if len(collection_name.split('/')) > 1 and not collection_name.endswith(('.files', '.chunks')) # skip attachments (GridFS)
+                                and not collection_name.endswith((operation_primitives.CHANGES_SUFFIX, operation_primitives.BASE_SUFFIX))) # and TRS change logs and bases
+    return sorted(collection_names)
+
+def convert_document(collection, storage_json, to_format):
+    from_dictionary = operation_primitives.PREDICATE_DICTIONARY if storage_format(storage_json) == STORAGE_FORMAT_V2 else None
+    to_dictionary = operation_primitives.PREDICATE_DICTIONARY if to_format == STORAGE_FORMAT_V2 else None
+    subject_array = [storage_subject_node_to_format(storage_subject_node, from_dictionary, to_dictionary) for storage_subject_node in storage_json.get('@graph', [])]
+    criteria = {'_id': storage_json['_id'], '_modificationCount': storage_json.get('_modificationCount')}
+    if to_format == STORAGE_FORMAT_V2:
+        patch = {'$set': {'@graph': subject_array, '_format': STORAGE_FORMAT_V2}}
+    else:
+        patch = {'$set': {'@graph': subject_array}, '$unset': {'_format': 1}}
+    last_err = collection.update(criteria, patch)
+    return last_err['n'] == 1
+
+def convert_collection(collection_name, to_format):
+    tenant, namespace = collection_name.split('/', 1)
+    collection = operation_primitives.tenant_collection(tenant, namespace)
+    converted = 0
+    for storage_json in collection.find({'_format': {'$ne': to_format}} if to_format == STORAGE_FORMAT_V2 else {'_format': {'$exists': True}}):
+        for _ in range(MAX_RETRIES):
+            if convert_document(collection, storage_json, to_format):
+                converted += 1
+                break
+            storage_json = collection.find_one({'_id': storage_json['_id']}) # modified (or deleted) while we were converting it
+            if storage_json is None or storage_format(storage_json) == to_format:
+                break
+        else:
+            logger.warn('could not convert document {0} in {1}'.format(storage_json['_id'], collection_name))
+    operation_primitives.collection_formats.pop(collection_name, None)
+    logger.info('converted {0} documents in {1} to storage format {2}'.format(converted, collection_name, to_format))
+    return converted
+
+def migrate(to_format, collection_names=None):
+    if to_format not in (STORAGE_FORMAT_V1, STORAGE_FORMAT_V2):
+        raise ValueError('unknown storage format %s' % to_format)
+    if not collection_names:
+        collection_names = tenant_collection_names()
+    for collection_name in collection_names:
+        convert_collection(collection_name, to_format)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        print 'usage: python migrate_storage_format.py <1|2> [tenant/namespace ...]'
+        sys.exit(1)
+    migrate(int(sys.argv[1]), sys.argv[2:])
@@ -1,23 +1,47 @@
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import ConnectionFailure
+from pymongo.errors import ExecutionTimeout
 from datetime import datetime
 from dateutil import tz
 from storage_mapping import rdf_json_from_storage
+from storage_mapping import lazy_rdf_json_from_storage
 from storage_mapping import query_to_storage
 from storage_mapping import storage_value_from_rdf_json
 from storage_mapping import predicate_to_mongo
 from storage_mapping import fix_up_url_for_storage
+from storage_mapping import STORAGE_FORMAT_V1, STORAGE_FORMAT_V2
+from storage_mapping import storage_format
+from storage_mapping import storage_labels, storage_access_control, LABEL, OWNER, RESOURCE_GROUP
+from storage_mapping import storage_memberships
+from rdf_json import URI
+from bson import json_util
+from gridfs import GridFS
+from gridfs.errors import NoFile
+from predicate_dictionary import Predicate_Dictionary
 from base_constants import URL_POLICY as url_policy
 import os
+import json
 import threading
 import logging
 import time
+import re
+import functools
+import itertools
+
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+    RAW_BSON_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument, tz_aware=True)
+except ImportError: # older pymongo - lazy reads will convert already decoded documents on demand
+    RAW_BSON_CODEC_OPTIONS = None
 
 """MongoDB-based implementation of Operation Primitives
 
 Expects OS environment variables MONGODB_DB_HOST, MONGODB_DB_PORT
-Optional OS environment variables MONGODB_DB_NAME, APP_NAME, MONGODB_DB_USERNAME, MONGODB_DB_PASSWORD
+Optional OS environment variables MONGODB_DB_NAME, APP_NAME, MONGODB_DB_USERNAME, MONGODB_DB_PASSWORD, MONGODB_STORAGE_FORMAT,
+MONGODB_CLUSTERS, MONGODB_PLACEMENT_CACHE_SECONDS, MONGODB_MEMBERSHIP_INDEX,
+MONGODB_MAX_TIME_MS, MONGODB_WRITE_CONCERNS, MONGODB_ATTACHMENT_CHUNK_SIZE, MONGODB_MAX_QUERY_RESULTS
 
 @see: lda-serverlib/logiclibrary/storage.py for an example of how to load operation_primitives indirectly
 """
@@ -45,6 +69,193 @@ MONGO_DB = MONGO_CLIENT[MONGODB_DB_NAME]
 if 'MONGODB_DB_USERNAME' in os.environ:
     MONGO_DB.authenticate(os.environ['MONGODB_DB_USERNAME'], os.environ['MONGODB_DB_PASSWORD'])
 
+# Storage format used for new collections (1 or 2, see storage_mapping.py). Existing collections keep the format of their
+# documents - use migrate_storage_format.py to convert them.
+STORAGE_FORMAT = int(os.environ.get('MONGODB_STORAGE_FORMAT', STORAGE_FORMAT_V1))
+PREDICATE_DICTIONARY = Predicate_Dictionary(MONGO_DB)
+collection_formats = {}
+
+# Tenant placement. MONGODB_CLUSTERS optionally configures additional clusters as a JSON object, e.g.:
+#
+#   {"big": {"host": "mongo2.example.com", "port": 27017, "db": "lda", "username": "...", "password": "..."}}
+#
+# A tenant's collections are in the cluster named by its document in the placements_collection of the default database
+# ({'_id': tenant, 'cluster': name}), or in MONGO_DB if it has none. Placements are cached for MONGODB_PLACEMENT_CACHE_SECONDS.
+# The lineages and predicate dictionary collections are global, and always in MONGO_DB.
+DEFAULT_CLUSTER = 'default'
+MONGODB_CLUSTERS = json.loads(os.environ.get('MONGODB_CLUSTERS', '{}'))
+PLACEMENT_CACHE_SECONDS = int(os.environ.get('MONGODB_PLACEMENT_CACHE_SECONDS', 60))
+cluster_databases = {DEFAULT_CLUSTER: MONGO_DB}
+tenant_placements = {} # tenant -> (database, expiry time)
+placement_lock = threading.Lock()
+
+# Index fields. Each document has top-level fields derived from its subjects, which are maintained by create_document and
+# patch_document and indexed (see index_fields):
+#
+#   '_labels': the plain string rdfs:label values of its subjects (see storage_mapping.storage_labels), so that
+#              find_documents_by_label is a point lookup
+#   '_owner', '_resourceGroup': the ce:owner and ac:resource-group URLs of its subjects, so that '$access' query clauses
+#              (see storage_mapping.access_query_to_storage) are evaluated on indexes
+#
+# Use rebuild_indexes.py to set the fields of documents created before they existed. Until then, lookups in a collection
+# with such documents fall back to the equivalent queries on their subjects (see index_field_complete).
+INDEX_FIELD_PREDICATES = frozenset((LABEL, OWNER, RESOURCE_GROUP))
+MAX_INDEX_RETRIES = 5
+index_field_states = {} # (collection name, field) -> True once every document has the field, False if some don't
+
+# Membership index. MONGODB_MEMBERSHIP_INDEX optionally configures membership predicates as a JSON object that maps each
+# predicate to a sort predicate (or null), e.g.:
+#
+#   {"http://example.org/ns#memberOf": "http://purl.org/dc/terms/title"}
+#
+# For each document with a subject that has a membership predicate, the collection 'tenant/namespace_members' has a row
+#
+#   {'predicate': <membership predicate>, 'container': <storage url of the value>, 'document': docId, 'sort': <storage value of
+#    the sort predicate of the subject>, 'revision': <_modificationCount of the document when the row was written>}
+#
+# The rows are maintained by create_document, patch_document and delete_document, so find_members and count_members
+# are index range scans instead of '_any' queries. Use rebuild_indexes.py after adding a predicate.
+MEMBERSHIP_INDEX = json.loads(os.environ.get('MONGODB_MEMBERSHIP_INDEX', '{}'))
+MEMBERS_SUFFIX = '_members'
+MEMBERS_BATCH_SIZE = 100
+
+# Saved views. A view is a named query (with optional query modifiers) and projection on a collection, registered in the
+# views_collection of the tenant's database:
+#
+#   {'collection': 'tenant/namespace', 'name': name, 'query': <storage query>, 'modifiers': {...}, 'projection': {...}}
+#
+# (the query, modifiers and projection are stored as extended JSON strings, since storage queries have '$' keys). The
+# (projected) storage documents that match the query are materialized in the collection 'tenant/namespace_view_<name>',
+# which create_document, patch_document and delete_document keep up to date, so read_view is a scan of that collection.
+# The views of a collection are read (with an indexed query) on each write, rather than cached, so a view registered by
+# another process can't miss writes made after it has been materialized.
+VIEW_INFIX = '_view_'
+VIEW_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Attachments. The binary attachments of the documents of a collection are stored in the GridFS bucket
+# 'tenant/namespace_attachments' of the tenant's database, with the ID of their document in the 'document' field of their
+# file documents. Uploads are copied into GridFS in chunks of MONGODB_ATTACHMENT_CHUNK_SIZE bytes and get_attachment returns
+# a file-like object that reads one chunk at a time, so attachments are never held in memory. The attachments of a
+# document are removed with it.
+ATTACHMENTS_SUFFIX = '_attachments'
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get('MONGODB_ATTACHMENT_CHUNK_SIZE', 255 * 1024))
+
+# Change logs. The entries of the change log of a Tracked Resource Set (see trsbuilder) that's stored in the collection
+# 'tenant/namespace' are stored in the collection 'tenant/namespace_change_log', one storage document per entry, with the
+# entry's position in the log as its _id:
+#
+#   {'_id': position, 'kind': <change type URI>, 'changed': <resource URI>, 'order': <sequence number>, 'identifier': <URI>}
+#
+# so adding an entry is a single insert, and a segment of the log is a range scan. Positions are allocated by
+# allocate_change_positions from a counter document in the same collection ({'_id': '@counter', 'next': <position>}),
+# so the processes that share a change log never take the same position, and an insert never overwrites an entry.
+# truncate_change_log removes the entries before a position, and records that position in the counter document ('start').
+# A change log that is fed from the oplog (see read_document_changes) also records the oplog position up to which the changes
+# of the tracked collection have been logged ({'_id': '@source', 'position': <oplog timestamp>}).
+CHANGES_SUFFIX = '_change_log'
+CHANGES_COUNTER_ID = '@counter' # entry _ids are numbers
+CHANGES_SOURCE_ID = '@source'
+
+# Document changes. read_document_changes tails the oplog of the replica set that stores a collection (a single-node replica
+# set will do), and returns its inserts, deletes and revisions (updates that increment _modificationCount - updates of index
+# fields only are derived data, and aren't changes) of the collection's documents, and its drop. With MongoDB running
+# as a standalone server, there is no oplog to tail.
+OPLOG_COLLECTION = 'oplog.rs'
+OPLOG_REPLAY = 8 # query flag that lets MongoDB find the starting point of an oplog query without a collection scan
+OPLOG_IDLE_SECONDS = 1
+
+# Tracked Resource Set bases. The members of the base of a TRS that's stored in the collection 'tenant/namespace' are
+# stored in the collection 'tenant/namespace_base_members', one storage document per member:
+#
+#   {'_id': <member URI>, 'stamp': <time.time() of the member's last addition>}
+#
+# so the base is maintained member by member as resources are created and deleted, and is read in pages in member URI order.
+BASE_SUFFIX = '_base_members'
+
+# Time limits. MONGODB_MAX_TIME_MS optionally sets the server-side time limit (maxTimeMS) of the queries of the read
+# primitives as a JSON object that maps primitive names (or 'default') to milliseconds, e.g.:
+#
+#   {"default": 30000, "execute_query": 5000, "get_document": 1000}
+#
+# The logic tier can also set a deadline for the request being processed by the current thread (set_request_deadline), in
+# which case the queries are limited to the time left until the deadline as well. A time limited primitive (see time_limited)
+# returns 503 if the deadline has passed before a query is started, and 504 if MongoDB stops a query that exceeds its limit.
+# Writes are not time limited, since MongoDB can't stop them cleanly.
+MAX_TIME_MS = json.loads(os.environ.get('MONGODB_MAX_TIME_MS', '{}'))
+
+# Query results. A query returns at most MONGODB_MAX_QUERY_RESULTS documents, whatever its $limit (a $limit of 0 is no
+# limit, as in MongoDB); clients page through larger results with $skip.
+MAX_QUERY_RESULTS = int(os.environ.get('MONGODB_MAX_QUERY_RESULTS', 100))
+
+# Write concerns. Each write is made with the write concern (pymongo's w, j and wtimeout options) of the kind of data it writes:
+#
+#   'document': the documents of a collection (create_document, patch_document, delete_document, delete_documents) and
+#               view definitions
+#   'history':  history documents (create_history_document)
+#   'derived':  data that is recomputed from the documents - index fields, membership index rows and view rows
+#   'tracking': Tracked Resource Set, change log and base documents (replace_document)
+#
+# MONGODB_WRITE_CONCERNS optionally overrides the policy for a deployment as a JSON object that maps kinds to options, e.g.:
+#
+#   {"document": {"w": "majority", "j": true, "wtimeout": 5000}, "history": {"w": "majority"}}
+#
+# An empty entry uses the client's default write concern. Writes are always acknowledged ("w": 0 isn't supported), since
+# the update counts of conditional writes are checked.
+DEFAULT_WRITE_CONCERNS = {'document': {}, 'history': {}, 'derived': {'w': 1, 'j': False}, 'tracking': {'w': 1, 'j': False}}
+WRITE_CONCERNS = dict(DEFAULT_WRITE_CONCERNS, **json.loads(os.environ.get('MONGODB_WRITE_CONCERNS', '{}')))
+request_context = threading.local()
+
+class Deadline_Exceeded(Exception):
+    pass
+
+def set_request_deadline(deadline):
+    """
+    Set the deadline (a time.time() value, or None for no deadline) of the request being processed by the current thread.
+    """
+    request_context.deadline = deadline
+
+def time_limit_ms():
+    # the maxTimeMS for a query of the current time limited primitive, or None if it has no limit
+    primitive = getattr(request_context, 'primitive', None)
+    if primitive is None:
+        return None
+    limit = MAX_TIME_MS.get(primitive, MAX_TIME_MS.get('default'))
+    deadline = getattr(request_context, 'deadline', None)
+    if deadline is not None:
+        remaining = int((deadline - time.time()) * 1000)
+        if remaining <= 0:
+            raise Deadline_Exceeded()
+        limit = remaining if limit is None else min(limit, remaining)
+    return limit
+
+def limit_time(cursor):
+    limit = time_limit_ms()
+    return cursor if limit is None else cursor.max_time_ms(limit)
+
+def time_limited(primitive):
+    # Decorator for read primitives that return (status, result). Queries made while the primitive is running (including by
+    # primitives it calls) are limited by its time limit - see MAX_TIME_MS.
+    @functools.wraps(primitive)
+    def limited_primitive(*args, **kwargs):
+        outer_primitive = getattr(request_context, 'primitive', None)
+        if outer_primitive is None:
+            request_context.primitive = primitive.__name__
+        try:
+            return primitive(*args, **kwargs)
+        except Deadline_Exceeded:
+            logger.warn("{0}: request deadline exceeded".format(primitive.__name__))
+            return 503, 'request deadline exceeded'
+        except ExecutionTimeout, e:
+            logger.warn("{0}: query exceeded its time limit: {1}".format(primitive.__name__, e))
+            return 504, 'query exceeded its time limit'
+        finally:
+            request_context.primitive = outer_primitive
+    return limited_primitive
+
+def write_concern(kind):
+    # the keyword arguments of a pymongo write of 'kind' of data (see WRITE_CONCERNS)
+    return WRITE_CONCERNS[kind]
+
 next_id = 1
 next_history_id = 1
 lineage = None
@@ -125,68 +336,128 @@ def create_document(user, document, public_hostname, tenant, namespace, resource
     elif resource_id[-1] == '/':
         resource_id = resource_id + make_objectid()
     document_url = url_policy.construct_url(public_hostname, tenant, namespace, resource_id)
-    subject_array = make_subject_array(document, public_hostname, document_url)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    subject_array = make_subject_array(document, public_hostname, document_url, predicate_dictionary)
     if subject_array is None:
         logger.warn("create_document could not set system property")
         return 400, None, 'cannot set system property'
     timestamp = get_timestamp()
     json_ld = {'_id' : resource_id, '@graph': subject_array, '@id' : fix_up_url_for_storage('', public_hostname, document_url)}
     json_ld['_modificationCount'] =  0
+    if predicate_dictionary is not None:
+        json_ld['_format'] = STORAGE_FORMAT_V2
     json_ld['_created'] = json_ld['_lastModified'] = timestamp
     json_ld['_createdBy'] = json_ld['_lastModifiedBy'] = fix_up_url_for_storage(user, public_hostname, document_url)
+    json_ld.update(index_fields(subject_array, predicate_dictionary))
     
     try:
-        MONGO_DB[make_collection_name(tenant, namespace)].insert(json_ld)
+        tenant_collection(tenant, namespace).insert(json_ld, **write_concern('document'))
     except DuplicateKeyError:
         logger.warn("create_document: duplicate document id {0}".format(resource_id))
         return 409, None, 'duplicate document id: %s' % resource_id
+    insert_document_memberships(tenant, namespace, resource_id, subject_array, predicate_dictionary)
+    update_views(tenant, namespace, resource_id, view_row)
     
     logger.info("created document {0}".format(document_url))
-    return 201, document_url, rdf_json_from_storage(json_ld, public_hostname) # status_code, headers, body (which could contain error info)
+    return 201, document_url, rdf_json_from_storage(json_ld, public_hostname, predicate_dictionary) # status_code, headers, body (which could contain error info)
+
+def replace_document(user, document, public_hostname, tenant, namespace, document_id):
+    """
+    Replace the content of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with
+    'document' (rdf_json), creating the document if it doesn't exist.
+
+    Unlike patch_document, there is no revision check and no history document, so this is meant for documents that are
+    generated rather than edited, like the Tracked Resource Set documents of trsbuilder, and it's written with the
+    'tracking' write concern (see WRITE_CONCERNS). The index fields, membership index and views are not maintained.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, document_id)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    subject_array = make_subject_array(document, public_hostname, document_url, predicate_dictionary)
+    if subject_array is None:
+        logger.warn("replace_document could not set system property")
+        return 400, 'cannot set system property'
+    timestamp = get_timestamp()
+    storage_user = fix_up_url_for_storage(user, public_hostname, document_url)
+    sets = {'@graph': subject_array, '@id': fix_up_url_for_storage('', public_hostname, document_url), '_lastModified': timestamp, '_lastModifiedBy': storage_user}
+    if predicate_dictionary is not None:
+        sets['_format'] = STORAGE_FORMAT_V2
+    patch = {'$set': sets, '$inc': {'_modificationCount': 1}, '$setOnInsert': {'_created': timestamp, '_createdBy': storage_user}}
+    tenant_collection(tenant, namespace).update({'_id': document_id}, patch, upsert=True, **write_concern('tracking'))
+    logger.debug("replaced document {0}".format(document_url))
+    return 200, None
 
-def execute_query(user, query, public_hostname, tenant, namespace, projection=None):
+@time_limited
+def execute_query(user, query, public_hostname, tenant, namespace, projection=None, lazy=False):
     """
     Execute the specified 'query' against the collection identified by 'public_hostname', 'tenant',
     and 'namespace'.
 
     This fuction always succeeds and returns a list of 0 or more matching documents.
 
+    If 'lazy' is True, the documents are read as raw BSON (when supported by pymongo) and each subject of
+    the result documents is only converted to rdf_json when it's accessed (see storage_mapping.Lazy_Storage_Graph).
+
+    Range and inequality operators ($gt, $gte, $lt, $lte, $ne, $nin) and the $orderby (one or more keys), $skip
+    and $limit query modifiers are evaluated by MongoDB (see storage_mapping.query_to_storage). At most MAX_QUERY_RESULTS
+    documents are returned.
+
     Return:
         Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
-        Error: no errors
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit (see MAX_TIME_MS)
     """
     collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
-    query = query_to_storage(query, public_hostname, collection_url)
+    query = resolve_access_clause(tenant, namespace, query)
+    query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
     logger.debug('execute_query: MongoDB query %s', query)
-    if projection is None:
-        cursor = MONGO_DB[make_collection_name(tenant, namespace)].find(query)
-    else:
-        # Note: projection must NOT suppress the @id field (@id is needed by the storage format conversion routine)
-        cursor = MONGO_DB[make_collection_name(tenant, namespace)].find(query, projection)
-    result = get_query_result(cursor, public_hostname)
+    # Note: projection must NOT suppress the @id field (@id is needed by the storage format conversion routine)
+    cursor = find_query(read_collection(tenant, namespace, lazy), query, projection)
+    result = get_query_result(cursor, public_hostname, lazy, query.get('$limit'))
     #logger.debug('execute_query: MongoDB result %s', result)
     logger.debug("executed query {0}".format(query))
     return 200, result
 
-def get_document(user, public_hostname, tenant, namespace, documentId):
+@time_limited
+def get_document(user, public_hostname, tenant, namespace, documentId, lazy=False):
     """
     Get the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
 
+    If 'lazy' is True, the returned document converts its subjects to rdf_json on demand (see execute_query).
+
     Return:
         Success: (200, <result-document:rdf_json>)
         Error: (<status-code:int>, <errror-msg:string>)
     """
-    cursor = MONGO_DB[make_collection_name(tenant, namespace)].find({'_id': documentId})
+    cursor = limit_time(read_collection(tenant, namespace, lazy).find({'_id': documentId}))
     try: document = cursor.next()
     except StopIteration: document = None
     if document is not None:
-        document = rdf_json_from_storage(document, public_hostname)
+        document = lazy_rdf_json_from_storage(document, public_hostname, PREDICATE_DICTIONARY) if lazy else rdf_json_from_storage(document, public_hostname, PREDICATE_DICTIONARY)
         logger.debug("retrieved document {0}".format(documentId))
         return 200, document
     else:
         logger.warn("could not fetch {0} in namespace {1} for tenant {2}".format(documentId, namespace, tenant))
         return 404, '404 not found'
 
+@time_limited
+def get_documents(user, public_hostname, tenant, namespace, document_ids, lazy=False):
+    """
+    Get the documents with the IDs 'document_ids' in the collection identified by 'public_hostname', 'tenant', and 'namespace',
+    with one query. IDs of documents that don't exist are ignored, and the documents are not in any particular order.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit (see MAX_TIME_MS)
+    """
+    document_ids = list(document_ids)
+    cursor = limit_time(read_collection(tenant, namespace, lazy).find({'_id': {'$in': document_ids}}))
+    result = get_query_result(cursor, public_hostname, lazy, len(document_ids))
+    logger.debug("retrieved {0} of {1} documents in namespace {2} for tenant {3}".format(len(result), len(document_ids), namespace, tenant))
+    return 200, result
+
 def delete_document(user, public_hostname, tenant, namespace, document_id):
     """
     Delete the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
@@ -197,7 +468,11 @@ def delete_document(user, public_hostname, tenant, namespace, document_id):
         Success: (200, None)
         Error: no errors
     """
-    MONGO_DB[make_collection_name(tenant, namespace)].remove(document_id, True)
+    tenant_collection(tenant, namespace).remove(document_id, True, **write_concern('document'))
+    if MEMBERSHIP_INDEX:
+        members_collection(tenant, namespace).remove({'document': document_id}, **write_concern('derived'))
+    remove_view_rows(tenant, namespace, [document_id])
+    remove_attachments(tenant, namespace, [document_id])
     #TODO: check how many things Mongo actually deleted...
     
     logger.info("deleted document {0}".format(document_id))
@@ -205,23 +480,54 @@ def delete_document(user, public_hostname, tenant, namespace, document_id):
     
     return 200, None
 
+DELETE_BATCH_SIZE = 1000
+
+@time_limited
+def delete_documents(user, query, public_hostname, tenant, namespace):
+    """
+    Delete all the documents that match 'query' (see execute_query) in the collection identified by 'public_hostname',
+    'tenant', and 'namespace'.
+
+    The IDs of the matching documents are read first, and the documents are then removed in batches of DELETE_BATCH_SIZE,
+    so the returned IDs can be used to record change events for exactly the documents that were deleted. The last version
+    of each document is kept as a history document (see create_history_documents) before its batch is removed.
+
+    Return:
+        Success: (200, [<deleted-document-id:string>, ...])
+        Error: (503 or 504, <errror-msg:string>) if reading the matching IDs exceeds its time limit (nothing is deleted)
+    """
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    query = resolve_access_clause(tenant, namespace, query)
+    query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    collection = tenant_collection(tenant, namespace)
+    document_ids = [document['_id'] for document in find_query(collection, query, {'_id': True})]
+    for index in range(0, len(document_ids), DELETE_BATCH_SIZE):
+        create_history_documents(public_hostname, tenant, namespace, document_ids[index:index+DELETE_BATCH_SIZE])
+        collection.remove({'_id': {'$in': document_ids[index:index+DELETE_BATCH_SIZE]}}, **write_concern('document'))
+        if MEMBERSHIP_INDEX:
+            members_collection(tenant, namespace).remove({'document': {'$in': document_ids[index:index+DELETE_BATCH_SIZE]}}, **write_concern('derived'))
+        remove_view_rows(tenant, namespace, document_ids[index:index+DELETE_BATCH_SIZE])
+        remove_attachments(tenant, namespace, document_ids[index:index+DELETE_BATCH_SIZE])
+    logger.info("deleted {0} documents in namespace {1} for tenant {2}".format(len(document_ids), namespace, tenant))
+    return 200, document_ids
+
 def drop_collection(user, public_hostname, tenant, namespace):
     logger.info("dropped collection {0} for tenant {1}".format(namespace, tenant))
-    MONGO_DB[make_collection_name(tenant, namespace)].drop()
+    tenant_collection(tenant, namespace).drop()
+    tenant_collection(tenant, namespace + MEMBERS_SUFFIX).drop()
+    drop_views(tenant, namespace)
+    drop_attachments(tenant, namespace)
+    tenant_collection(tenant, namespace + CHANGES_SUFFIX).drop()
+    tenant_collection(tenant, namespace + BASE_SUFFIX).drop()
+    collection_formats.pop(make_collection_name(tenant, namespace), None)
 
 def create_history_document(user, public_hostname, tenant, namespace, document_id):
-    cursor = MONGO_DB[make_collection_name(tenant, namespace)].find({'_id': document_id})
+    cursor = tenant_collection(tenant, namespace).find({'_id': document_id})
     try: storage_json = cursor.next()
     except StopIteration: storage_json = None
     if storage_json is not None:
-        storage_json['_versionOfId'] = storage_json['_id']
-        storage_json['_versionOf'] = storage_json['@id']
-        history_objectId = make_historyid()
-        storage_json['_id'] = history_objectId
-        history_collection_name = make_collection_name(tenant, namespace + '_history')
-        history_document_url = url_policy.construct_url(public_hostname, tenant, namespace + '_history', history_objectId)
-        storage_json['@id'] = fix_up_url_for_storage('', public_hostname, history_document_url)
-        MONGO_DB[history_collection_name].insert(storage_json)
+        history_document_url = make_history_document(storage_json, public_hostname, tenant, namespace)
+        tenant_collection(tenant, namespace + '_history').insert(storage_json, **write_concern('history'))
         
         logger.info("created history document {0}".format(history_document_url))
         
@@ -230,16 +536,37 @@ def create_history_document(user, public_hostname, tenant, namespace, document_i
         logger.warn("create_history_document failed for id {0}".format(document_id))
         return 404, None
 
+def create_history_documents(public_hostname, tenant, namespace, document_ids):
+    # Keep the current versions of the documents with 'document_ids' as history documents (e.g., before they are deleted),
+    # with a single read and a single insert.
+    history_documents = []
+    for storage_json in tenant_collection(tenant, namespace).find({'_id': {'$in': list(document_ids)}}):
+        make_history_document(storage_json, public_hostname, tenant, namespace)
+        history_documents.append(storage_json)
+    if history_documents:
+        tenant_collection(tenant, namespace + '_history').insert(history_documents, **write_concern('history'))
+
+def make_history_document(storage_json, public_hostname, tenant, namespace):
+    # turn a storage document into a history document of its current version, and return the URL of the history document
+    storage_json['_versionOfId'] = storage_json['_id']
+    storage_json['_versionOf'] = storage_json['@id']
+    history_objectId = make_historyid()
+    storage_json['_id'] = history_objectId
+    history_document_url = url_policy.construct_url(public_hostname, tenant, namespace + '_history', history_objectId)
+    storage_json['@id'] = fix_up_url_for_storage('', public_hostname, history_document_url)
+    return history_document_url
+
+@time_limited
 def get_prior_versions(user, public_hostname, tenant, namespace, history):
     query = {'@id': {'$in': [fix_up_url_for_storage(version, public_hostname, '/') for version in history]}}
-    cursor = MONGO_DB[make_collection_name(tenant, namespace + '_history')].find(query)
+    cursor = limit_time(tenant_collection(tenant, namespace + '_history').find(query))
     result = get_query_result(cursor, public_hostname)
     #logger.debug(result)
     logger.debug("retrieved prior version with query {0}".format(query))
     
     return 200, result
 
-def patch_document(user, revision, new_values, public_hostname, tenant, namespace, document_id):
+def patch_document(user, revision, new_values, public_hostname, tenant, namespace, document_id, merge=False):
     """
     Patch the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with the
     content in 'document'.
@@ -262,6 +589,10 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
     history document whose ID is referenced in the successful patch operation will ever be looked at, so the
     other is just wasting a little disk space.
 
+    If 'merge' is True and the document has been modified since the client's revision, the patch is applied to the
+    current revision instead, provided none of the subjects and predicates it changes have been changed since the
+    client's revision (see merge_revision). Only overlapping changes result in a 409 (Conflict).
+
     Return:
         Success: (200, None)
         Error: (<status-code:int>, <errror-msg:string>)
@@ -272,6 +603,11 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
         logger.warn("patch_document revision must be an integer: {0}".format(revision))
         return 400, 'revision must be an integer: %s' % revision
 
+    if merge and mod_count != -1:
+        status, mod_count = merge_revision(new_values, public_hostname, tenant, namespace, document_id, mod_count, tenant_collection(tenant, namespace).find_one({'_id': document_id}))
+        if status != 200:
+            return status, mod_count
+
     status, history_document_id = create_history_document(user, public_hostname, tenant, namespace, document_id)
     if status == 201:
         if mod_count == -1:
@@ -280,11 +616,12 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
             mod_count_criteria = True
         document_url = url_policy.construct_url(public_hostname, tenant, namespace, document_id)
         delete_subject_urls = [ fix_up_url_for_storage(x, public_hostname, document_url) for x in new_values.iterkeys() if new_values[x] is None]
-        collection_name = make_collection_name(tenant, namespace)
+        collection = tenant_collection(tenant, namespace)
+        predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
         if len(delete_subject_urls) != 0:
             criteria = {'_id' : document_id}
             patch = {'$inc' : {'_modificationCount' : 1}, '$pull': { '@graph': { '@id': { '$in': delete_subject_urls } } }, '$push': {'_history' : history_document_id} }
-            last_err = MONGO_DB[collection_name].update(criteria, patch)
+            last_err = collection.update(criteria, patch, **write_concern('document'))
             if last_err['n'] == 1:
                 mod_count = mod_count + 1
             else:
@@ -294,7 +631,7 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
             if subject_node is None: continue
             # first assume the subject is already in the @graph array, and construct a query that will modify it
             criteria = {subject_url : {}}
-            criteria = query_to_storage(criteria, public_hostname, document_url)
+            criteria = query_to_storage(criteria, public_hostname, document_url, predicate_dictionary)
             criteria['_id'] = document_id
             if mod_count_criteria:
                 criteria['_modificationCount'] = mod_count
@@ -306,20 +643,20 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
                     return 400, 'cannot set system property'
                 if isinstance(value_array, (list, tuple)):
                     if len(value_array) > 0:
-                        subject_sets['@graph.$.' + predicate_to_mongo(predicate)] = [storage_value_from_rdf_json(value, public_hostname, document_url) for value in value_array]
+                        subject_sets['@graph.$.' + predicate_to_mongo(predicate, predicate_dictionary)] = [storage_value_from_rdf_json(value, public_hostname, document_url, predicate_dictionary) for value in value_array]
                     else:
-                        subject_unsets['@graph.$.' + predicate_to_mongo(predicate)] = 1
+                        subject_unsets['@graph.$.' + predicate_to_mongo(predicate, predicate_dictionary)] = 1
                 elif value_array == None:
-                    subject_unsets['@graph.$.' + predicate_to_mongo(predicate)] = 1
+                    subject_unsets['@graph.$.' + predicate_to_mongo(predicate, predicate_dictionary)] = 1
                 else:
-                    subject_sets['@graph.$.' + predicate_to_mongo(predicate)] = storage_value_from_rdf_json(value_array, public_hostname, document_url)
+                    subject_sets['@graph.$.' + predicate_to_mongo(predicate, predicate_dictionary)] = storage_value_from_rdf_json(value_array, public_hostname, document_url, predicate_dictionary)
             patch = {'$inc' : {'_modificationCount' : 1}, '$set' : subject_sets, '$push': {'_history' : history_document_id}}
 
             # mongo has breaking change with version 2.5.x and does not allow $unset to be empty. Check subject_unsets before inserting into patch
             if len(subject_unsets):
                 patch['$unset'] = subject_unsets
 
-            last_err = MONGO_DB[collection_name].update(criteria, patch)
+            last_err = collection.update(criteria, patch, **write_concern('document'))
             if last_err['n'] == 1:
                 mod_count = mod_count + 1
             else:
@@ -335,16 +672,21 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
                         return 400, 'cannot set system property'
                     if isinstance(value_array, (list, tuple)):
                         if len(value_array) > 0:
-                            new_subject[predicate_to_mongo(predicate)] = [storage_value_from_rdf_json(value, public_hostname, document_url) for value in value_array]
+                            new_subject[predicate_to_mongo(predicate, predicate_dictionary)] = [storage_value_from_rdf_json(value, public_hostname, document_url, predicate_dictionary) for value in value_array]
                     else:
-                        new_subject[predicate_to_mongo(predicate)] = storage_value_from_rdf_json(value_array, public_hostname, document_url)
+                        new_subject[predicate_to_mongo(predicate, predicate_dictionary)] = storage_value_from_rdf_json(value_array, public_hostname, document_url, predicate_dictionary)
                 patch = {'$inc' : {'_modificationCount' : 1}, '$set' : subject_sets, '$push': {'_history' : history_document_id, '@graph': new_subject}}
-                last_err = MONGO_DB[collection_name].update(criteria, patch)
+                last_err = collection.update(criteria, patch, **write_concern('document'))
                 if last_err['n'] == 1:
                     mod_count = mod_count + 1
                 else:
                     logger.warn("patch_document unexpected update count: {0}".format(last_err))
                     return 409, 'unexpected update count %s' % last_err
+        if patches_index_fields(new_values):
+            update_index_fields(tenant, namespace, document_id, lambda: collection.find_one({'_id': document_id}, {'@graph': True, '_modificationCount': True}), predicate_dictionary)
+        if patches_memberships(new_values):
+            update_document_memberships(tenant, namespace, document_id, lambda: collection.find_one({'_id': document_id}, {'@graph': True, '_modificationCount': True}), predicate_dictionary)
+        update_views(tenant, namespace, document_id, view_row)
                 
         logger.debug("Patched document {0}".format(document_id))
         return 200, None
@@ -352,6 +694,773 @@ def patch_document(user, revision, new_values, public_hostname, tenant, namespac
         logger.warn("patch_document failed to create history document: {0}".format(status))
         return status, 'failed to create history document'
 
+@time_limited
+def find_documents_by_label(user, label, public_hostname, tenant, namespace):
+    """
+    Find the documents in the collection identified by 'public_hostname', 'tenant', and 'namespace' that have a subject
+    whose rdfs:label is 'label'. Unlike the equivalent execute_query, this is an indexed lookup of the '_labels' field - as
+    long as all the documents of the collection have it (see index_field_complete).
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit (see MAX_TIME_MS)
+    """
+    if not index_field_complete(tenant, namespace, '_labels'):
+        return execute_query(user, {'_any': {LABEL: label}}, public_hostname, tenant, namespace)
+    result = get_query_result(limit_time(tenant_collection(tenant, namespace).find({'_labels': label})), public_hostname)
+    logger.debug("found {0} documents with label {1}".format(len(result), label))
+    return 200, result
+
+def index_field_complete(tenant, namespace, field):
+    # Return True if every document of the collection has the index field 'field' (documents created before the field
+    # existed don't, until rebuild_indexes.py has run), so lookups on the field find all the matching documents. The field
+    # is indexed on first use in this process, and once every document has it, it isn't checked again.
+    key = (make_collection_name(tenant, namespace), field)
+    state = index_field_states.get(key)
+    if state:
+        return True
+    collection = tenant_collection(tenant, namespace)
+    if state is None:
+        collection.ensure_index(field)
+    state = collection.find_one({field: {'$exists': False}}, {'_id': True}) is None
+    index_field_states[key] = state
+    return state
+
+def index_fields(subject_array, predicate_dictionary=None):
+    # the index fields of a document with the subjects of a storage '@graph' array
+    owners, resource_groups = storage_access_control(subject_array, predicate_dictionary)
+    return {'_labels': storage_labels(subject_array, predicate_dictionary), '_owner': owners, '_resourceGroup': resource_groups}
+
+def resolve_access_clause(tenant, namespace, query):
+    # Return 'query' ready to be executed on the collection. A '$access' clause is evaluated on the (indexed) access control
+    # fields, but while some documents of the collection lack them (see index_field_complete), it is replaced by the
+    # equivalent clause on the ce:owner and ac:resource-group values of any subject, so those documents aren't left out.
+    clauses = query.get('$query', query)
+    if '$access' not in clauses or (index_field_complete(tenant, namespace, '_owner') and index_field_complete(tenant, namespace, '_resourceGroup')):
+        return query
+    clauses = dict(clauses)
+    access = clauses.pop('$access')
+    owner_clause = {OWNER: URI(access['owner'])}
+    resource_groups = [URI(resource_group) for resource_group in access.get('resourceGroups') or []]
+    if len(resource_groups) > 0:
+        clauses['_any_access'] = {'$or': [owner_clause, {RESOURCE_GROUP: {'$in': resource_groups} if len(resource_groups) > 1 else resource_groups[0]}]}
+    else:
+        clauses['_any_access'] = owner_clause
+    return dict(query, **{'$query': clauses}) if '$query' in query else clauses
+
+def patches_index_fields(new_values):
+    # True if a patch may change the index fields of a document, i.e., it sets or removes one of their predicates, or deletes a subject
+    return any(subject_node is None or not INDEX_FIELD_PREDICATES.isdisjoint(subject_node.iterkeys()) for subject_node in new_values.itervalues())
+
+def update_index_fields(tenant, namespace, document_id, read_document, predicate_dictionary=None):
+    # Recompute the index fields of a document. 'read_document' returns the header (with '_modificationCount') and
+    # '@graph' of the current document. The update is conditional on the modification count, so a concurrent patch cannot
+    # be overwritten with stale fields - if it fails, the fields are recomputed from the newer revision.
+    collection = tenant_collection(tenant, namespace)
+    for _ in range(MAX_INDEX_RETRIES):
+        storage_json = read_document()
+        if storage_json is None:
+            break
+        last_err = collection.update({'_id': document_id, '_modificationCount': storage_json['_modificationCount']}, {'$set': index_fields(storage_json.get('@graph', []), predicate_dictionary)}, **write_concern('derived'))
+        if last_err['n'] == 1:
+            break
+    else:
+        logger.warn("could not update index fields of document {0}".format(document_id))
+
+def rebuild_index_fields(tenant, namespace):
+    """
+    Set the index fields of every document in the collection identified by 'tenant' and 'namespace'. This is needed
+    for collections with documents created before the fields existed.
+    """
+    collection = tenant_collection(tenant, namespace)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    count = 0
+    for storage_json in collection.find({}, {'_id': True}):
+        document_id = storage_json['_id']
+        update_index_fields(tenant, namespace, document_id, lambda: collection.find_one({'_id': document_id}, {'@graph': True, '_modificationCount': True}), predicate_dictionary)
+        count += 1
+    for field in ('_labels', '_owner', '_resourceGroup'):
+        collection.ensure_index(field)
+    return count
+
+@time_limited
+def find_members(user, membership_resource, membership_predicate, query, sort_predicate, public_hostname, tenant, namespace, skip=0, limit=None):
+    """
+    Find the documents in the collection identified by 'public_hostname', 'tenant', and 'namespace' that have a subject
+    with 'membership_predicate' whose value is 'membership_resource', and that also match 'query' (see execute_query),
+    if it isn't empty.
+
+    If 'membership_predicate' is in the membership index (with 'sort_predicate', if one is given), the members are read
+    from the index in sort order, and 'skip' and 'limit' page through the members that match 'query'. Otherwise, this is
+    the equivalent execute_query.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: no errors
+    """
+    if not membership_indexed(membership_predicate, sort_predicate):
+        return execute_query(user, membership_query(membership_resource, membership_predicate, query, sort_predicate, skip, limit), public_hostname, tenant, namespace)
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    collection = tenant_collection(tenant, namespace)
+    match = None
+    if query:
+        query = resolve_access_clause(tenant, namespace, query)
+        storage_query = query_to_storage(query, public_hostname, collection_url, predicate_dictionary)
+        def match(candidate_ids):
+            criteria = {'$and': [{'_id': {'$in': candidate_ids}}, storage_query]}
+            matching_ids = set(storage_json['_id'] for storage_json in limit_time(collection.find(criteria, {'_id': True})))
+            return [document_id for document_id in candidate_ids if document_id in matching_ids]
+    document_ids = member_document_ids(tenant, namespace, membership_predicate, fix_up_url_for_storage(membership_resource, public_hostname, collection_url), skip, limit, match)
+    documents = dict((storage_json['_id'], storage_json) for storage_json in limit_time(collection.find({'_id': {'$in': document_ids}})))
+    result = [rdf_json_from_storage(documents[document_id], public_hostname, PREDICATE_DICTIONARY) for document_id in document_ids if document_id in documents]
+    logger.debug("found {0} members of {1}".format(len(result), membership_resource))
+    return 200, result
+
+@time_limited
+def count_members(user, membership_resource, membership_predicate, public_hostname, tenant, namespace):
+    """
+    Count the documents that find_members (without a query) would find.
+
+    Return:
+        Success: (200, <count:int>)
+        Error: no errors
+    """
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    if membership_indexed(membership_predicate):
+        criteria = {'predicate': membership_predicate, 'container': fix_up_url_for_storage(membership_resource, public_hostname, collection_url)}
+        return 200, limit_time(members_collection(tenant, namespace).find(criteria)).count()
+    storage_query = query_to_storage(membership_query(membership_resource, membership_predicate), public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    return 200, limit_time(tenant_collection(tenant, namespace).find(storage_query)).count()
+
+def membership_indexed(membership_predicate, sort_predicate=None):
+    return membership_predicate in MEMBERSHIP_INDEX and (not sort_predicate or MEMBERSHIP_INDEX[membership_predicate] == sort_predicate)
+
+def membership_query(membership_resource, membership_predicate, query=None, sort_predicate=None, skip=0, limit=None):
+    # the execute_query query equivalent to a membership index lookup
+    query = dict(query or {}, _any_member={membership_predicate: URI(membership_resource)})
+    if not sort_predicate and not skip and limit is None:
+        return query
+    query = {'$query': query, '$skip': skip}
+    if sort_predicate:
+        query['$orderby'] = {sort_predicate: 1}
+    if limit is not None:
+        query['$limit'] = limit
+    return query
+
+def members_collection(tenant, namespace):
+    collection = tenant_collection(tenant, namespace + MEMBERS_SUFFIX)
+    collection.ensure_index([('predicate', 1), ('container', 1), ('document', 1)], unique=True)
+    collection.ensure_index([('predicate', 1), ('container', 1), ('sort', 1), ('document', 1)])
+    collection.ensure_index('document')
+    return collection
+
+def member_document_ids(tenant, namespace, membership_predicate, container, skip=0, limit=None, match=None):
+    # The IDs of a page of the members of 'container' (a storage url), in sort order. If 'match' is given, it is called with
+    # the IDs of each batch of index rows and returns those of the members to keep (in the same order), and 'skip' and
+    # 'limit' count those members only - so batches are read until the page is full or the index rows run out.
+    limit = limit or MEMBERS_BATCH_SIZE
+    cursor = limit_time(members_collection(tenant, namespace).find({'predicate': membership_predicate, 'container': container}, {'document': True}))
+    cursor = cursor.sort([('sort', 1), ('document', 1)])
+    if match is None:
+        return [row['document'] for row in cursor.skip(skip).limit(limit)]
+    rows = iter(cursor.batch_size(MEMBERS_BATCH_SIZE))
+    document_ids = []
+    while len(document_ids) < skip + limit:
+        batch = [row['document'] for row in itertools.islice(rows, MEMBERS_BATCH_SIZE)]
+        if len(batch) == 0:
+            break
+        document_ids.extend(match(batch))
+    return document_ids[skip:skip + limit]
+
+def insert_document_memberships(tenant, namespace, document_id, subject_array, predicate_dictionary=None):
+    if MEMBERSHIP_INDEX:
+        rows = [{'predicate': predicate, 'container': container, 'document': document_id, 'sort': sort_value, 'revision': 0}
+                for predicate, container, sort_value in storage_memberships(subject_array, MEMBERSHIP_INDEX, predicate_dictionary)]
+        if len(rows) > 0:
+            members_collection(tenant, namespace).insert(rows, **write_concern('derived'))
+
+def patches_memberships(new_values):
+    # True if a patch may change the memberships of a document
+    if not MEMBERSHIP_INDEX:
+        return False
+    predicates = set(MEMBERSHIP_INDEX.iterkeys()) | set(sort_predicate for sort_predicate in MEMBERSHIP_INDEX.itervalues() if sort_predicate)
+    return any(subject_node is None or not predicates.isdisjoint(subject_node.iterkeys()) for subject_node in new_values.itervalues())
+
+def update_document_memberships(tenant, namespace, document_id, read_document, predicate_dictionary=None):
+    # Bring the membership rows of a document up to date with the revision returned by 'read_document'. Each row is only
+    # written if it wasn't written for a newer revision, and rows of older revisions are then removed. If the document was
+    # patched in the meantime, this is repeated for the newer revision, so concurrent updates can't leave stale rows.
+    members = members_collection(tenant, namespace)
+    collection = tenant_collection(tenant, namespace)
+    for _ in range(MAX_INDEX_RETRIES):
+        storage_json = read_document()
+        if storage_json is None:
+            members.remove({'document': document_id}, **write_concern('derived'))
+            return
+        revision = storage_json['_modificationCount']
+        for predicate, container, sort_value in storage_memberships(storage_json.get('@graph', []), MEMBERSHIP_INDEX, predicate_dictionary):
+            criteria = {'predicate': predicate, 'container': container, 'document': document_id, 'revision': {'$lte': revision}}
+            try:
+                members.update(criteria, {'$set': {'sort': sort_value, 'revision': revision}}, upsert=True, **write_concern('derived'))
+            except DuplicateKeyError: # already written for a newer revision
+                pass
+        members.remove({'document': document_id, 'revision': {'$lt': revision}}, **write_concern('derived'))
+        current = collection.find_one({'_id': document_id}, {'_modificationCount': True})
+        if current is None or current['_modificationCount'] == revision:
+            if current is None:
+                members.remove({'document': document_id}, **write_concern('derived'))
+            return
+    logger.warn("could not update memberships of document {0}".format(document_id))
+
+def rebuild_membership_index(tenant, namespace):
+    """
+    Write the membership rows of every document in the collection identified by 'tenant' and 'namespace'.
+    """
+    collection = tenant_collection(tenant, namespace)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    count = 0
+    for storage_json in collection.find({}, {'_id': True}):
+        document_id = storage_json['_id']
+        update_document_memberships(tenant, namespace, document_id, lambda: collection.find_one({'_id': document_id}, {'@graph': True, '_modificationCount': True}), predicate_dictionary)
+        count += 1
+    return count
+
+def create_view(user, name, query, projection, public_hostname, tenant, namespace):
+    """
+    Register the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace', and
+    materialize it. 'query' is a query as for execute_query (including query modifiers), and 'projection' is a projection
+    as for execute_query, or None.
+
+    Return:
+        Success: (201, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    status, view = register_view(name, query, projection, public_hostname, tenant, namespace)
+    if status != 201:
+        return status, view
+    collection = tenant_collection(tenant, namespace)
+    for storage_json in collection.find(view['query'], {'_id': True}):
+        update_views(tenant, namespace, storage_json['_id'], view_row, [view])
+    logger.info("created view {0} of namespace {1} for tenant {2}".format(name, namespace, tenant))
+    return 201, None
+
+def drop_view(user, name, public_hostname, tenant, namespace):
+    """
+    Unregister the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace', and drop it.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    collection_name = make_collection_name(tenant, namespace)
+    last_err = views_collection(tenant).remove({'collection': collection_name, 'name': name}, **write_concern('document'))
+    if last_err['n'] == 0:
+        return 404, 'no view %s' % name
+    tenant_collection(tenant, namespace + VIEW_INFIX + name).drop()
+    logger.info("dropped view {0} of namespace {1} for tenant {2}".format(name, namespace, tenant))
+    return 200, None
+
+@time_limited
+def read_view(user, name, public_hostname, tenant, namespace, lazy=False):
+    """
+    Get the documents of the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace',
+    i.e., the result of its query, without evaluating the query.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    views = [view for view in collection_views(tenant, namespace) if view['name'] == name]
+    if len(views) == 0:
+        return 404, 'no view %s' % name
+    modifiers = views[0]['modifiers']
+    cursor = find_query(read_collection(tenant, namespace + VIEW_INFIX + name, lazy), dict(modifiers, **{'$query': {}}) if modifiers else {})
+    result = get_query_result(cursor, public_hostname, lazy, modifiers.get('$limit'))
+    logger.debug("read view {0} of namespace {1} for tenant {2}".format(name, namespace, tenant))
+    return 200, result
+
+def views_collection(tenant):
+    collection = tenant_database(tenant)['views_collection']
+    collection.ensure_index([('collection', 1), ('name', 1)], unique=True)
+    return collection
+
+def register_view(name, query, projection, public_hostname, tenant, namespace):
+    # store the definition of a view, and return it as collection_views does
+    if not VIEW_NAME_PATTERN.match(name):
+        return 400, 'invalid view name: %s' % name
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    query = resolve_access_clause(tenant, namespace, query)
+    storage_query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    modifiers = dict((key, value) for key, value in storage_query.iteritems() if key != '$query') if '$query' in storage_query else {}
+    if projection is not None and all(projection.itervalues()):
+        projection = dict(projection, **{'@id': True, '_modificationCount': True}) # needed by the storage format conversion routine and view maintenance
+    collection_name = make_collection_name(tenant, namespace)
+    view = {'collection': collection_name, 'name': name, 'query': storage_query.get('$query', storage_query), 'modifiers': modifiers, 'projection': projection}
+    try:
+        views_collection(tenant).insert(dict(view, **dict((key, json_util.dumps(view[key])) for key in ('query', 'modifiers', 'projection'))), **write_concern('document'))
+    except DuplicateKeyError:
+        return 409, 'duplicate view name: %s' % name
+    return 201, view
+
+def collection_views(tenant, namespace):
+    # the views of a collection, with their query, modifiers and projection decoded
+    views = []
+    for view in views_collection(tenant).find({'collection': make_collection_name(tenant, namespace)}):
+        for key in ('query', 'modifiers', 'projection'):
+            view[key] = json_util.loads(view[key])
+        views.append(view)
+    return views
+
+def view_row(tenant, namespace, view, document_id):
+    # the (projected) storage document that is the row of 'view' for a document, or None if the document doesn't match the view's query
+    criteria = {'$and': [{'_id': document_id}, view['query']]} if view['query'] else {'_id': document_id}
+    return tenant_collection(tenant, namespace).find_one(criteria, view['projection'])
+
+def update_views(tenant, namespace, document_id, read_row, views=None):
+    # Bring the rows of a document in the views of its collection (or 'views') up to date. 'read_row' returns the row of a
+    # document in a view (see view_row). Each row is only replaced by a row of the same or a newer revision, and if the
+    # document was patched in the meantime, this is repeated for the newer revision, so concurrent updates can't leave stale rows.
+    if views is None:
+        views = collection_views(tenant, namespace)
+    if not views:
+        return
+    collection = tenant_collection(tenant, namespace)
+    for _ in range(MAX_INDEX_RETRIES):
+        current = collection.find_one({'_id': document_id}, {'_modificationCount': True})
+        for view in views:
+            rows = tenant_collection(tenant, namespace + VIEW_INFIX + view['name'])
+            row = read_row(tenant, namespace, view, document_id) if current is not None else None
+            if row is None:
+                rows.remove({'_id': document_id}, **write_concern('derived'))
+            else:
+                try:
+                    rows.update({'_id': document_id, '_modificationCount': {'$lte': row['_modificationCount']}}, row, upsert=True, **write_concern('derived'))
+                except DuplicateKeyError: # already written for a newer revision
+                    pass
+        latest = collection.find_one({'_id': document_id}, {'_modificationCount': True})
+        if (latest is None and current is None) or (latest is not None and current is not None and latest['_modificationCount'] == current['_modificationCount']):
+            return
+    logger.warn("could not update views of document {0}".format(document_id))
+
+def remove_view_rows(tenant, namespace, document_ids):
+    for view in collection_views(tenant, namespace):
+        tenant_collection(tenant, namespace + VIEW_INFIX + view['name']).remove({'_id': {'$in': document_ids}}, **write_concern('derived'))
+
+def drop_views(tenant, namespace):
+    for view in collection_views(tenant, namespace):
+        tenant_collection(tenant, namespace + VIEW_INFIX + view['name']).drop()
+    views_collection(tenant).remove({'collection': make_collection_name(tenant, namespace)}, **write_concern('document'))
+
+def create_attachment(user, stream, length, content_type, filename, public_hostname, tenant, namespace, document_id):
+    """
+    Store 'length' bytes read from 'stream' (a file-like object, e.g., wsgi.input) as an attachment of the document specified
+    by 'public_hostname', 'tenant', 'namespace', and 'document_id'. The stream is copied in chunks of ATTACHMENT_CHUNK_SIZE
+    bytes. The document itself is not changed - it's up to the caller to link the attachment from it.
+
+    Return:
+        Success: (201, <attachment-id:string>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    if tenant_collection(tenant, namespace).find_one({'_id': document_id}, {'_id': True}) is None:
+        logger.warn("create_attachment: no document {0} in namespace {1} for tenant {2}".format(document_id, namespace, tenant))
+        return 404, '404 not found'
+    attachments = attachments_fs(tenant, namespace)
+    attachment_id = make_objectid()
+    attachment = attachments.new_file(_id=attachment_id, document=document_id, content_type=content_type, filename=filename,
+                                      chunk_size=ATTACHMENT_CHUNK_SIZE, uploadedBy=fix_up_url_for_storage(user, public_hostname, '/'))
+    remaining = length
+    try:
+        while remaining > 0:
+            data = stream.read(min(remaining, ATTACHMENT_CHUNK_SIZE))
+            if not data:
+                break
+            attachment.write(data)
+            remaining -= len(data)
+    finally:
+        attachment.close()
+        if remaining > 0: # the client went away, or sent less than it said it would
+            attachments.delete(attachment_id)
+    if remaining > 0:
+        logger.warn("create_attachment: request body ended {0} bytes short of its length".format(remaining))
+        return 400, 'request body is shorter than its Content-Length'
+    logger.info("created attachment {0} of document {1} ({2} bytes)".format(attachment_id, document_id, length))
+    return 201, attachment_id
+
+def get_attachment(user, public_hostname, tenant, namespace, document_id, attachment_id):
+    """
+    Get the attachment 'attachment_id' of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    The attachment is returned as a file-like object (a GridOut) with 'length', 'content_type', 'filename' and
+    'upload_date' attributes, whose read() and seek() methods read the chunks of the attachment on demand.
+
+    Return:
+        Success: (200, <attachment:GridOut>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    try:
+        attachment = attachments_fs(tenant, namespace).get(attachment_id)
+    except NoFile:
+        attachment = None
+    if attachment is None or getattr(attachment, 'document', None) != document_id:
+        logger.warn("could not fetch attachment {0} of document {1} in namespace {2} for tenant {3}".format(attachment_id, document_id, namespace, tenant))
+        return 404, '404 not found'
+    return 200, attachment
+
+def delete_attachment(user, public_hostname, tenant, namespace, document_id, attachment_id):
+    """
+    Delete the attachment 'attachment_id' of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    attachments = attachments_fs(tenant, namespace)
+    if not attachments.exists(_id=attachment_id, document=document_id):
+        return 404, '404 not found'
+    attachments.delete(attachment_id)
+    logger.info("deleted attachment {0} of document {1}".format(attachment_id, document_id))
+    return 200, None
+
+def attachments_fs(tenant, namespace):
+    attachments = GridFS(tenant_database(tenant), make_collection_name(tenant, namespace + ATTACHMENTS_SUFFIX))
+    tenant_collection(tenant, namespace + ATTACHMENTS_SUFFIX).files.ensure_index('document')
+    return attachments
+
+def remove_attachments(tenant, namespace, document_ids):
+    files = tenant_collection(tenant, namespace + ATTACHMENTS_SUFFIX).files
+    if files.find_one({'document': {'$in': document_ids}}, {'_id': True}) is not None:
+        attachments = attachments_fs(tenant, namespace)
+        for attachment in files.find({'document': {'$in': document_ids}}, {'_id': True}):
+            attachments.delete(attachment['_id'])
+
+def drop_attachments(tenant, namespace):
+    attachments = tenant_collection(tenant, namespace + ATTACHMENTS_SUFFIX)
+    attachments.files.drop()
+    attachments.chunks.drop()
+
+def append_change_entries(tenant, namespace, entries):
+    """
+    Append 'entries' to the change log stored with the collection identified by 'tenant' and 'namespace'. Each entry is a
+    dictionary with the keys 'position' (its position in the log, starting at 0), 'kind', 'changed', 'order', and 'identifier'.
+
+    Return:
+        Success: (201, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    if not entries:
+        return 201, None
+    storage_entries = [dict([('_id', entry['position'])] + [(key, entry[key]) for key in ('kind', 'changed', 'order', 'identifier')]) for entry in entries]
+    try:
+        tenant_collection(tenant, namespace + CHANGES_SUFFIX).insert(storage_entries, **write_concern('tracking'))
+    except DuplicateKeyError:
+        return 409, 'change log position already taken'
+    return 201, None
+
+def read_change_entries(tenant, namespace, start, end=None, limit=None):
+    """
+    Get the entries of the change log stored with the collection identified by 'tenant' and 'namespace' whose positions
+    are from 'start' up to (but not including) 'end', or to the end of the log if 'end' is None, in log order - at most
+    'limit' of them, if it isn't None.
+
+    Return:
+        Success: (200, [<entry:dict>, ...]) (see append_change_entries)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    criteria = {'$gte': start} if end is None else {'$gte': start, '$lt': end} # numbers only, i.e., not the counter
+    entries = []
+    cursor = tenant_collection(tenant, namespace + CHANGES_SUFFIX).find({'_id': criteria}).sort('_id', 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    for storage_entry in cursor:
+        storage_entry['position'] = storage_entry.pop('_id')
+        entries.append(storage_entry)
+    return 200, entries
+
+def change_log_length(tenant, namespace):
+    """
+    Get the length of the change log stored with the collection identified by 'tenant' and 'namespace', i.e., the position
+    of its next entry.
+
+    Return:
+        Success: (200, <length:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    cursor = tenant_collection(tenant, namespace + CHANGES_SUFFIX).find({'_id': {'$gte': 0}}, {'_id': True}).sort('_id', -1).limit(1)
+    try: last_entry = cursor.next()
+    except StopIteration: return 200, 0
+    return 200, last_entry['_id'] + 1
+
+def allocate_change_positions(tenant, namespace, count):
+    """
+    Atomically allocate 'count' consecutive positions in the change log stored with the collection identified by 'tenant'
+    and 'namespace', for entries to be appended with append_change_entries.
+
+    Return:
+        Success: (200, <first position:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    collection = tenant_collection(tenant, namespace + CHANGES_SUFFIX)
+    counter = collection.find_and_modify(query={'_id': CHANGES_COUNTER_ID}, update={'$inc': {'next': count}}, new=True)
+    if counter is None: # the first allocation - start after the entries stored so far
+        status, length = change_log_length(tenant, namespace)
+        if status != 200:
+            return status, length
+        try:
+            collection.insert({'_id': CHANGES_COUNTER_ID, 'next': length})
+        except DuplicateKeyError: # allocated by another process in the meantime
+            pass
+        counter = collection.find_and_modify(query={'_id': CHANGES_COUNTER_ID}, update={'$inc': {'next': count}}, new=True)
+    return 200, counter['next'] - count
+
+def claim_change_positions(tenant, namespace, start, count):
+    """
+    Atomically allocate the 'count' consecutive positions from 'start' on in the change log stored with the collection
+    identified by 'tenant' and 'namespace', e.g., to store entries whose positions are given by the segments they belong to.
+    This fails if any position from 'start' on has already been allocated (see allocate_change_positions), and later
+    allocations follow the claimed positions.
+
+    Return:
+        Success: (200, None)
+        Error: (409, <errror-msg:string>) if positions from 'start' on have already been allocated
+    """
+    collection = tenant_collection(tenant, namespace + CHANGES_SUFFIX)
+    try: # the upsert inserts a counter, which fails if one exists with later positions allocated
+        collection.update({'_id': CHANGES_COUNTER_ID, 'next': {'$lte': start}}, {'$set': {'next': start + count}}, upsert=True, **write_concern('tracking'))
+    except DuplicateKeyError:
+        return 409, 'change log positions from %d on have already been allocated' % start
+    return 200, None
+
+def truncate_change_log(tenant, namespace, before):
+    """
+    Remove the entries whose positions are less than 'before' from the change log stored with the collection identified
+    by 'tenant' and 'namespace'. Positions are never reused, so later entries keep their positions.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    collection = tenant_collection(tenant, namespace + CHANGES_SUFFIX)
+    collection.update({'_id': CHANGES_COUNTER_ID}, {'$max': {'start': before}}, **write_concern('tracking'))
+    collection.remove({'_id': {'$gte': 0, '$lt': before}}, **write_concern('tracking'))
+    return 200, None
+
+def remove_numbered_documents(tenant, namespace, prefix, before):
+    """
+    Remove the documents '<prefix><n>' whose number n is less than 'before' from the collection identified by 'tenant' and
+    'namespace', e.g., the ChangeLog segments stored as whole documents by earlier versions of trsbuilder.
+
+    Return:
+        Success: (200, <count:int>) the number of documents removed
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    collection = tenant_collection(tenant, namespace)
+    document_ids = numbered_document_ids(collection, prefix, before)
+    if len(document_ids) > 0:
+        collection.remove({'_id': {'$in': document_ids}}, **write_concern('tracking'))
+    return 200, len(document_ids)
+
+def numbered_document_ids(collection, prefix, before):
+    # the IDs '<prefix><n>' with n < 'before' of the documents of 'collection', found with a single (prefix) query
+    pattern = re.compile('^%s([0-9]+)$' % re.escape(prefix))
+    matches = [pattern.match(document['_id']) for document in collection.find({'_id': {'$regex': '^' + re.escape(prefix)}}, {'_id': True})]
+    return [match.group(0) for match in matches if match is not None and int(match.group(1)) < before]
+
+def change_log_start(tenant, namespace):
+    """
+    Get the position before which the change log stored with the collection identified by 'tenant' and 'namespace' has
+    been truncated (0 if it hasn't been).
+
+    Return:
+        Success: (200, <position:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    counter = tenant_collection(tenant, namespace + CHANGES_SUFFIX).find_one({'_id': CHANGES_COUNTER_ID})
+    return 200, counter.get('start', 0) if counter is not None else 0
+
+def add_base_members(tenant, namespace, member_urls, stamp):
+    """
+    Add 'member_urls' to the TRS base stored with the collection identified by 'tenant' and 'namespace' (members that are
+    already in the base get the new 'stamp').
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    collection = tenant_collection(tenant, namespace + BASE_SUFFIX)
+    for member_url in member_urls:
+        collection.update({'_id': member_url}, {'$set': {'stamp': stamp}}, upsert=True, **write_concern('tracking'))
+    return 200, None
+
+def remove_base_members(tenant, namespace, member_urls=None, before=None):
+    """
+    Remove 'member_urls', or (if 'member_urls' is None) the members that were last added with a stamp less than 'before',
+    from the TRS base stored with the collection identified by 'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    criteria = {'_id': {'$in': list(member_urls)}} if member_urls is not None else {'stamp': {'$lt': before}}
+    tenant_collection(tenant, namespace + BASE_SUFFIX).remove(criteria, **write_concern('tracking'))
+    return 200, None
+
+def read_base_members(tenant, namespace, after=None, limit=None):
+    """
+    Get the members of the TRS base stored with the collection identified by 'tenant' and 'namespace' that follow 'after'
+    (or all members, if 'after' is None), in URI order, up to 'limit' of them.
+
+    Return:
+        Success: (200, [<member-url:string>, ...])
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    cursor = tenant_collection(tenant, namespace + BASE_SUFFIX).find({'_id': {'$gt': after}} if after is not None else {}, {'_id': True}).sort('_id', 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return 200, [member['_id'] for member in cursor]
+
+def read_document_changes(tenant, namespace, after=None, limit=None):
+    """
+    Get the changes of the documents of the collection identified by 'tenant' and 'namespace' that follow the oplog position
+    'after' (or the latest position, if 'after' is None), in the order in which they were made - at most 'limit' of them, if
+    it isn't None. If there are none, this waits a second or so for one.
+
+    Each change is a dictionary {'kind': 'create' | 'modify' | 'delete' | 'drop', 'document': <document id, None for 'drop'>,
+    'position': <oplog position>}. The returned position is that of the last oplog entry that was read, which can be passed
+    as 'after' to continue - and stored with the change log (see write_change_source_position).
+
+    Return:
+        Success: (200, [<change:dict>, ...], <position>)
+        Error: (404, None, <errror-msg:string>) if MongoDB isn't running as a replica set,
+               (410, None, <errror-msg:string>) if the oplog no longer goes back to 'after'
+    """
+    database = tenant_database(tenant)
+    local = (database.client if hasattr(database, 'client') else database.connection)['local']
+    if OPLOG_COLLECTION not in local.collection_names():
+        return 404, None, 'no oplog - MongoDB must run as a replica set'
+    oplog = local[OPLOG_COLLECTION]
+    if after is None:
+        latest = list(oplog.find({}, {'ts': True}).sort('$natural', -1).limit(1))
+        return 200, [], latest[0]['ts'] if latest else None
+    oldest = list(oplog.find({}, {'ts': True}).sort('$natural', 1).limit(1))
+    if oldest and oldest[0]['ts'] > after:
+        return 410, None, 'the oplog no longer goes back to %s' % after
+    collection_name = make_collection_name(tenant, namespace)
+    criteria = {'ts': {'$gt': after}, '$or': [{'ns': database.name + '.' + collection_name}, {'ns': database.name + '.$cmd', 'o.drop': collection_name}]}
+    cursor = oplog.find(criteria, tailable=True, await_data=True).add_option(OPLOG_REPLAY)
+    changes = []
+    position = after
+    for entry in cursor: # ends when no entry is added for a while (await_data)
+        position = entry['ts']
+        change = oplog_document_change(entry)
+        if change is not None:
+            changes.append(change)
+            if limit and len(changes) == limit:
+                break
+    cursor.close()
+    if position == after: # the cursor ends right away when nothing follows 'after' yet
+        time.sleep(OPLOG_IDLE_SECONDS)
+    return 200, changes, position
+
+def oplog_document_change(entry):
+    # the change of a document recorded by an oplog entry of its collection (see read_document_changes), or None
+    op = entry['op']
+    if op == 'i':
+        return {'kind': 'create', 'document': entry['o']['_id'], 'position': entry['ts']}
+    elif op == 'd':
+        return {'kind': 'delete', 'document': entry['o']['_id'], 'position': entry['ts']}
+    elif op == 'u':
+        update = entry['o']
+        fields = update.get('$set') or update.get('diff', {}).get('u') or update # $inc is logged as $set (as a diff by MongoDB 5)
+        if '_modificationCount' in fields:
+            return {'kind': 'modify', 'document': entry['o2']['_id'], 'position': entry['ts']}
+    elif op == 'c':
+        return {'kind': 'drop', 'document': None, 'position': entry['ts']}
+    return None
+
+def read_change_source_position(tenant, namespace):
+    """
+    Get the oplog position (see read_document_changes) recorded with the change log stored with the collection identified
+    by 'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, <position, or None if none has been recorded>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    source = tenant_collection(tenant, namespace + CHANGES_SUFFIX).find_one({'_id': CHANGES_SOURCE_ID})
+    return 200, source['position'] if source is not None else None
+
+def write_change_source_position(tenant, namespace, position):
+    """
+    Record the oplog position 'position' (see read_document_changes) with the change log stored with the collection
+    identified by 'tenant' and 'namespace'.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    tenant_collection(tenant, namespace + CHANGES_SUFFIX).update({'_id': CHANGES_SOURCE_ID}, {'$set': {'position': position}}, upsert=True, **write_concern('tracking'))
+    return 200, None
+
+def merge_revision(new_values, public_hostname, tenant, namespace, document_id, revision, current_storage_json):
+    """
+    Decide whether a patch of 'revision' can be applied to 'current_storage_json', the current state of the document.
+
+    The changes made since 'revision' are computed by comparing the history document of 'revision' (the snapshot taken
+    by the patch that followed it) with the current document. The patch can be merged if it doesn't change (or delete)
+    any subject predicate that was changed since, and doesn't delete a subject that was changed since.
+
+    Return:
+        Success: (200, <current-revision:int>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    if current_storage_json is None:
+        return 404, '404 not found'
+    current_revision = current_storage_json['_modificationCount']
+    if current_revision == revision:
+        return 200, revision
+    history_collection = tenant_collection(tenant, namespace + '_history')
+    history_collection.ensure_index([('_versionOfId', 1), ('_modificationCount', 1)])
+    base_storage_json = history_collection.find_one({'_versionOfId': document_id, '_modificationCount': revision})
+    if base_storage_json is None or storage_format(base_storage_json) != storage_format(current_storage_json):
+        logger.warn("patch_document cannot merge revision {0} of {1}: no history".format(revision, document_id))
+        return 409, 'cannot merge revision %s: no history for that revision' % revision
+    changed = changed_subject_predicates(base_storage_json.get('@graph', []), current_storage_json.get('@graph', []))
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, document_id)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    changed_subjects = set(subject for subject, predicate in changed)
+    for subject_url, subject_node in new_values.iteritems():
+        storage_subject_url = fix_up_url_for_storage(subject_url, public_hostname, document_url)
+        if subject_node is None:
+            conflict = storage_subject_url in changed_subjects
+        else:
+            conflict = (storage_subject_url, None) in changed or \
+                any((storage_subject_url, predicate_to_mongo(predicate, predicate_dictionary, False)) in changed for predicate in subject_node.iterkeys())
+        if conflict:
+            logger.info("patch_document merge conflict on {0} of {1} since revision {2}".format(subject_url, document_id, revision))
+            return 409, 'conflicting change to %s since revision %s' % (subject_url, revision)
+    logger.debug("patch_document merging revision {0} of {1} into revision {2}".format(revision, document_id, current_revision))
+    return 200, current_revision
+
+def changed_subject_predicates(base_subject_array, current_subject_array):
+    # return the set of (subject, predicate) storage pairs that differ between two @graph arrays. A predicate of None means
+    # that the whole subject was added or removed.
+    base_subjects = dict((subject['@id'], subject) for subject in base_subject_array)
+    current_subjects = dict((subject['@id'], subject) for subject in current_subject_array)
+    changed = set()
+    for subject_url in set(base_subjects) | set(current_subjects):
+        base_subject = base_subjects.get(subject_url)
+        current_subject = current_subjects.get(subject_url)
+        if base_subject is None or current_subject is None:
+            changed.add((subject_url, None))
+            for predicate in (base_subject or current_subject).iterkeys():
+                changed.add((subject_url, predicate))
+        else:
+            for predicate in set(base_subject) | set(current_subject):
+                if base_subject.get(predicate) != current_subject.get(predicate):
+                    changed.add((subject_url, predicate))
+    return changed
+
 def make_objectid():
     global next_id
     global lineage
@@ -372,26 +1481,44 @@ def make_historyid():
         next_history_id += 1
     return '.'.join((history_lineage, str(rslt)))
 
-def get_query_result(cursor, public_hostname):
-    batchSize = 100
+def find_query(collection, storage_query, projection=None):
+    # Return a cursor for a query produced by query_to_storage, applying its query modifiers (if any) and time limit to the cursor
+    if '$query' not in storage_query:
+        return limit_time(collection.find(storage_query) if projection is None else collection.find(storage_query, projection))
+    query = storage_query['$query']
+    cursor = limit_time(collection.find(query) if projection is None else collection.find(query, projection))
+    if '$orderby' in storage_query:
+        cursor = cursor.sort(storage_query['$orderby'])
+    if '$skip' in storage_query:
+        cursor = cursor.skip(storage_query['$skip'])
+    if '$limit' in storage_query:
+        cursor = cursor.limit(storage_query['$limit'])
+    return cursor
+
+def get_query_result(cursor, public_hostname, lazy=False, limit=None):
+    batchSize = query_result_limit(limit)
     cursor.batch_size(batchSize)
     response = []
-    for _ in range(batchSize): # TODO: how can client GET subsequent batches, if there are more?
+    for _ in xrange(batchSize): # clients GET subsequent batches with $skip
         try: document = cursor.next()
         except StopIteration: break
-        document = rdf_json_from_storage(document, public_hostname)
+        document = lazy_rdf_json_from_storage(document, public_hostname, PREDICATE_DICTIONARY) if lazy else rdf_json_from_storage(document, public_hostname, PREDICATE_DICTIONARY)
         response.append(document)
     return response
 
-def make_subject_array(rdf_json, public_hostname, path_url):
+def query_result_limit(limit=None):
+    # the number of documents to return for a query with the $limit 'limit' (None or 0 for no limit)
+    return min(limit, MAX_QUERY_RESULTS) if limit > 0 else MAX_QUERY_RESULTS
+
+def make_subject_array(rdf_json, public_hostname, path_url, predicate_dictionary=None):
     subject_array = []
     for subject, subject_node in rdf_json.iteritems():
         json_ld_subject_node = {}
         for predicate, value_array in subject_node.iteritems():
             if subject == rdf_json.graph_url and predicate in SYSTEM_PROPERTIES:
                 return None
-            predicate = predicate_to_mongo(predicate)
-            value = [storage_value_from_rdf_json(item, public_hostname, path_url) for item in value_array] if isinstance(value_array, (list, tuple)) else storage_value_from_rdf_json(value_array, public_hostname, path_url)
+            predicate = predicate_to_mongo(predicate, predicate_dictionary)
+            value = [storage_value_from_rdf_json(item, public_hostname, path_url, predicate_dictionary) for item in value_array] if isinstance(value_array, (list, tuple)) else storage_value_from_rdf_json(value_array, public_hostname, path_url, predicate_dictionary)
             json_ld_subject_node[predicate] = value
         json_ld_subject_node['@id'] = fix_up_url_for_storage(subject, public_hostname, path_url)
         subject_array.append(json_ld_subject_node)
@@ -400,6 +1527,64 @@ def make_subject_array(rdf_json, public_hostname, path_url):
 def make_collection_name(tenant, namespace):
     return tenant + '/' + namespace
 
+def tenant_collection(tenant, namespace):
+    return tenant_database(tenant)[make_collection_name(tenant, namespace)]
+
+def tenant_database(tenant):
+    placement = tenant_placements.get(tenant)
+    if placement is None or placement[1] < time.time():
+        cluster = DEFAULT_CLUSTER
+        if MONGODB_CLUSTERS:
+            placement_document = MONGO_DB['placements_collection'].find_one({'_id': tenant})
+            if placement_document is not None:
+                cluster = placement_document['cluster']
+        placement = (cluster_database(cluster), time.time() + PLACEMENT_CACHE_SECONDS)
+        tenant_placements[tenant] = placement
+    return placement[0]
+
+def cluster_database(cluster):
+    with placement_lock:
+        if cluster not in cluster_databases:
+            if cluster not in MONGODB_CLUSTERS:
+                raise ValueError('unknown MongoDB cluster: %s' % cluster)
+            config = MONGODB_CLUSTERS[cluster]
+            database = MongoClient(config['host'], int(config.get('port', 27017)), tz_aware=True)[config.get('db', MONGODB_DB_NAME)]
+            if 'username' in config:
+                database.authenticate(config['username'], config['password'])
+            cluster_databases[cluster] = database
+            logger.info("connected to MongoDB cluster {0}".format(cluster))
+        return cluster_databases[cluster]
+
+def cluster_names():
+    return [DEFAULT_CLUSTER] + [cluster for cluster in MONGODB_CLUSTERS if cluster != DEFAULT_CLUSTER]
+
+def place_tenant(tenant, cluster):
+    """
+    Record that the collections of 'tenant' are in 'cluster'. The collections themselves must be copied to the new
+    cluster separately. Other processes pick up the new placement when their cached placement expires.
+    """
+    cluster_database(cluster) # fail early for unknown clusters
+    MONGO_DB['placements_collection'].update({'_id': tenant}, {'$set': {'cluster': cluster}}, upsert=True)
+    tenant_placements.pop(tenant, None)
+    logger.info("placed tenant {0} in cluster {1}".format(tenant, cluster))
+
+def collection_format(tenant, namespace):
+    # The format of a collection is the format of its documents, or STORAGE_FORMAT if it is empty.
+    collection_name = make_collection_name(tenant, namespace)
+    if collection_name not in collection_formats:
+        document = tenant_collection(tenant, namespace).find_one({}, {'_format': True})
+        collection_formats[collection_name] = document.get('_format', STORAGE_FORMAT_V1) if document is not None else STORAGE_FORMAT
+    return collection_formats[collection_name]
+
+def collection_predicate_dictionary(tenant, namespace):
+    return PREDICATE_DICTIONARY if collection_format(tenant, namespace) == STORAGE_FORMAT_V2 else None
+
+def read_collection(tenant, namespace, lazy=False):
+    collection = tenant_collection(tenant, namespace)
+    if lazy and RAW_BSON_CODEC_OPTIONS is not None:
+        collection = collection.with_options(codec_options=RAW_BSON_CODEC_OPTIONS)
+    return collection
+
 def tenant_names(namespace):
-    collection_names = MONGO_DB.collection_names()
+    collection_names = [collection_name for cluster in cluster_names() for collection_name in cluster_database(cluster).collection_names()]
     return [name_split[0] for name_split in [collection_name.split('/') for collection_name in collection_names] if len(name_split) > 1 and name_split[1] == namespace]
@@ -0,0 +1,82 @@
+from pymongo.errors import DuplicateKeyError
+import threading
+import logging
+
+"""Predicate dictionary used by storage format 2
+
+Storage format 2 stores subject predicates under short IDs (e.g., 'p1f') instead of full (%2E escaped) predicate IRIs.
+The mapping is kept in a per-database dictionary collection with one document per predicate:
+
+    {'_id': <predicate IRI>, 'short_id': <short ID>}
+
+plus a counter document ({'_id': '@counter', 'value': <last allocated number>}) used to allocate new short IDs.
+Entries are never changed once created, so they are cached in-process without invalidation.
+"""
+
+logger=logging.getLogger(__name__)
+
+COUNTER_ID = '@counter' # predicate IRIs never start with '@'
+
+class Predicate_Dictionary(object):
+    def __init__(self, db, collection_name='predicates_collection'):
+        self.collection = db[collection_name]
+        self.collection.ensure_index('short_id', unique=True, sparse=True)
+        self.short_ids = {}
+        self.predicates = {}
+        self.lock = threading.Lock()
+
+    def short_id(self, predicate, create=True):
+        """
+        Return the short ID for 'predicate'. If the predicate isn't in the dictionary yet, a new short ID is allocated,
+        unless 'create' is False, in which case None is returned.
+        """
+        short_id = self.short_ids.get(predicate)
+        if short_id is not None:
+            return short_id
+        entry = self.collection.find_one({'_id': predicate})
+        if entry is None:
+            if not create:
+                return None
+            short_id = self.allocate_short_id()
+            try:
+                self.collection.insert({'_id': predicate, 'short_id': short_id})
+                logger.debug('added predicate {0} to dictionary as {1}'.format(predicate, short_id))
+            except DuplicateKeyError: # another process added it first - use theirs
+                entry = self.collection.find_one({'_id': predicate})
+                short_id = entry['short_id']
+        else:
+            short_id = entry['short_id']
+        self.cache(predicate, short_id)
+        return short_id
+
+    def predicate(self, short_id):
+        """
+        Return the predicate IRI for 'short_id'.
+        """
+        predicate = self.predicates.get(short_id)
+        if predicate is not None:
+            return predicate
+        entry = self.collection.find_one({'short_id': short_id})
+        if entry is None:
+            raise ValueError('unknown predicate short id %s' % short_id)
+        predicate = entry['_id']
+        self.cache(predicate, short_id)
+        return predicate
+
+    def allocate_short_id(self):
+        counter = self.collection.find_and_modify(query={'_id': COUNTER_ID}, update={'$inc': {'value': 1}}, new=True, upsert=True)
+        return 'p' + base36(counter['value'])
+
+    def cache(self, predicate, short_id):
+        with self.lock:
+            self.short_ids[predicate] = short_id
+            self.predicates[short_id] = predicate
+
+def base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if number == 0:
+            return result
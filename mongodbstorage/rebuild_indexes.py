@@ -0,0 +1,34 @@
+# This module rebuilds the index fields and the membership index (see operation_primitives) of existing collections, e.g. for
+# documents created before the index fields existed, or after a predicate has been added to MONGODB_MEMBERSHIP_INDEX. It is
+# run as a script, with the same environment variables as the application (MONGODB_DB_HOST, MONGODB_DB_PORT, APP_NAME,
+# OPERATION_PRIMITIVES, MONGODB_MEMBERSHIP_INDEX, ...):
+#
+#   python rebuild_indexes.py tenant/namespace [tenant/namespace ...]
+#
+# Documents are updated one at a time, conditional on their _modificationCount, so it is safe to run while the
+# application is serving requests.
+#
+import os
+import sys
+import importlib
+import logging
+
+logger=logging.getLogger(__name__)
+
+operation_primitives = importlib.import_module(os.environ.get('OPERATION_PRIMITIVES', 'operation_primitives'))
+
+def rebuild(collection_names):
+    for collection_name in collection_names:
+        tenant, namespace = collection_name.split('/', 1)
+        count = operation_primitives.rebuild_index_fields(tenant, namespace)
+        logger.info('set the index fields of {0} documents in {1}'.format(count, collection_name))
+        if operation_primitives.MEMBERSHIP_INDEX:
+            count = operation_primitives.rebuild_membership_index(tenant, namespace)
+            logger.info('indexed the memberships of {0} documents in {1}'.format(count, collection_name))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        print 'usage: python rebuild_indexes.py tenant/namespace [tenant/namespace ...]'
+        sys.exit(1)
+    rebuild(sys.argv[1:])
@@ -1,20 +1,33 @@
 import urlparse
 import datetime
+import UserDict
 from rdf_json import RDF_JSON_Document
 from rdf_json import rdf_json_value_struct
 from rdf_json import URI
 from rdf_json import BNode
 from dateutil.parser import parse as to_date
-from base_constants import XSD, RDF, CE, DC
+from base_constants import XSD, RDF, RDFS, CE, DC, AC
 
 STORAGE_PREFIX = 'urn:ce:'
 
+# Storage format 2 stores predicates as short IDs from a Predicate_Dictionary (see predicate_dictionary.py) and uses
+# compact value structs: {'u': <url>} for URIs, {'b': <bnode>} for blank nodes, and {'l': <value>, 'd': <datatype>}
+# for literals that aren't stored as native values. Format 2 documents are marked with '_format': 2.
+#
+# Functions in this module that take a 'predicate_dictionary' argument produce format 1 if it is None, and format 2
+# otherwise. Documents and values read from storage are converted from whichever format they are in.
+STORAGE_FORMAT_V1 = 1
+STORAGE_FORMAT_V2 = 2
+
 REVISION = CE+'revision'
 LASTMODIFIED = CE+'lastModified'
 LASTMODIFIEDBY = CE+'lastModifiedBy'
 
 CREATOR = DC+'creator'
 CREATED = DC+'created'
+LABEL = RDFS+'label'
+OWNER = CE+'owner'
+RESOURCE_GROUP = AC+'resource-group'
 #TODO: Think about whether we should use our own CE namespace (instead of DC) for CREATOR and CREATED properties, so that
 #      we don't ever interfere with (wipe out) user-defined values.
 
@@ -43,7 +56,17 @@ def fix_up_url_for_storage(url, public_hostname, path_url):
         else: #must be an absolute http url on a different host or an url with a scheme other than http(s)
             return url
 
-def storage_value_from_rdf_json(rdf_json, public_hostname, path_url):
+def storage_value_struct(rdf_type, value, datatype=None, predicate_dictionary=None):
+    if predicate_dictionary is None:
+        return rdf_json_value_struct(rdf_type, value, datatype)
+    elif rdf_type == 'uri':
+        return {'u': value}
+    elif rdf_type == 'bnode':
+        return {'b': value}
+    else:
+        return {'l': value, 'd': datatype} if datatype else {'l': value}
+
+def storage_value_from_rdf_json(rdf_json, public_hostname, path_url, predicate_dictionary=None):
     if hasattr(rdf_json, 'keys'):
         rdf_type = rdf_json['type']
         if rdf_type == 'literal':
@@ -55,25 +78,25 @@ def storage_value_from_rdf_json(rdf_json, public_hostname, path_url):
                 return value
             elif datatype == XSD+'boolean' or datatype == XSD+'string' or datatype == XSD+'integer' or datatype == XSD+'double' or datatype == XSD+'float' or not datatype:
                 return value
-            return rdf_json_value_struct('literal', value, datatype)
+            return storage_value_struct('literal', value, datatype, predicate_dictionary)
         elif rdf_type == 'uri':
             value = rdf_json['value']
             if hasattr(value, 'keys'):
                 if '$in' in value:
-                    return rdf_json_value_struct('uri', {'$in': [fix_up_url_for_storage(x, public_hostname, path_url) for x in value['$in']]})
+                    return storage_value_struct('uri', {'$in': [fix_up_url_for_storage(x, public_hostname, path_url) for x in value['$in']]}, None, predicate_dictionary)
                 else: 
                     raise ValueError('unhandled clause %s' % value)
             else:
-                return rdf_json_value_struct('uri', fix_up_url_for_storage(rdf_json['value'], public_hostname, path_url))
+                return storage_value_struct('uri', fix_up_url_for_storage(rdf_json['value'], public_hostname, path_url), None, predicate_dictionary)
         elif rdf_type == 'bnode':
-            return rdf_json
+            return rdf_json if predicate_dictionary is None else storage_value_struct('bnode', rdf_json['value'], None, predicate_dictionary)
         else:
             raise ValueError(rdf_type)
     else:
         if isinstance(rdf_json, URI):
-            return {'type':'uri','value': fix_up_url_for_storage(rdf_json.uri_string, public_hostname, path_url)}
+            return storage_value_struct('uri', fix_up_url_for_storage(rdf_json.uri_string, public_hostname, path_url), None, predicate_dictionary)
         elif isinstance(rdf_json, BNode):
-            return {'type':'bnode','value':rdf_json.bnode_string} 
+            return storage_value_struct('bnode', rdf_json.bnode_string, None, predicate_dictionary)
         else:
             return rdf_json # hopefully it's a string, a number or a boolean, otherwise it won't work    
             
@@ -92,7 +115,9 @@ def uri_string_from_storage(url_string, public_hostname):
         result = URI(url_string)
     return result
         
-def restore_predicate_from_storage(predicate):
+def restore_predicate_from_storage(predicate, predicate_dictionary=None):
+    if predicate_dictionary is not None:
+        return predicate_dictionary.predicate(predicate)
     if '%2E' in predicate: #need to escape dots in predicates to keep mongodb happy
         predicate = predicate.replace('%2E', '.')
     return predicate
@@ -100,120 +125,260 @@ def restore_predicate_from_storage(predicate):
 def rdf_json_value_from_storage (storage_json, public_hostname):
     result = None
     if hasattr(storage_json, 'keys'):
-        rj_type = storage_json['type']
-        if rj_type == 'uri':
-            url_string = storage_json['value']
-            result = uri_string_from_storage(url_string, public_hostname)
-        elif rj_type == 'literal':
-            result = storage_json
+        if 'type' in storage_json: # storage format 1
+            rj_type = storage_json['type']
+            if rj_type == 'uri':
+                url_string = storage_json['value']
+                result = uri_string_from_storage(url_string, public_hostname)
+            elif rj_type == 'literal':
+                result = storage_json if isinstance(storage_json, dict) else dict(storage_json) # raw BSON sub-documents are read-only
+            else:
+                result = BNode(storage_json['value'])
+        elif 'u' in storage_json:
+            result = uri_string_from_storage(storage_json['u'], public_hostname)
+        elif 'b' in storage_json:
+            result = BNode(storage_json['b'])
         else:
-            result = BNode(storage_json['value'])
+            result = rdf_json_value_struct('literal', storage_json['l'], storage_json.get('d'))
     else:
         result = storage_json
     return result
-        
-def rdf_json_from_storage (storage_json, public_hostname):
-    # return rdf_json format for a single document
-    rdf_json = {}
-    if '@graph' in storage_json:
-        for storage_subject_node in storage_json['@graph']: 
-            rdf_subject = {}
-            for predicate, storage_value_array in storage_subject_node.iteritems():
-                if predicate == "@id": 
-                    pass
-                else:
-                    predicate = restore_predicate_from_storage(predicate)
-                    if isinstance(storage_value_array, (list, tuple)):
-                        rdf_subject[predicate] = [rdf_json_value_from_storage (item, public_hostname) for item in storage_value_array]
-                    else:
-                        rdf_subject[predicate] = rdf_json_value_from_storage (storage_value_array, public_hostname)
-            rdf_json[restore_URL_from_storage(storage_subject_node['@id'], public_hostname)] = rdf_subject
+
+def rdf_subject_from_storage(storage_subject_node, public_hostname, predicate_dictionary=None):
+    rdf_subject = {}
+    for predicate, storage_value_array in storage_subject_node.iteritems():
+        if predicate == "@id": 
+            pass
+        else:
+            predicate = restore_predicate_from_storage(predicate, predicate_dictionary)
+            if isinstance(storage_value_array, (list, tuple)):
+                rdf_subject[predicate] = [rdf_json_value_from_storage (item, public_hostname) for item in storage_value_array]
+            else:
+                rdf_subject[predicate] = rdf_json_value_from_storage (storage_value_array, public_hostname)
+    return rdf_subject
+
+def storage_format(storage_json):
+    return storage_json.get('_format', STORAGE_FORMAT_V1)
+
+def document_predicate_dictionary(storage_json, predicate_dictionary):
+    # return the dictionary needed to read the predicates of storage_json, or None if it is in storage format 1
+    if storage_format(storage_json) == STORAGE_FORMAT_V1:
+        return None
+    if predicate_dictionary is None:
+        raise ValueError('a predicate dictionary is needed to read storage format %s' % storage_format(storage_json))
+    return predicate_dictionary
+
+def graph_urls_from_storage(storage_json, public_hostname):
+    # return (graph_subject_url, version_url) - version_url is None unless storage_json is a history document
     if '_versionOf' in storage_json:
-        graph_subject_url = restore_URL_from_storage(storage_json['_versionOf'], public_hostname)
-        version_url = restore_URL_from_storage(storage_json['@id'], public_hostname)
-        rdf_json[version_url] = {CE+'versionOf': rdf_json_value_struct('uri', graph_subject_url), RDF+'type': rdf_json_value_struct('uri', CE+'Version')}
-        if graph_subject_url not in rdf_json:
-            rdf_json[graph_subject_url] = {}
+        return restore_URL_from_storage(storage_json['_versionOf'], public_hostname), restore_URL_from_storage(storage_json['@id'], public_hostname)
     else:
-        graph_subject_url = restore_URL_from_storage(storage_json['@id'], public_hostname)
-        version_url = None
-        if graph_subject_url not in rdf_json:
-            rdf_json[graph_subject_url] = {}
+        return restore_URL_from_storage(storage_json['@id'], public_hostname), None
+
+def version_subject_from_storage(graph_subject_url):
+    return {CE+'versionOf': rdf_json_value_struct('uri', graph_subject_url), RDF+'type': rdf_json_value_struct('uri', CE+'Version')}
+
+def system_properties_from_storage(storage_json, public_hostname):
+    properties = {}
     if '_modificationCount' in storage_json:
-        rdf_json[graph_subject_url][REVISION] = str(storage_json['_modificationCount'])
+        properties[REVISION] = str(storage_json['_modificationCount'])
     if '_lastModified' in storage_json:
-        rdf_json[graph_subject_url][LASTMODIFIED] = storage_json['_lastModified']
+        properties[LASTMODIFIED] = storage_json['_lastModified']
     if '_lastModifiedBy' in storage_json:
-        rdf_json[graph_subject_url][LASTMODIFIEDBY] = uri_string_from_storage(storage_json['_lastModifiedBy'], public_hostname)
+        properties[LASTMODIFIEDBY] = uri_string_from_storage(storage_json['_lastModifiedBy'], public_hostname)
     if '_created' in storage_json:
-        rdf_json[graph_subject_url][CREATED] = storage_json['_created']
+        properties[CREATED] = storage_json['_created']
     if '_createdBy' in storage_json:
-        rdf_json[graph_subject_url][CREATOR] = uri_string_from_storage(storage_json['_createdBy'], public_hostname)
+        properties[CREATOR] = uri_string_from_storage(storage_json['_createdBy'], public_hostname)
     if '_history' in storage_json: 
         history = storage_json['_history']
-        rdf_json[graph_subject_url][CE+'history'] = [URI(version) for version in history]
+        properties[CE+'history'] = [URI(version) for version in history]
+    return properties
+
+def rdf_json_from_storage (storage_json, public_hostname, predicate_dictionary=None):
+    # return rdf_json format for a single document
+    rdf_json = {}
+    if '@graph' in storage_json:
+        predicate_dictionary = document_predicate_dictionary(storage_json, predicate_dictionary)
+        for storage_subject_node in storage_json['@graph']: 
+            rdf_json[restore_URL_from_storage(storage_subject_node['@id'], public_hostname)] = rdf_subject_from_storage(storage_subject_node, public_hostname, predicate_dictionary)
+    graph_subject_url, version_url = graph_urls_from_storage(storage_json, public_hostname)
+    if version_url:
+        rdf_json[version_url] = version_subject_from_storage(graph_subject_url)
+    if graph_subject_url not in rdf_json:
+        rdf_json[graph_subject_url] = {}
+    rdf_json[graph_subject_url].update(system_properties_from_storage(storage_json, public_hostname))
     return RDF_JSON_Document(rdf_json, version_url or graph_subject_url)
+
+class Lazy_Storage_Graph(UserDict.DictMixin):
+    """
+    An rdf_json subject map over a single storage document (either decoded or raw BSON). Each subject is converted from
+    the storage format the first time it is accessed, so callers that only look at a few predicates (e.g., permission
+    checks reading ce:owner and ac:resource-group) don't pay for converting the whole document.
+    
+    Call materialize() to get a plain rdf_json dict, e.g., before serializing the document.
+    """
+    def __init__(self, storage_json, public_hostname, predicate_dictionary=None):
+        self.storage_json = storage_json
+        self.public_hostname = public_hostname
+        self.predicate_dictionary = document_predicate_dictionary(storage_json, predicate_dictionary)
+        self.graph_subject_url, self.version_url = graph_urls_from_storage(storage_json, public_hostname)
+        self.converted = {}
+        self.pending = {} # subject_url -> storage subject node (or None for subjects that are only synthesized from system properties)
+        if '@graph' in storage_json:
+            for storage_subject_node in storage_json['@graph']:
+                self.pending[restore_URL_from_storage(storage_subject_node['@id'], public_hostname)] = storage_subject_node
+        if self.version_url:
+            self.pending[self.version_url] = None
+        if self.graph_subject_url not in self.pending:
+            self.pending[self.graph_subject_url] = None
+
+    def convert_subject(self, subject_url):
+        storage_subject_node = self.pending.pop(subject_url)
+        if subject_url == self.version_url:
+            rdf_subject = version_subject_from_storage(self.graph_subject_url)
+        elif storage_subject_node is not None:
+            rdf_subject = rdf_subject_from_storage(storage_subject_node, self.public_hostname, self.predicate_dictionary)
+        else:
+            rdf_subject = {}
+        if subject_url == self.graph_subject_url:
+            rdf_subject.update(system_properties_from_storage(self.storage_json, self.public_hostname))
+        self.converted[subject_url] = rdf_subject
+        return rdf_subject
+
+    def __getitem__(self, subject_url):
+        if subject_url in self.converted:
+            return self.converted[subject_url]
+        if subject_url in self.pending:
+            return self.convert_subject(subject_url)
+        raise KeyError(subject_url)
+
+    def __setitem__(self, subject_url, rdf_subject):
+        self.pending.pop(subject_url, None)
+        self.converted[subject_url] = rdf_subject
+
+    def __delitem__(self, subject_url):
+        if subject_url in self.pending:
+            del self.pending[subject_url]
+        else:
+            del self.converted[subject_url]
+
+    def __contains__(self, subject_url):
+        return subject_url in self.converted or subject_url in self.pending
+
+    def has_key(self, subject_url):
+        return subject_url in self
+
+    def __iter__(self):
+        for subject_url in self.keys():
+            yield subject_url
+
+    def __len__(self):
+        return len(self.converted) + len(self.pending)
+
+    def keys(self):
+        return self.converted.keys() + self.pending.keys()
+
+    def materialize(self):
+        for subject_url in self.pending.keys():
+            self.convert_subject(subject_url)
+        return self.converted
+
+def lazy_rdf_json_from_storage(storage_json, public_hostname, predicate_dictionary=None):
+    # return a rdf_json document for a single document, whose subjects are converted on demand
+    rdf_json = Lazy_Storage_Graph(storage_json, public_hostname, predicate_dictionary)
+    return RDF_JSON_Document(rdf_json, rdf_json.version_url or rdf_json.graph_subject_url)
     
-def predicate_to_mongo(predicate):
+def predicate_to_mongo(predicate, predicate_dictionary=None, create=True):
     # This method does two things, which perhaps should be separated. The first is to escape '.' in predicate names sinc eMongoDB cannot
     # accept those. The second is to convert paths of the form a->b->c used in queries to the a.b.c form that Mongo knows. The second is done
     # here because we currently use the same json_structure_to_storage method for queries that we use for resource representations. It might be
     # better in the future to use a different path for queries, in which case this logic may move.
+    # In storage format 2 the predicate (first path segment) is replaced by its short ID. Queries pass create=False, so that querying an
+    # unknown predicate doesn't grow the dictionary; the format 1 name is used instead, which matches no format 2 document.
+    if predicate_dictionary is not None and not predicate.startswith('$'): # query operators are not predicates
+        path = predicate.split('->')
+        short_id = predicate_dictionary.short_id(path[0], create)
+        if short_id is not None:
+            path[0] = short_id
+            return '.'.join(path)
     if '.' in predicate: 
         predicate = predicate.replace('.', '%2E')
     if '->' in predicate:
         predicate = predicate.replace('->', '.')
     return predicate
    
-def query_value_to_storage(value, public_hostname, path_url):
-    return storage_value_from_rdf_json(value, public_hostname, path_url)
+def query_value_to_storage(value, public_hostname, path_url, predicate_dictionary=None):
+    return storage_value_from_rdf_json(value, public_hostname, path_url, predicate_dictionary)
+
+QUERY_VALUE_OPERATORS = ('$gt', '$gte', '$lt', '$lte', '$ne')
+QUERY_LIST_OPERATORS = ('$in', '$nin')
 
-def query_predicate_to_storage(predicate, value_array, public_hostname, path_url):
+def query_predicate_to_storage(predicate, value_array, public_hostname, path_url, predicate_dictionary=None):
     if predicate == '$or':
-        op1 = value_array[0].popitem()
-        op2 = value_array[1].popitem()
-        predicate1 = op1[0]
-        value_array1 = op1[1]
-        match_predicates1 = {}
-        match_predicates1[predicate_to_mongo(predicate1)] = query_predicate_to_storage(predicate1, value_array1, public_hostname, path_url)
-        predicate2 = op2[0]
-        value_array2 = op2[1]
-        match_predicates2 = {}
-        match_predicates2[predicate_to_mongo(predicate2)] = query_predicate_to_storage(predicate2, value_array2, public_hostname, path_url)
-        return [match_predicates1, match_predicates2]
+        operands = []
+        for operand in value_array:
+            match_predicates = {}
+            for operand_predicate, operand_value_array in operand.iteritems():
+                match_predicates[predicate_to_mongo(operand_predicate, predicate_dictionary, False)] = query_predicate_to_storage(operand_predicate, operand_value_array, public_hostname, path_url, predicate_dictionary)
+            operands.append(match_predicates)
+        return operands
     else:
         if isinstance(value_array, basestring) and value_array.startswith('_any'):
             return {'$exists' : True}
         elif hasattr(value_array, 'keys'):
-            if len(value_array) == 1 and '$in' in value_array:
-                values = value_array['$in']
-                return {'$in' : [query_value_to_storage(value, public_hostname, path_url) for value in values]}
-            elif len(value_array) == 1 and '$exists' in value_array:
-                value = value_array['$exists']
-                return {'$exists' : value}
-            else:
-                raise ValueError('unhandled clause %s' % value_array)
+            clause = {}
+            for operator, value in value_array.iteritems():
+                if operator in QUERY_LIST_OPERATORS:
+                    clause[operator] = [query_value_to_storage(item, public_hostname, path_url, predicate_dictionary) for item in value]
+                elif operator in QUERY_VALUE_OPERATORS:
+                    clause[operator] = query_value_to_storage(value, public_hostname, path_url, predicate_dictionary)
+                elif operator == '$exists':
+                    clause[operator] = value
+                else:
+                    raise ValueError('unhandled clause %s' % value_array)
+            return clause
         else:
             isArray = isinstance(value_array, (list, tuple))
             if isArray and len(value_array) > 1:
-                return {'$all' : [query_value_to_storage(value, public_hostname, path_url) for value in value_array]}
+                return {'$all' : [query_value_to_storage(value, public_hostname, path_url, predicate_dictionary) for value in value_array]}
             else:
-                return query_value_to_storage(value_array[0] if isArray else value_array, public_hostname, path_url)
-                    
-def query_to_storage(json_query, public_hostname, path_url):
+                return query_value_to_storage(value_array[0] if isArray else value_array, public_hostname, path_url, predicate_dictionary)
+
+def orderby_keys(orderby):
+    # $orderby is either {predicate: direction}, or a list of [predicate, direction] pairs (or {predicate: direction} dicts) for multiple keys
+    if hasattr(orderby, 'keys'):
+        if len(orderby) > 1:
+            raise ValueError('use a list for multiple $orderby keys: %s' % orderby)
+        return orderby.items()
+    keys = []
+    for key in orderby:
+        keys.extend(key.items() if hasattr(key, 'keys') else [tuple(key)])
+    return keys
+
+def query_to_storage(json_query, public_hostname, path_url, predicate_dictionary=None):
+    # Returns a MongoDB query. If json_query has query modifiers ($orderby, $skip, $limit), the result is of the form
+    # {'$query': <query>, '$orderby': [(<field>, <direction>), ...], '$skip': <int>, '$limit': <int>} and the modifiers
+    # must be applied to the cursor by the caller.
     if '$query' in json_query:
-        mongo_query_part = query_to_storage(json_query['$query'], public_hostname, path_url)
-        predicate, ascending = json_query['$orderby'].popitem()
-        predicate = predicate_to_mongo(predicate)
-        return {'$query': mongo_query_part, '$orderby': {predicate: ascending}}
+        mongo_query = {'$query': query_to_storage(json_query['$query'], public_hostname, path_url, predicate_dictionary)}
+        if '$orderby' in json_query:
+            mongo_query['$orderby'] = [('@graph.' + predicate_to_mongo(predicate, predicate_dictionary, False), int(direction)) for predicate, direction in orderby_keys(json_query['$orderby'])]
+        for modifier in ('$skip', '$limit'):
+            if modifier in json_query:
+                mongo_query[modifier] = int(json_query[modifier])
+        return mongo_query
     match_array = []
     for subject, subject_map in json_query.iteritems():
+        if subject == '$access':
+            match_array.append(access_query_to_storage(subject_map, public_hostname, path_url))
+            continue
         if subject.startswith('_any'):
             match_predicates = {} # would it be more correct to put something like {'$where' : 'this[@id] == this["@graph.0.@id"]'} ??
         else:  
             match_predicates = {'@id' : fix_up_url_for_storage(subject, public_hostname, path_url)}
         for predicate, value_array in subject_map.iteritems():
-            match_predicates[predicate_to_mongo(predicate)] = query_predicate_to_storage(predicate, value_array, public_hostname, path_url)
+            match_predicates[predicate_to_mongo(predicate, predicate_dictionary, False)] = query_predicate_to_storage(predicate, value_array, public_hostname, path_url, predicate_dictionary)
         match_array.append({'@graph': {'$elemMatch': match_predicates}})
     if len(match_array) > 1:
         mongo_query = {'$and' : match_array}
@@ -221,4 +386,101 @@ def query_to_storage(json_query, public_hostname, path_url):
         mongo_query = match_array[0]
     else:
         mongo_query = {}
-    return mongo_query
\ No newline at end of file
+    return mongo_query
+
+def access_query_to_storage(access, public_hostname, path_url):
+    # A '$access' query clause {'owner': <user url>, 'resourceGroups': [<resource group url>, ...]} matches the documents that
+    # are owned by the user or are in one of the resource groups. It is evaluated on the top-level '_owner' and
+    # '_resourceGroup' fields (see storage_access_control), which are indexed, rather than on the subjects.
+    clauses = [{'_owner': fix_up_url_for_storage(str(access['owner']), public_hostname, path_url)}]
+    resource_groups = access.get('resourceGroups')
+    if resource_groups:
+        clauses.append({'_resourceGroup': {'$in': [fix_up_url_for_storage(str(resource_group), public_hostname, path_url) for resource_group in resource_groups]}})
+    return {'$or': clauses} if len(clauses) > 1 else clauses[0]
+
+def storage_labels(subject_array, predicate_dictionary=None):
+    # Return the rdfs:label values of the subjects of a storage '@graph' array that are plain strings (i.e., the values an
+    # '_any' rdfs:label query matches), in the order they are first found.
+    label_key = predicate_to_mongo(LABEL, predicate_dictionary, False)
+    labels = []
+    for subject in subject_array:
+        value_array = subject.get(label_key)
+        for value in value_array if isinstance(value_array, (list, tuple)) else [value_array]:
+            if isinstance(value, basestring) and value not in labels:
+                labels.append(value)
+    return labels
+
+def storage_uri_value(storage_value):
+    # return the URL of a stored URI value (in either format), or None if it isn't a URI
+    if hasattr(storage_value, 'keys'):
+        if storage_value.get('type') == 'uri':
+            return storage_value['value']
+        return storage_value.get('u')
+    return None
+
+def storage_uri_values(subject_array, predicate, predicate_dictionary=None):
+    # return the URLs of the values of 'predicate' of the subjects of a storage '@graph' array, in the order they are first found
+    key = predicate_to_mongo(predicate, predicate_dictionary, False)
+    urls = []
+    for subject in subject_array:
+        value_array = subject.get(key)
+        for value in value_array if isinstance(value_array, (list, tuple)) else [value_array]:
+            url = storage_uri_value(value)
+            if url is not None and url not in urls:
+                urls.append(url)
+    return urls
+
+def storage_access_control(subject_array, predicate_dictionary=None):
+    # Return the (owner URLs, resource group URLs) of the subjects of a storage '@graph' array, i.e., the values a query for
+    # ce:owner or ac:resource-group on any subject matches.
+    return storage_uri_values(subject_array, OWNER, predicate_dictionary), storage_uri_values(subject_array, RESOURCE_GROUP, predicate_dictionary)
+
+def storage_memberships(subject_array, membership_index, predicate_dictionary=None):
+    # Return the (predicate, container, sort value) entries of a storage '@graph' array for a membership index. 'membership_index'
+    # maps membership predicates to the predicate whose (first) value is the sort value of a member, or None. A subject is a member
+    # of 'container' if it has the membership predicate with the (storage) URL 'container' as a value.
+    memberships = {}
+    for predicate, sort_predicate in membership_index.iteritems():
+        key = predicate_to_mongo(predicate, predicate_dictionary, False)
+        sort_key = predicate_to_mongo(sort_predicate, predicate_dictionary, False) if sort_predicate else None
+        for subject in subject_array:
+            value_array = subject.get(key)
+            if value_array is None:
+                continue
+            sort_value = subject.get(sort_key) if sort_key else None
+            if isinstance(sort_value, (list, tuple)):
+                sort_value = sort_value[0] if len(sort_value) > 0 else None
+            for value in value_array if isinstance(value_array, (list, tuple)) else [value_array]:
+                container = storage_uri_value(value)
+                if container is not None:
+                    memberships.setdefault((predicate, container), sort_value)
+    return [(predicate, container, sort_value) for (predicate, container), sort_value in memberships.iteritems()]
+
+def storage_value_to_format(storage_value, predicate_dictionary=None):
+    # convert a stored value (in either format) to format 1 (predicate_dictionary is None) or format 2
+    if isinstance(storage_value, (list, tuple)):
+        return [storage_value_to_format(item, predicate_dictionary) for item in storage_value]
+    if not hasattr(storage_value, 'keys'):
+        return storage_value # native value - same in both formats
+    if 'type' in storage_value:
+        rdf_type, value, datatype = storage_value['type'], storage_value['value'], storage_value.get('datatype')
+    elif 'u' in storage_value:
+        rdf_type, value, datatype = 'uri', storage_value['u'], None
+    elif 'b' in storage_value:
+        rdf_type, value, datatype = 'bnode', storage_value['b'], None
+    else:
+        rdf_type, value, datatype = 'literal', storage_value['l'], storage_value.get('d')
+    if rdf_type == 'bnode' and predicate_dictionary is None:
+        return {'type':'bnode','value':value}
+    return storage_value_struct(rdf_type, value, datatype, predicate_dictionary)
+
+def storage_subject_node_to_format(storage_subject_node, from_dictionary, to_dictionary):
+    # convert a stored subject node from one format to another. A dictionary argument of None means format 1.
+    result = {}
+    for predicate, storage_value_array in storage_subject_node.iteritems():
+        if predicate == '@id':
+            result[predicate] = storage_value_array
+        else:
+            predicate = restore_predicate_from_storage(predicate, from_dictionary)
+            result[predicate_to_mongo(predicate, to_dictionary)] = storage_value_to_format(storage_value_array, to_dictionary)
+    return result
@@ -0,0 +1,686 @@
+from storage_mapping import rdf_json_from_storage
+from storage_mapping import lazy_rdf_json_from_storage
+from storage_mapping import query_to_storage
+from storage_mapping import storage_value_from_rdf_json
+from storage_mapping import predicate_to_mongo
+from storage_mapping import fix_up_url_for_storage
+from storage_mapping import STORAGE_FORMAT_V2
+from storage_mapping import LABEL, OWNER, RESOURCE_GROUP
+from base_constants import URL_POLICY as url_policy
+from operation_primitives import PREDICATE_DICTIONARY, SYSTEM_PROPERTIES
+from operation_primitives import get_timestamp, make_objectid, make_historyid, tenant_collection, make_subject_array, collection_predicate_dictionary
+from operation_primitives import get_prior_versions, tenant_names, merge_revision, make_history_document
+from operation_primitives import index_field_complete
+from operation_primitives import index_fields, resolve_access_clause, patches_index_fields, update_index_fields
+from operation_primitives import membership_indexed, membership_query, members_collection, member_document_ids, insert_document_memberships
+from operation_primitives import patches_memberships, update_document_memberships, MEMBERSHIP_INDEX, MEMBERS_SUFFIX
+from operation_primitives import read_view, drop_view, register_view, update_views, remove_view_rows, drop_views
+from operation_primitives import set_request_deadline, time_limited, time_limit_ms, limit_time, query_result_limit
+from operation_primitives import write_concern
+from operation_primitives import create_attachment, get_attachment, delete_attachment, remove_attachments, drop_attachments
+from operation_primitives import append_change_entries, read_change_entries, change_log_length, allocate_change_positions, claim_change_positions, CHANGES_SUFFIX
+from operation_primitives import truncate_change_log, change_log_start, numbered_document_ids
+from operation_primitives import add_base_members, remove_base_members, read_base_members, BASE_SUFFIX
+from operation_primitives import read_document_changes, read_change_source_position, write_change_source_position
+from pymongo.errors import DuplicateKeyError
+from bson.son import SON
+from datetime import datetime
+import logging
+import time
+
+"""Subject-partitioned MongoDB implementation of Operation Primitives
+
+Select it by setting the OS environment variable OPERATION_PRIMITIVES=subject_partitioned_primitives. The connection
+is configured the same way as operation_primitives.
+
+Instead of storing all the subjects of a document in one '@graph' array, each document is stored as a header row in the
+collection 'tenant/namespace' and one row per subject in the collection 'tenant/namespace_subjects':
+
+  header:  {'_id': docId, '@id': document_url, '_modificationCount': number, '_created': ..., '_history': [...], ...}
+  subject: {'_document': docId, '@id': subject_url, <predicate>: <storage value>, ...}
+
+Subject rows are unique by (_document, @id), so patching a subject and reading a few subjects costs O(subject) rather than
+O(document), and documents are no longer limited by the maximum BSON document size. History documents are stored in the
+'@graph' layout of operation_primitives, so get_prior_versions is shared. The index fields (see operation_primitives) are in
+the header row, and the membership index and saved views are maintained in the same way as by operation_primitives (view
+rows are stored in the '@graph' layout, so read_view is shared). Attachments are stored in GridFS, as by operation_primitives.
+
+Note that the subject updates of a patch are not applied atomically with respect to concurrent readers. The revision check is
+atomic: a patch first takes a lock on the header row ('_patchLock', conditional on the revision), so a concurrent patch of the same
+revision fails with 409. The header's _modificationCount is only incremented (and the lock released) once all the subject rows
+have been written, so the index fields, memberships and view rows derived for a revision are never built from a half-applied
+patch. A lock left behind by a failed patch expires after PATCH_LOCK_SECONDS.
+"""
+
+logger=logging.getLogger(__name__)
+
+SUBJECTS_SUFFIX = '_subjects'
+BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+SORT_BATCH_SIZE = 10000 # document IDs per aggregation of a sorted query
+PATCH_LOCK_SECONDS = 30
+PATCH_LOCK_RETRIES = 20 # unconditional patches wait for the lock of a concurrent patch
+PATCH_LOCK_WAIT_SECONDS = 0.05
+
+def subjects_collection(tenant, namespace):
+    collection = tenant_collection(tenant, namespace + SUBJECTS_SUFFIX)
+    collection.ensure_index([('_document', 1), ('@id', 1)], unique=True)
+    return collection
+
+def create_document(user, document, public_hostname, tenant, namespace, resource_id=None):
+    """
+    Create a new document in the collection identified by 'public_hostname', 'tenant', and 'namespace'.
+
+    Return:
+        Success: (201, <new-document-url:string>, <new-document:rdf_json>)
+        Error: (<status-code:int>, None, <errror-msg:string>)
+    """
+    if resource_id == None:
+        resource_id = make_objectid()
+    elif resource_id[-1] == '/':
+        resource_id = resource_id + make_objectid()
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, resource_id)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    subject_array = make_subject_array(document, public_hostname, document_url, predicate_dictionary)
+    if subject_array is None:
+        logger.warn("create_document could not set system property")
+        return 400, None, 'cannot set system property'
+    timestamp = get_timestamp()
+    header = {'_id' : resource_id, '@id' : fix_up_url_for_storage('', public_hostname, document_url)}
+    header['_modificationCount'] =  0
+    if predicate_dictionary is not None:
+        header['_format'] = STORAGE_FORMAT_V2
+    header['_created'] = header['_lastModified'] = timestamp
+    header['_createdBy'] = header['_lastModifiedBy'] = fix_up_url_for_storage(user, public_hostname, document_url)
+    header.update(index_fields(subject_array, predicate_dictionary))
+
+    try:
+        tenant_collection(tenant, namespace).insert(header, **write_concern('document'))
+    except DuplicateKeyError:
+        logger.warn("create_document: duplicate document id {0}".format(resource_id))
+        return 409, None, 'duplicate document id: %s' % resource_id
+    insert_document_memberships(tenant, namespace, resource_id, subject_array, predicate_dictionary)
+    if len(subject_array) > 0:
+        subjects_collection(tenant, namespace).insert([dict(subject, _document=resource_id) for subject in subject_array], **write_concern('document'))
+    update_views(tenant, namespace, resource_id, view_row) # the view rows are read from the subject rows
+
+    logger.info("created document {0}".format(document_url))
+    header['@graph'] = subject_array
+    return 201, document_url, rdf_json_from_storage(header, public_hostname, predicate_dictionary)
+
+def replace_document(user, document, public_hostname, tenant, namespace, document_id):
+    """
+    Replace the content of the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with
+    'document' (rdf_json), creating the document if it doesn't exist (see operation_primitives.replace_document).
+
+    The header row is upserted, and the subject rows are then replaced.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, document_id)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    subject_array = make_subject_array(document, public_hostname, document_url, predicate_dictionary)
+    if subject_array is None:
+        logger.warn("replace_document could not set system property")
+        return 400, 'cannot set system property'
+    timestamp = get_timestamp()
+    storage_user = fix_up_url_for_storage(user, public_hostname, document_url)
+    sets = {'@id': fix_up_url_for_storage('', public_hostname, document_url), '_lastModified': timestamp, '_lastModifiedBy': storage_user}
+    if predicate_dictionary is not None:
+        sets['_format'] = STORAGE_FORMAT_V2
+    patch = {'$set': sets, '$inc': {'_modificationCount': 1}, '$setOnInsert': {'_created': timestamp, '_createdBy': storage_user}}
+    tenant_collection(tenant, namespace).update({'_id': document_id}, patch, upsert=True, **write_concern('tracking'))
+    subjects = subjects_collection(tenant, namespace)
+    subjects.remove({'_document': document_id}, **write_concern('tracking'))
+    if len(subject_array) > 0:
+        subjects.insert([dict(subject, _document=document_id) for subject in subject_array], **write_concern('tracking'))
+    logger.debug("replaced document {0}".format(document_url))
+    return 200, None
+
+@time_limited
+def execute_query(user, query, public_hostname, tenant, namespace, projection=None, lazy=False):
+    """
+    Execute the specified 'query' against the collection identified by 'public_hostname', 'tenant',
+    and 'namespace'.
+
+    Each subject clause of the query is evaluated against the subject rows, and the matching documents are the
+    documents that have a matching subject for every clause.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit (see operation_primitives.MAX_TIME_MS)
+    """
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    query = resolve_access_clause(tenant, namespace, query)
+    query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    logger.debug('execute_query: MongoDB query %s', query)
+    modifiers = {}
+    if '$query' in query:
+        modifiers = query
+        query = query['$query']
+    subjects = subjects_collection(tenant, namespace)
+    document_ids = matching_document_ids(subjects, query, tenant_collection(tenant, namespace)) if query else None
+    if document_ids is not None:
+        document_ids = list(document_ids)
+    elif '$orderby' not in modifiers: # page through the header rows, rather than reading all their IDs
+        cursor = tenant_collection(tenant, namespace).find({}, {'_id': True})
+        cursor = cursor.skip(modifiers.get('$skip', 0)).limit(query_result_limit(modifiers.get('$limit')))
+        document_ids = [header['_id'] for header in limit_time(cursor)]
+        modifiers = {}
+    document_ids = apply_query_modifiers(subjects, document_ids, modifiers, query_result_limit(modifiers.get('$limit')))
+    result = get_query_result(tenant, namespace, document_ids, public_hostname, projection, lazy)
+    logger.debug("executed query {0}".format(query))
+    return 200, result
+
+@time_limited
+def get_document(user, public_hostname, tenant, namespace, documentId, lazy=False):
+    """
+    Get the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    Return:
+        Success: (200, <result-document:rdf_json>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    storage_json = get_storage_document(tenant, namespace, documentId)
+    if storage_json is not None:
+        document = lazy_rdf_json_from_storage(storage_json, public_hostname, PREDICATE_DICTIONARY) if lazy else rdf_json_from_storage(storage_json, public_hostname, PREDICATE_DICTIONARY)
+        logger.debug("retrieved document {0}".format(documentId))
+        return 200, document
+    else:
+        logger.warn("could not fetch {0} in namespace {1} for tenant {2}".format(documentId, namespace, tenant))
+        return 404, '404 not found'
+
+@time_limited
+def get_document_subjects(user, public_hostname, tenant, namespace, documentId, subject_urls):
+    """
+    Get only the subjects 'subject_urls' (plus the system properties) of the document specified by 'public_hostname', 'tenant',
+    'namespace', and 'document_id'.
+
+    Return:
+        Success: (200, <result-document:rdf_json>)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, documentId)
+    storage_subject_urls = [fix_up_url_for_storage(subject_url, public_hostname, document_url) for subject_url in subject_urls]
+    storage_json = get_storage_document(tenant, namespace, documentId, {'@id': {'$in': storage_subject_urls}})
+    if storage_json is not None:
+        return 200, rdf_json_from_storage(storage_json, public_hostname, PREDICATE_DICTIONARY)
+    else:
+        logger.warn("could not fetch {0} in namespace {1} for tenant {2}".format(documentId, namespace, tenant))
+        return 404, '404 not found'
+
+@time_limited
+def get_documents(user, public_hostname, tenant, namespace, document_ids, lazy=False):
+    """
+    Get the documents with the IDs 'document_ids' (see operation_primitives.get_documents). The header rows and the subject
+    rows are each read with one query.
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit
+    """
+    result = get_query_result(tenant, namespace, list(document_ids), public_hostname, lazy=lazy)
+    logger.debug("retrieved {0} documents in namespace {1} for tenant {2}".format(len(result), namespace, tenant))
+    return 200, result
+
+def delete_document(user, public_hostname, tenant, namespace, document_id):
+    """
+    Delete the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id'.
+
+    If the document doesn't exist, this function is a NO-OP.
+
+    Return:
+        Success: (200, None)
+        Error: no errors
+    """
+    tenant_collection(tenant, namespace).remove(document_id, True, **write_concern('document'))
+    subjects_collection(tenant, namespace).remove({'_document': document_id}, **write_concern('document'))
+    if MEMBERSHIP_INDEX:
+        members_collection(tenant, namespace).remove({'document': document_id}, **write_concern('derived'))
+    remove_view_rows(tenant, namespace, [document_id])
+    remove_attachments(tenant, namespace, [document_id])
+    logger.info("deleted document {0}".format(document_id))
+    return 200, None
+
+@time_limited
+def delete_documents(user, query, public_hostname, tenant, namespace):
+    """
+    Delete all the documents that match 'query' (see execute_query) in the collection identified by 'public_hostname',
+    'tenant', and 'namespace'.
+
+    Return:
+        Success: (200, [<deleted-document-id:string>, ...])
+        Error: (503 or 504, <errror-msg:string>) if reading the matching IDs exceeds its time limit (nothing is deleted)
+    """
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    query = resolve_access_clause(tenant, namespace, query)
+    query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    modifiers = query if '$query' in query else {}
+    query = query.get('$query', query)
+    subjects = subjects_collection(tenant, namespace)
+    if query:
+        document_ids = list(matching_document_ids(subjects, query, tenant_collection(tenant, namespace)))
+    elif '$orderby' in modifiers:
+        document_ids = None # sorted by the subject rows
+    else:
+        document_ids = [header['_id'] for header in limit_time(tenant_collection(tenant, namespace).find({}, {'_id': True}))]
+    document_ids = apply_query_modifiers(subjects, document_ids, modifiers)
+    for index in range(0, len(document_ids), DELETE_BATCH_SIZE):
+        batch = document_ids[index:index+DELETE_BATCH_SIZE]
+        create_history_documents(public_hostname, tenant, namespace, batch)
+        tenant_collection(tenant, namespace).remove({'_id': {'$in': batch}}, **write_concern('document'))
+        subjects.remove({'_document': {'$in': batch}}, **write_concern('document'))
+        if MEMBERSHIP_INDEX:
+            members_collection(tenant, namespace).remove({'document': {'$in': batch}}, **write_concern('derived'))
+        remove_view_rows(tenant, namespace, batch)
+        remove_attachments(tenant, namespace, batch)
+    logger.info("deleted {0} documents in namespace {1} for tenant {2}".format(len(document_ids), namespace, tenant))
+    return 200, document_ids
+
+def drop_collection(user, public_hostname, tenant, namespace):
+    logger.info("dropped collection {0} for tenant {1}".format(namespace, tenant))
+    tenant_collection(tenant, namespace).drop()
+    tenant_collection(tenant, namespace + SUBJECTS_SUFFIX).drop()
+    tenant_collection(tenant, namespace + MEMBERS_SUFFIX).drop()
+    drop_views(tenant, namespace)
+    drop_attachments(tenant, namespace)
+    tenant_collection(tenant, namespace + CHANGES_SUFFIX).drop()
+    tenant_collection(tenant, namespace + BASE_SUFFIX).drop()
+
+def remove_numbered_documents(tenant, namespace, prefix, before):
+    """
+    Remove the documents '<prefix><n>' whose number n is less than 'before' (see operation_primitives.remove_numbered_documents).
+
+    Return:
+        Success: (200, <count:int>) the number of documents removed
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    document_ids = numbered_document_ids(tenant_collection(tenant, namespace), prefix, before)
+    if len(document_ids) > 0:
+        tenant_collection(tenant, namespace).remove({'_id': {'$in': document_ids}}, **write_concern('tracking'))
+        subjects_collection(tenant, namespace).remove({'_document': {'$in': document_ids}}, **write_concern('tracking'))
+    return 200, len(document_ids)
+
+def create_history_document(user, public_hostname, tenant, namespace, document_id):
+    storage_json = get_storage_document(tenant, namespace, document_id)
+    if storage_json is not None:
+        storage_json.pop('_patchLock', None)
+        history_document_url = make_history_document(storage_json, public_hostname, tenant, namespace)
+        tenant_collection(tenant, namespace + '_history').insert(storage_json, **write_concern('history'))
+
+        logger.info("created history document {0}".format(history_document_url))
+
+        return 201, history_document_url
+    else:
+        logger.warn("create_history_document failed for id {0}".format(document_id))
+        return 404, None
+
+def create_history_documents(public_hostname, tenant, namespace, document_ids):
+    # see operation_primitives.create_history_documents - the subject rows of all the documents are read with a single query
+    headers = dict((header['_id'], header) for header in tenant_collection(tenant, namespace).find({'_id': {'$in': list(document_ids)}}))
+    if not headers:
+        return
+    for header in headers.itervalues():
+        header['@graph'] = []
+    for row in subjects_collection(tenant, namespace).find({'_document': {'$in': headers.keys()}}):
+        headers[row['_document']]['@graph'].append(strip_subject_row(row))
+    for header in headers.itervalues():
+        make_history_document(header, public_hostname, tenant, namespace)
+    tenant_collection(tenant, namespace + '_history').insert(headers.values(), **write_concern('history'))
+
+def patch_document(user, revision, new_values, public_hostname, tenant, namespace, document_id, merge=False):
+    """
+    Patch the document specified by 'public_hostname', 'tenant', 'namespace', and 'document_id' with the
+    content in 'new_values'. See operation_primitives.patch_document for the revision, history and merge semantics.
+
+    The header row is locked first (conditional on the revision), then each patched subject row is updated, upserted
+    or removed on its own, and finally the header's revision is incremented and the lock released. The index fields,
+    memberships and view rows are updated after that, so they are derived from the complete patched revision.
+
+    Return:
+        Success: (200, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    try:
+        mod_count = int(revision)
+    except ValueError:
+        logger.warn("patch_document revision must be an integer: {0}".format(revision))
+        return 400, 'revision must be an integer: %s' % revision
+
+    if merge and mod_count != -1:
+        status, mod_count = merge_revision(new_values, public_hostname, tenant, namespace, document_id, mod_count, get_storage_document(tenant, namespace, document_id))
+        if status != 200:
+            return status, mod_count
+
+    document_url = url_policy.construct_url(public_hostname, tenant, namespace, document_id)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    subject_patches = []
+    for subject_url, subject_node in new_values.iteritems():
+        if subject_node is None: continue
+        subject_sets = {}
+        subject_unsets = {}
+        for predicate, value_array in subject_node.iteritems():
+            if predicate in SYSTEM_PROPERTIES or predicate == '_id':
+                logger.warn("patch_document cannot set system property: {0}".format(predicate))
+                return 400, 'cannot set system property'
+            if isinstance(value_array, (list, tuple)):
+                if len(value_array) > 0:
+                    subject_sets[predicate_to_mongo(predicate, predicate_dictionary)] = [storage_value_from_rdf_json(value, public_hostname, document_url, predicate_dictionary) for value in value_array]
+                else:
+                    subject_unsets[predicate_to_mongo(predicate, predicate_dictionary)] = 1
+            elif value_array == None:
+                subject_unsets[predicate_to_mongo(predicate, predicate_dictionary)] = 1
+            else:
+                subject_sets[predicate_to_mongo(predicate, predicate_dictionary)] = storage_value_from_rdf_json(value_array, public_hostname, document_url, predicate_dictionary)
+        subject_patches.append((fix_up_url_for_storage(subject_url, public_hostname, document_url), subject_sets, subject_unsets))
+    delete_subject_urls = [fix_up_url_for_storage(x, public_hostname, document_url) for x in new_values.iterkeys() if new_values[x] is None]
+
+    status, lock = lock_document(tenant, namespace, document_id, mod_count)
+    if status != 200:
+        return status, lock
+    status, history_document_id = create_history_document(user, public_hostname, tenant, namespace, document_id)
+    if status != 201:
+        logger.warn("patch_document failed to create history document: {0}".format(status))
+        tenant_collection(tenant, namespace).update({'_id': document_id, '_patchLock.id': lock}, {'$unset': {'_patchLock': 1}}, **write_concern('document'))
+        return status, 'failed to create history document'
+
+    subjects = subjects_collection(tenant, namespace)
+    if len(delete_subject_urls) != 0:
+        subjects.remove({'_document': document_id, '@id': {'$in': delete_subject_urls}}, **write_concern('document'))
+    for storage_subject_url, subject_sets, subject_unsets in subject_patches:
+        subject_patch = {'$set': dict(subject_sets, _document=document_id)}
+        subject_patch['$set']['@id'] = storage_subject_url
+        # mongo does not allow $unset to be empty
+        if len(subject_unsets):
+            subject_patch['$unset'] = subject_unsets
+        subjects.update({'_document': document_id, '@id': storage_subject_url}, subject_patch, upsert=True, **write_concern('document'))
+    patch = {'$inc' : {'_modificationCount' : 1}, '$set' : {'_lastModified' : get_timestamp(), '_lastModifiedBy': user}, '$push': {'_history' : history_document_id}, '$unset': {'_patchLock': 1}}
+    last_err = tenant_collection(tenant, namespace).update({'_id': document_id, '_patchLock.id': lock}, patch, **write_concern('document'))
+    if last_err['n'] != 1:
+        # the lock expired and was taken by another patch, whose revision now includes these subject updates
+        logger.warn("patch_document lost the lock of document {0}: {1}".format(document_id, last_err))
+        return 409, 'patch lock expired'
+    if patches_index_fields(new_values):
+        update_index_fields(tenant, namespace, document_id, lambda: get_index_field_subjects(tenant, namespace, document_id, predicate_dictionary), predicate_dictionary)
+    if patches_memberships(new_values):
+        update_document_memberships(tenant, namespace, document_id, lambda: get_storage_document(tenant, namespace, document_id), predicate_dictionary)
+    update_views(tenant, namespace, document_id, view_row)
+
+    logger.debug("Patched document {0}".format(document_id))
+    return 200, None
+
+def lock_document(tenant, namespace, document_id, mod_count):
+    # take the patch lock of a document header, conditional on its revision unless 'mod_count' is -1. A lock that is held
+    # by a concurrent patch is waited for only if the revision is not checked, since the revision changes when it's released.
+    # Return (200, <lock id>), or (409, <error-msg>) if the revision doesn't match or the lock is held.
+    lock = make_objectid()
+    collection = tenant_collection(tenant, namespace)
+    criteria = {'_id': document_id}
+    if mod_count != -1:
+        criteria['_modificationCount'] = mod_count
+    for _ in range(PATCH_LOCK_RETRIES):
+        now = time.time()
+        criteria['$or'] = [{'_patchLock': {'$exists': False}}, {'_patchLock.expires': {'$lt': now}}]
+        last_err = collection.update(criteria, {'$set': {'_patchLock': {'id': lock, 'expires': now + PATCH_LOCK_SECONDS}}}, **write_concern('document'))
+        if last_err['n'] == 1:
+            return 200, lock
+        if mod_count != -1 or collection.find_one({'_id': document_id}, {'_id': True}) is None:
+            break
+        time.sleep(PATCH_LOCK_WAIT_SECONDS)
+    logger.warn("patch_document unexpected update count: {0}".format(last_err))
+    return 409, 'unexpected update count %s' % last_err
+
+@time_limited
+def find_documents_by_label(user, label, public_hostname, tenant, namespace):
+    """
+    Find the documents in the collection identified by 'public_hostname', 'tenant', and 'namespace' that have a subject
+    whose rdfs:label is 'label' (see operation_primitives.find_documents_by_label).
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: (503 or 504, <errror-msg:string>) if the query exceeds its time limit (see operation_primitives.MAX_TIME_MS)
+    """
+    if not index_field_complete(tenant, namespace, '_labels'):
+        return execute_query(user, {'_any': {LABEL: label}}, public_hostname, tenant, namespace)
+    document_ids = [header['_id'] for header in limit_time(tenant_collection(tenant, namespace).find({'_labels': label}, {'_id': True}).limit(BATCH_SIZE))]
+    result = get_query_result(tenant, namespace, document_ids, public_hostname)
+    logger.debug("found {0} documents with label {1}".format(len(result), label))
+    return 200, result
+
+@time_limited
+def find_members(user, membership_resource, membership_predicate, query, sort_predicate, public_hostname, tenant, namespace, skip=0, limit=None):
+    """
+    Find the members of 'membership_resource' that match 'query' (see operation_primitives.find_members).
+
+    Return:
+        Success: (200, [<result-document1:rdf_json>, <result-document2:rdf_json>, ...])
+        Error: no errors
+    """
+    if not membership_indexed(membership_predicate, sort_predicate):
+        return execute_query(user, membership_query(membership_resource, membership_predicate, query, sort_predicate, skip, limit), public_hostname, tenant, namespace)
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    match = None
+    if query:
+        query = resolve_access_clause(tenant, namespace, query)
+        storage_query = query_to_storage(query, public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+        def match(candidate_ids):
+            matching_ids = matching_document_ids(subjects_collection(tenant, namespace), storage_query, tenant_collection(tenant, namespace), candidate_ids)
+            return candidate_ids if matching_ids is None else [document_id for document_id in candidate_ids if document_id in matching_ids]
+    document_ids = member_document_ids(tenant, namespace, membership_predicate, fix_up_url_for_storage(membership_resource, public_hostname, collection_url), skip, limit, match)
+    result = get_query_result(tenant, namespace, document_ids, public_hostname)
+    logger.debug("found {0} members of {1}".format(len(result), membership_resource))
+    return 200, result
+
+@time_limited
+def count_members(user, membership_resource, membership_predicate, public_hostname, tenant, namespace):
+    """
+    Count the documents that find_members (without a query) would find.
+
+    Return:
+        Success: (200, <count:int>)
+        Error: no errors
+    """
+    collection_url = url_policy.construct_url(public_hostname, tenant, namespace, None)
+    if membership_indexed(membership_predicate):
+        criteria = {'predicate': membership_predicate, 'container': fix_up_url_for_storage(membership_resource, public_hostname, collection_url)}
+        return 200, limit_time(members_collection(tenant, namespace).find(criteria)).count()
+    storage_query = query_to_storage(membership_query(membership_resource, membership_predicate), public_hostname, collection_url, collection_predicate_dictionary(tenant, namespace))
+    return 200, len(matching_document_ids(subjects_collection(tenant, namespace), storage_query, tenant_collection(tenant, namespace)))
+
+def create_view(user, name, query, projection, public_hostname, tenant, namespace):
+    """
+    Register the view 'name' of the collection identified by 'public_hostname', 'tenant', and 'namespace', and
+    materialize it (see operation_primitives.create_view).
+
+    Return:
+        Success: (201, None)
+        Error: (<status-code:int>, <errror-msg:string>)
+    """
+    status, view = register_view(name, query, projection, public_hostname, tenant, namespace)
+    if status != 201:
+        return status, view
+    headers = tenant_collection(tenant, namespace)
+    if view['query']:
+        document_ids = matching_document_ids(subjects_collection(tenant, namespace), view['query'], headers)
+    else:
+        document_ids = [header['_id'] for header in headers.find({}, {'_id': True})]
+    for document_id in document_ids:
+        update_views(tenant, namespace, document_id, view_row, [view])
+    logger.info("created view {0} of namespace {1} for tenant {2}".format(name, namespace, tenant))
+    return 201, None
+
+def view_row(tenant, namespace, view, document_id):
+    # the (projected) storage document that is the row of 'view' for a document, or None if the document doesn't match the view's query
+    if view['query'] and document_id not in matching_document_ids(subjects_collection(tenant, namespace), view['query'], tenant_collection(tenant, namespace), [document_id]):
+        return None
+    return get_storage_document(tenant, namespace, document_id, projection=view['projection'])
+
+def get_index_field_subjects(tenant, namespace, document_id, predicate_dictionary=None):
+    # the header of a document, with only the subjects that have a predicate of an index field
+    return get_storage_document(tenant, namespace, document_id, {'$or': [{predicate_to_mongo(predicate, predicate_dictionary, False): {'$exists': True}} for predicate in (LABEL, OWNER, RESOURCE_GROUP)]})
+
+def rebuild_index_fields(tenant, namespace):
+    """
+    Set the index fields of every header row in the collection identified by 'tenant' and 'namespace'.
+    """
+    collection = tenant_collection(tenant, namespace)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    count = 0
+    for header in collection.find({}, {'_id': True}):
+        document_id = header['_id']
+        update_index_fields(tenant, namespace, document_id, lambda: get_index_field_subjects(tenant, namespace, document_id, predicate_dictionary), predicate_dictionary)
+        count += 1
+    for field in ('_labels', '_owner', '_resourceGroup'):
+        collection.ensure_index(field)
+    return count
+
+def rebuild_membership_index(tenant, namespace):
+    """
+    Write the membership rows of every document in the collection identified by 'tenant' and 'namespace'.
+    """
+    collection = tenant_collection(tenant, namespace)
+    predicate_dictionary = collection_predicate_dictionary(tenant, namespace)
+    count = 0
+    for header in collection.find({}, {'_id': True}):
+        document_id = header['_id']
+        update_document_memberships(tenant, namespace, document_id, lambda: get_storage_document(tenant, namespace, document_id), predicate_dictionary)
+        count += 1
+    return count
+
+def matching_document_ids(subjects, query, headers, candidate_ids=None):
+    # Return the set of IDs of the documents (of 'candidate_ids', if given) that have a matching subject row for every subject
+    # clause of the storage query, and whose header row matches the other (e.g., '$access') clauses
+    clauses = query['$and'] if '$and' in query else [query]
+    subject_matches = [clause['@graph']['$elemMatch'] for clause in clauses if '@graph' in clause]
+    header_matches = [clause for clause in clauses if '@graph' not in clause]
+    if candidate_ids is not None:
+        subject_matches = [{'$and': [subject_match, {'_document': {'$in': candidate_ids}}]} for subject_match in subject_matches]
+        header_matches = header_matches + [{'_id': {'$in': candidate_ids}}] if header_matches else header_matches
+    document_ids = None
+    if header_matches:
+        document_ids = set(header['_id'] for header in limit_time(headers.find({'$and': header_matches}, {'_id': True})))
+    for subject_match in subject_matches:
+        if document_ids is not None and not document_ids:
+            break
+        # the IDs are streamed from the subject rows, rather than returned by a single distinct reply (which is limited in size)
+        matching_ids = set(row['_document'] for row in limit_time(subjects.find(subject_match, {'_document': True, '_id': False})))
+        document_ids = matching_ids if document_ids is None else document_ids & matching_ids
+    return document_ids
+
+def get_storage_document(tenant, namespace, document_id, subject_criteria=None, projection=None):
+    # assemble the header and subject rows of a document into the '@graph' storage layout
+    header = tenant_collection(tenant, namespace).find_one({'_id': document_id})
+    if header is None:
+        return None
+    criteria = {'_document': document_id}
+    if subject_criteria:
+        criteria.update(subject_criteria)
+    if projection is not None:
+        rows = subjects_collection(tenant, namespace).find(criteria, subject_row_fields(projection))
+    else:
+        rows = subjects_collection(tenant, namespace).find(criteria)
+    rows = limit_time(rows)
+    header['@graph'] = [strip_subject_row(row) for row in rows]
+    return header
+
+def subject_row_fields(projection):
+    # Note: projection must NOT suppress the @id field (@id is needed by the storage format conversion routine)
+    fields = dict((key[len('@graph.'):] if key.startswith('@graph.') else key, value) for key, value in projection.iteritems())
+    fields['@id'] = fields['_document'] = True
+    return fields
+
+def strip_subject_row(row):
+    row.pop('_id', None)
+    row.pop('_document', None)
+    return row
+
+def get_query_result(tenant, namespace, document_ids, public_hostname, projection=None, lazy=False):
+    # document_ids are in result order
+    headers = dict((header['_id'], header) for header in limit_time(tenant_collection(tenant, namespace).find({'_id': {'$in': document_ids}})))
+    if projection is not None:
+        rows = subjects_collection(tenant, namespace).find({'_document': {'$in': document_ids}}, subject_row_fields(projection))
+    else:
+        rows = subjects_collection(tenant, namespace).find({'_document': {'$in': document_ids}})
+    rows = limit_time(rows)
+    for header in headers.itervalues():
+        header['@graph'] = []
+    for row in rows:
+        header = headers.get(row['_document'])
+        if header is not None:
+            header['@graph'].append(strip_subject_row(row))
+    response = []
+    for document_id in document_ids:
+        if document_id in headers:
+            storage_json = headers[document_id]
+            response.append(lazy_rdf_json_from_storage(storage_json, public_hostname, PREDICATE_DICTIONARY) if lazy else rdf_json_from_storage(storage_json, public_hostname, PREDICATE_DICTIONARY))
+    return response
+
+def apply_query_modifiers(subjects, document_ids, modifiers, limit=None):
+    # Return the IDs that the $orderby, $skip and $limit modifiers select from 'document_ids' - at most 'limit' of them, if
+    # it isn't None. 'document_ids' is None for all the documents of the collection, if there is an $orderby.
+    skip = modifiers.get('$skip', 0)
+    if modifiers.get('$limit'): # a $limit of 0 is no limit
+        limit = min(limit, modifiers['$limit']) if limit else modifiers['$limit']
+    if '$orderby' in modifiers:
+        document_ids = sort_document_ids(subjects, document_ids, modifiers['$orderby'], skip + limit if limit else None)
+    return document_ids[skip:skip+limit] if limit else document_ids[skip:]
+
+def sort_document_ids(subjects, document_ids, orderby, count=None):
+    # Return the first 'count' (or all) of 'document_ids' (None for all the documents of the collection), ordered by the sort
+    # predicates of their subjects. orderby is a list of (field, direction) pairs, as produced by query_to_storage. MongoDB
+    # groups the subject rows by document, with the least (or, descending, the greatest) value of each sort predicate, and
+    # sorts and limits the groups - so documents without the predicate come first, like MongoDB's sort of missing fields,
+    # and only 'count' groups are kept. The IDs are matched in batches of SORT_BATCH_SIZE, whose first groups are merged.
+    # Documents without any subject rows have no group, so they aren't returned.
+    group = {'_id': '$_document'}
+    sort = SON()
+    for index, (field, direction) in enumerate(orderby):
+        predicate = field[len('@graph.'):] if field.startswith('@graph.') else field
+        group['k%d' % index] = {'$min' if direction == 1 else '$max': '$' + predicate}
+        sort['k%d' % index] = direction
+    sort['_id'] = 1
+    if document_ids is None:
+        batches = [None]
+    else:
+        batches = [document_ids[index:index+SORT_BATCH_SIZE] for index in range(0, len(document_ids), SORT_BATCH_SIZE)]
+    groups = []
+    for batch in batches:
+        pipeline = [{'$group': group}, {'$sort': sort}] + ([{'$limit': count}] if count else [])
+        if batch is not None:
+            pipeline.insert(0, {'$match': {'_document': {'$in': batch}}})
+        groups.extend(aggregate(subjects, pipeline))
+    if len(batches) > 1:
+        groups.sort(key=lambda row: row['_id'])
+        for index, (field, direction) in reversed(list(enumerate(orderby))): # stable sorts, least significant key first
+            groups.sort(key=lambda row: sort_value_key(row.get('k%d' % index)), reverse=direction == -1)
+    return [group['_id'] for group in (groups[:count] if count else groups)]
+
+def aggregate(collection, pipeline):
+    # the result documents of an aggregation, which may use disk for large sorts and groups
+    options = {'allowDiskUse': True, 'cursor': {}}
+    limit = time_limit_ms()
+    if limit is not None:
+        options['maxTimeMS'] = limit
+    result = collection.aggregate(pipeline, **options)
+    return result['result'] if hasattr(result, 'keys') else result
+
+def sort_value_key(value):
+    # A Python sort key for the values of a sort predicate that orders them like MongoDB does for the common BSON types
+    # (null, numbers, strings, objects, arrays, booleans, dates), to merge the results of several aggregations.
+    if value is None:
+        return (1, None)
+    elif isinstance(value, bool):
+        return (8, value)
+    elif isinstance(value, (int, long, float)):
+        return (2, value)
+    elif isinstance(value, basestring):
+        return (3, value)
+    elif hasattr(value, 'keys'):
+        return (4, [(key, sort_value_key(item)) for key, item in value.iteritems()])
+    elif isinstance(value, (list, tuple)):
+        return (5, [sort_value_key(item) for item in value])
+    elif isinstance(value, datetime):
+        return (9, value)
+    return (6, value)